@@ -67,18 +67,15 @@ def read(dataset, args):
             print('Layer', layer_name, 'does not exist')
             return
         actual_count = 0
-        max_results = None if expected_count < 100 else 100
-        call_number = 0
-        while actual_count < expected_count:
-            annotations = dataset.get_annotations(
-                layer_name, first_result=actual_count, max_results=max_results)
-            call_number += 1
-            actual_count += len(annotations)
-            first = annotations[0].start_time_offset_usec
-            last = annotations[-1].end_time_offset_usec
-            print("got", len(annotations), "annotations on call #",
-                  call_number, "covering", first, "usec to", last, "usec")
-        print("got", actual_count, "annotations in total")
+        first = None
+        last = None
+        for annotation in dataset.iter_annotations(layer_name, page_size=100):
+            actual_count += 1
+            if first is None:
+                first = annotation.start_time_offset_usec
+            last = annotation.end_time_offset_usec
+        print("got", actual_count, "annotations in total covering",
+              first, "usec to", last, "usec")
 
 
 @dataset_required
@@ -0,0 +1,155 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import numpy as np
+
+
+class AnnotationIndex:
+    """
+    An index of the annotations in an ieeg.dataset.AnnotationTable which answers
+    overlap, stabbing and nearest event queries by time and channel.
+
+    The annotations are sorted by start time, and an interval tree of the largest end
+    time under each node finds the annotations which span a given time. An overlap
+    query for [start, end) is then the annotations spanning start plus the contiguous
+    run of annotations starting in [start, end). Building the index takes O(n log n)
+    and a query takes O(log n) plus time proportional to the number of results.
+
+    Times are microseconds since the recording start, as in AnnotationTable.
+    An annotation covers [start_usec, end_usec), or only start_usec if it has no length.
+    Queries return row indices into table, in start time order unless noted.
+
+        index = dataset.get_annotation_index('Seizures')
+        seizures = index.table[index.overlapping(start, end, channels=[0, 3])]
+
+    Attributes:
+        table: The indexed AnnotationTable sorted by start time.
+    """
+
+    def __init__(self, table):
+        self.table = table[np.argsort(table.start_usec, kind='stable')]
+        self._starts = self.table.start_usec
+        self._ends = np.maximum(self.table.end_usec, self._starts + 1)
+        self._end_order = np.argsort(self._ends, kind='stable')
+        self._sorted_ends = self._ends[self._end_order]
+
+        # An implicit binary tree over the rows where node i has children 2i and 2i + 1
+        # and holds the largest end under it. The leaves start at _leaf_count.
+        self._leaf_count = 1
+        while self._leaf_count < len(self.table):
+            self._leaf_count *= 2
+        self._max_ends = np.full(2 * self._leaf_count, np.iinfo(np.int64).min, dtype=np.int64)
+        self._max_ends[self._leaf_count:self._leaf_count + len(self.table)] = self._ends
+        level = self._leaf_count // 2
+        while level >= 1:
+            self._max_ends[level:2 * level] = np.maximum(
+                self._max_ends[2 * level:4 * level:2], self._max_ends[2 * level + 1:4 * level:2])
+            level //= 2
+
+    def __len__(self):
+        return len(self.table)
+
+    def _spanning(self, time, row_end):
+        """
+        Returns the rows before row_end which end after time, in row order.
+        """
+        rows = []
+        stack = [(1, 0, self._leaf_count)]
+        while stack:
+            node, first_row, width = stack.pop()
+            if first_row >= row_end or self._max_ends[node] <= time:
+                continue
+            if width == 1:
+                rows.append(first_row)
+                continue
+            width //= 2
+            stack.append((2 * node + 1, first_row + width, width))
+            stack.append((2 * node, first_row, width))
+        return np.array(rows, dtype=np.int64)
+
+    def _on_channels(self, rows, channels):
+        """
+        Returns a boolean array which is True for the rows annotating any of channels.
+        """
+        offsets = self.table.channel_offsets
+        counts = offsets[rows + 1] - offsets[rows]
+        owners = np.repeat(np.arange(len(rows)), counts)
+        run_starts = np.cumsum(counts) - counts
+        positions = np.repeat(offsets[rows] - run_starts, counts) + np.arange(counts.sum())
+        on_channels = np.zeros(len(rows), dtype=bool)
+        on_channels[owners[np.isin(self.table.channel_indices[positions], channels)]] = True
+        return on_channels
+
+    def overlapping(self, start, end, channels=None):
+        """
+        Returns the rows of the annotations which overlap [start, end).
+
+        :param channels: If given, only annotations of at least one of these channel
+                         indices are returned.
+        """
+        end = max(end, start + 1)
+        first_starting = int(np.searchsorted(self._starts, start, side='left'))
+        row_end = int(np.searchsorted(self._starts, end, side='left'))
+        rows = np.concatenate((self._spanning(start, first_starting),
+                               np.arange(first_starting, row_end, dtype=np.int64)))
+        if channels is not None and len(rows):
+            rows = rows[self._on_channels(rows, channels)]
+        return rows
+
+    def stabbing(self, time, channels=None):
+        """
+        Returns the rows of the annotations which cover time.
+
+        :param channels: If given, only annotations of at least one of these channel
+                         indices are returned.
+        """
+        return self.overlapping(time, time + 1, channels)
+
+    def count_overlapping(self, starts, ends):
+        """
+        Returns the number of annotations overlapping each [starts[i], ends[i]),
+        on any channel, as an array.
+        """
+        starts = np.asarray(starts)
+        ends = np.maximum(np.asarray(ends), starts + 1)
+        return (np.searchsorted(self._starts, ends, side='left')
+                - np.searchsorted(self._sorted_ends, starts, side='right'))
+
+    def nearest(self, time, k=1, channels=None):
+        """
+        Returns the rows of the k annotations nearest to time, nearest first.
+        Annotations covering time are at distance 0, others at the distance from time
+        to the nearest time they cover.
+
+        :param channels: If given, only annotations of at least one of these channel
+                         indices are returned.
+        """
+        rows = self.stabbing(time, channels)[:k].tolist()
+        next_after = int(np.searchsorted(self._starts, time, side='right'))
+        next_before = int(np.searchsorted(self._sorted_ends, time, side='right')) - 1
+        while len(rows) < k and (next_after < len(self) or next_before >= 0):
+            after_distance = (self._starts[next_after] - time if next_after < len(self)
+                              else np.inf)
+            before_distance = (time - self._sorted_ends[next_before] + 1 if next_before >= 0
+                               else np.inf)
+            if after_distance <= before_distance:
+                row = next_after
+                next_after += 1
+            else:
+                row = int(self._end_order[next_before])
+                next_before -= 1
+            if channels is None or self._on_channels(np.array([row]), channels)[0]:
+                rows.append(row)
+        return np.array(rows, dtype=np.int64)
@@ -16,8 +16,10 @@
 import math as m
 import datetime
 
+from ieeg.annotation_upload import AnnotationUploader
+from ieeg.dataset import Annotation
 from ieeg.mprov_listener import MProvWriter, AnnotationActivity
-from ieeg.processing import Window
+from ieeg.processing import Window, SlidingWindowBlocks, run_blocks_in_process_pool
 
 
 class SlidingWindowAnnotator:
@@ -35,16 +37,45 @@ class SlidingWindowAnnotator:
                             which any created annotation should belong.
         mprov_connection: An optional pennprov.connection.mprov_connection.MProvConnection
                           if provenance tracking is desired.
+        max_workers: If set, windows are annotated in a pool of this many processes.
+                     annotator_function must then be picklable, so it should be a
+                     module level function rather than a lambda. The window's dataset
+                     is a copy without a session in the workers, so annotator_function
+                     cannot read data or annotations from the IEEG platform there; use
+                     annotation_index for existing annotations.
+        block_usec: The approximate length in microseconds of the blocks of samples
+                    which are read at once.
+        annotation_index: An optional ieeg.annotation_index.AnnotationIndex, for example
+                          of an existing layer. Each Window's annotations property then
+                          holds the indexed annotations which overlap it.
+        upload_batch_size: If set, annotations are uploaded in batches of this size while
+                           the dataset is processed instead of all at once at the end.
+        max_upload_workers: The maximum number of batches uploaded at once.
+        journal: An optional ieeg.annotation_upload.AnnotationJournal. Annotations it
+                 records as accepted are not uploaded again, so a failed run can be
+                 repeated with the same journal. Implies batched uploads.
     """
 
     def __init__(self,
                  window_size_usec,
                  slide_usec,
                  annotator_function,
-                 mprov_connection=None):
+                 mprov_connection=None,
+                 max_workers=None,
+                 block_usec=None,
+                 annotation_index=None,
+                 upload_batch_size=None,
+                 max_upload_workers=4,
+                 journal=None):
         self.window_size_usec = window_size_usec
         self.slide_usec = slide_usec
         self.annotator_function = annotator_function
+        self.max_workers = max_workers
+        self.block_usec = block_usec
+        self.annotation_index = annotation_index
+        self.upload_batch_size = upload_batch_size
+        self.max_upload_workers = max_upload_workers
+        self.journal = journal
         self.mprov_writer = MProvWriter(
             mprov_connection) if mprov_connection else None
 
@@ -80,26 +111,99 @@ class SlidingWindowAnnotator:
                 dataset, input_channel_labels)
 
         annotations = []
+        uploader = None
+        if self.upload_batch_size or self.journal is not None:
+            uploader = AnnotationUploader(dataset, batch_size=self.upload_batch_size or 1000,
+                                          max_workers=self.max_upload_workers,
+                                          journal=self.journal)
+        window_count = int(m.ceil(duration_usec / self.slide_usec))
+        blocks = SlidingWindowBlocks(dataset, input_channel_indices, start_time_usec,
+                                     self.window_size_usec, self.slide_usec, window_count,
+                                     self.block_usec)
+        block_args = (self.annotator_function, annotation_layer, dataset, input_channel_labels,
+                      start_time_usec, self.slide_usec, self.window_size_usec,
+                      bool(self.max_workers), self.annotation_index)
+        if self.max_workers:
+            block_results = run_blocks_in_process_pool(
+                blocks, _annotate_block, block_args, self.max_workers)
+        else:
+            block_results = ((first_window, buffer, window_rows, window_end_rows,
+                              _annotate_block(block_args, first_window,
+                                              [buffer[window_row:window_end_row]
+                                               for window_row, window_end_row
+                                               in zip(window_rows, window_end_rows)]))
+                             for first_window, buffer, window_rows, window_end_rows
+                             in blocks.iter_buffers())
 
-        for window_index in range(0, int(m.ceil(duration_usec / self.slide_usec))):
-            window_start_usec = start_time_usec + window_index * self.slide_usec
-            data_block = dataset.get_data(window_start_usec,
-                                          self.window_size_usec,
-                                          input_channel_indices)
-            window = Window(dataset, input_channel_labels, data_block,
-                            window_index, window_start_usec, self.window_size_usec)
-            activity_start_time = datetime.datetime.now(datetime.timezone.utc)
-            new_annotation = self.annotator_function(
-                window, annotation_layer)
-            activity_end_time = datetime.datetime.now(datetime.timezone.utc)
-            if new_annotation:
-                annotations.append(new_annotation)
-            if self.mprov_writer:
-                activity = AnnotationActivity(
-                    self.annotator_function.__name__, annotation_layer, window_index,
-                    activity_start_time, activity_end_time)
-                self.mprov_writer.write_widow_prov(
-                    window, activity, new_annotation)
-
-        dataset.add_annotations(annotations)
+        try:
+            for first_window, buffer, window_rows, window_end_rows, results in block_results:
+                for offset, (new_annotation, activity_start_time, activity_end_time) \
+                        in enumerate(results):
+                    window_index = first_window + offset
+                    if isinstance(new_annotation, tuple):
+                        new_annotation = _fields_to_annotation(dataset, new_annotation)
+                    if new_annotation:
+                        annotations.append(new_annotation)
+                        if uploader:
+                            uploader.add([new_annotation])
+                    if self.mprov_writer:
+                        window = Window(dataset, input_channel_labels,
+                                        buffer[window_rows[offset]:window_end_rows[offset]],
+                                        window_index, blocks.window_starts_usec[window_index],
+                                        self.window_size_usec, self.annotation_index)
+                        activity = AnnotationActivity(
+                            self.annotator_function.__name__, annotation_layer, window_index,
+                            activity_start_time, activity_end_time)
+                        self.mprov_writer.write_widow_prov(
+                            window, activity, new_annotation)
+            if uploader:
+                uploader.flush()
+        finally:
+            if uploader:
+                uploader.close()
+
+        if not uploader:
+            dataset.add_annotations(annotations)
         return annotations
+
+
+def _annotate_block(block_args, first_window, windows):
+    """
+    Runs the annotator function over a block of windows.
+
+    Returns one (annotation, activity_start_time, activity_end_time) tuple per window,
+    where annotation is None if no annotation was created. In worker processes
+    annotations are returned as a tuple of fields so that they can be sent back
+    without a copy of the Dataset.
+    """
+    (annotator_function, annotation_layer, dataset, input_channel_labels,
+     start_time_usec, slide_usec, window_size_usec, in_worker,
+     annotation_index) = block_args
+    results = []
+    for offset, data_block in enumerate(windows):
+        window_index = first_window + offset
+        data_block.setflags(write=False)
+        window = Window(dataset, input_channel_labels, data_block,
+                        window_index, start_time_usec + window_index * slide_usec,
+                        window_size_usec, annotation_index)
+        activity_start_time = datetime.datetime.now(datetime.timezone.utc)
+        new_annotation = annotator_function(window, annotation_layer)
+        activity_end_time = datetime.datetime.now(datetime.timezone.utc)
+        if new_annotation and in_worker:
+            new_annotation = _annotation_to_fields(new_annotation)
+        results.append((new_annotation, activity_start_time, activity_end_time))
+    return results
+
+
+def _annotation_to_fields(annotation):
+    return (annotation.annotator, annotation.type, annotation.description, annotation.layer,
+            annotation.start_time_offset_usec, annotation.end_time_offset_usec,
+            annotation.portal_id, [detail.portal_id for detail in annotation.annotated])
+
+
+def _fields_to_annotation(dataset, fields):
+    (annotator, _type, description, layer, start_time_offset_usec, end_time_offset_usec,
+     portal_id, annotated_portal_ids) = fields
+    return Annotation(dataset, annotator, _type, description, layer,
+                      start_time_offset_usec, end_time_offset_usec,
+                      portal_id=portal_id, annotated_portal_ids=annotated_portal_ids)
@@ -0,0 +1,353 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+from ieeg.annotation_upload import annotation_fields
+from ieeg.dataset import Annotation, AnnotationTable, Dataset
+
+_SCHEMA_VERSION = 1
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY,
+    rev_id TEXT UNIQUE,
+    layer TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    type TEXT NOT NULL,
+    description TEXT NOT NULL,
+    start_usec INTEGER NOT NULL,
+    end_usec INTEGER NOT NULL,
+    channels TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS annotations_layer_start ON annotations (layer, start_usec);
+CREATE TABLE IF NOT EXISTS annotation_channels (
+    annotation_id INTEGER NOT NULL REFERENCES annotations (id) ON DELETE CASCADE,
+    channel TEXT NOT NULL,
+    PRIMARY KEY (channel, annotation_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS annotation_channels_annotation
+    ON annotation_channels (annotation_id);
+CREATE TABLE IF NOT EXISTS layers (
+    name TEXT PRIMARY KEY,
+    synced_count INTEGER,
+    last_start_usec INTEGER,
+    max_length_usec INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS snapshot (
+    snapshot_id TEXT NOT NULL
+);
+'''
+
+
+class AnnotationStore:
+    """
+    A local SQLite mirror of the annotation layers of a Dataset, for annotation queries
+    which make no requests to the IEEG platform.
+
+    Each snapshot has its own file in directory, which can be shared by many programs.
+    sync copies the layers from the IEEG platform, using the layer counts it requests
+    to find the layers which changed. A layer whose count
+    grew is synced incrementally by reading only the annotations starting at or after
+    the last one already copied. Annotations are identified by their revId, so ones read
+    twice are stored once. If the counts still differ afterwards, because annotations
+    were added earlier in the layer or removed, the layer is copied again in full.
+
+    Annotations added with add_annotations are stored locally and included in queries,
+    and are uploaded to the IEEG platform by push.
+
+        with AnnotationStore(dataset, '/data/ieeg-annotations') as store:
+            store.sync(['Seizures'])
+            seizures = store.get_annotations('Seizures', start_usec, end_usec, channels=[0, 3])
+
+    Attributes:
+        dataset: The Dataset whose annotations are stored.
+        path: The SQLite file of the dataset's snapshot.
+    """
+
+    def __init__(self, dataset, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.dataset = dataset
+        self.path = os.path.join(
+            directory,
+            'annotations-' + hashlib.sha1(dataset.snap_id.encode('utf-8')).hexdigest() + '.sqlite')
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        with self._connection:
+            if self._connection.execute('PRAGMA user_version').fetchone()[0] != _SCHEMA_VERSION:
+                self._connection.executescript(
+                    'DROP TABLE IF EXISTS annotation_channels; DROP TABLE IF EXISTS annotations;'
+                    'DROP TABLE IF EXISTS layers; DROP TABLE IF EXISTS snapshot;')
+                self._connection.executescript(_SCHEMA)
+                self._connection.execute('PRAGMA user_version = ' + str(_SCHEMA_VERSION))
+                self._connection.execute('INSERT INTO snapshot VALUES (?)', (dataset.snap_id,))
+        stored_id = self._connection.execute('SELECT snapshot_id FROM snapshot').fetchone()
+        if stored_id is None or stored_id[0] != dataset.snap_id:
+            self._connection.close()
+            raise ValueError(self.path + ' does not belong to snapshot ' + dataset.snap_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the SQLite file.
+        """
+        with self._lock:
+            self._connection.close()
+
+    def sync(self, layers=None, page_size=1000, full=False):
+        """
+        Copies the given annotation layers, or all layers, from the IEEG platform.
+        Layers which no longer exist there are removed. Locally added annotations
+        which have not been pushed are kept.
+
+        :param layers: The name, or names, of the layers to sync. All layers by default.
+        :param page_size: The number of annotations in each request
+        :param full: If True, the layers are copied in full even if their counts
+                     have not changed.
+        :returns: a dict mapping each synced layer name to the number of annotations read
+        """
+        if page_size <= 0:
+            raise ValueError('page_size must be positive')
+        if isinstance(layers, str):
+            layers = [layers]
+        # Not Dataset.get_annotation_layers, whose counts may come from the metadata cache.
+        remote_counts = Dataset._parse_annotation_layers(
+            self.dataset.session.api.get_annotation_layers(self.dataset).json())
+        with self._lock:
+            synced = dict(self._connection.execute(
+                'SELECT name, synced_count FROM layers WHERE synced_count IS NOT NULL'))
+        names = list(remote_counts) + [name for name in synced if name not in remote_counts]
+        if layers is not None:
+            names = [name for name in names if name in layers]
+
+        read_counts = {}
+        for name in names:
+            remote_count = remote_counts.get(name, 0)
+            if not full and synced.get(name) == remote_count:
+                continue
+            read_count = 0
+            if not full and name in synced and remote_count > synced[name]:
+                read_count = self._copy_layer(name, True, remote_count, page_size)
+            if full or name not in synced or self._synced_count(name) != remote_count:
+                read_count += self._copy_layer(name, False, remote_count, page_size)
+            read_counts[name] = read_count
+        return read_counts
+
+    def _synced_count(self, layer):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM annotations WHERE layer = ? AND rev_id IS NOT NULL',
+                (layer,)).fetchone()[0]
+
+    def _copy_layer(self, layer, incremental, remote_count, page_size):
+        """
+        Reads the annotations of layer from the IEEG platform into the store, starting
+        at the last copied start time if incremental, and otherwise replacing the
+        copied annotations of layer. Returns the number of annotations read.
+        """
+        start_offset_usecs = None
+        if incremental:
+            with self._lock:
+                start_offset_usecs = self._connection.execute(
+                    'SELECT last_start_usec FROM layers WHERE name = ?', (layer,)).fetchone()[0]
+        else:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    'DELETE FROM annotations WHERE layer = ? AND rev_id IS NOT NULL', (layer,))
+                self._connection.execute(
+                    'UPDATE layers SET synced_count = NULL, last_start_usec = NULL WHERE name = ?',
+                    (layer,))
+
+        read_count = 0
+        while remote_count:
+            response = self.dataset.session.api.get_annotations(
+                self.dataset, layer, start_offset_usecs=start_offset_usecs,
+                first_result=read_count, max_results=page_size)
+            json_annotations = Dataset._json_annotation_list(response.json())
+            with self._lock, self._connection:
+                self._insert(
+                    [(a['annotator'], a['type'], a.get('description', ''), a['layer'],
+                      a['startTimeUutc'], a['endTimeUutc'],
+                      a['timeseriesRevIds']['timeseriesRevId'], a['revId'])
+                     for a in json_annotations])
+            read_count += len(json_annotations)
+            if len(json_annotations) < page_size:
+                break
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR IGNORE INTO layers (name) VALUES (?)', (layer,))
+            self._connection.execute(
+                'UPDATE layers SET synced_count = '
+                '(SELECT COUNT(*) FROM annotations WHERE layer = ?1 AND rev_id IS NOT NULL), '
+                'last_start_usec = '
+                '(SELECT MAX(start_usec) FROM annotations WHERE layer = ?1 AND rev_id IS NOT NULL) '
+                'WHERE name = ?1', (layer,))
+        return read_count
+
+    def _insert(self, rows):
+        """
+        Inserts (annotator, type, description, layer, start, end, channel revisionIds,
+        revId) rows, ignoring those with a revId already stored.
+        Must be called holding _lock in a transaction.
+        """
+        max_lengths = {}
+        for annotator, _type, description, layer, start, end, rev_ids, rev_id in rows:
+            rev_ids = [rev_ids] if isinstance(rev_ids, str) else list(rev_ids)
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO annotations (rev_id, layer, annotator, type, description, '
+                'start_usec, end_usec, channels) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (rev_id, layer, annotator, _type, description, int(start), int(end),
+                 json.dumps(rev_ids)))
+            if not cursor.rowcount:
+                continue
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO annotation_channels VALUES (?, ?)',
+                [(cursor.lastrowid, channel) for channel in rev_ids])
+            max_lengths[layer] = max(max_lengths.get(layer, 0), int(end) - int(start))
+        for layer, max_length in max_lengths.items():
+            self._connection.execute('INSERT OR IGNORE INTO layers (name) VALUES (?)', (layer,))
+            self._connection.execute(
+                'UPDATE layers SET max_length_usec = MAX(max_length_usec, ?) WHERE name = ?',
+                (max_length, layer))
+
+    def get_annotation_layers(self):
+        """
+        Returns a dictionary mapping the stored layer names to annotation counts,
+        including annotations which have not been pushed.
+        """
+        with self._lock:
+            return dict(self._connection.execute(
+                'SELECT layer, COUNT(*) FROM annotations GROUP BY layer'))
+
+    def get_annotations(self, layer_name, start_usec=None, end_usec=None, channels=None,
+                        as_table=False):
+        """
+        Returns the stored annotations in the given layer which overlap
+        [start_usec, end_usec), ordered by start time. An annotation covers
+        [start, end), or only its start if it has no length.
+
+        :param layer_name: The annotation layer to query
+        :param start_usec: If specified, annotations ending at or before start_usec are left out.
+        :param end_usec: If specified, annotations starting at or after end_usec are left out.
+        :param channels: If specified, only annotations of at least one of these channel
+                         indices are returned.
+        :param as_table: If True, an AnnotationTable is returned instead of a list.
+        """
+        query = ('SELECT rev_id, annotator, type, description, layer, start_usec, end_usec, '
+                 'channels FROM annotations WHERE layer = ?')
+        parameters = [layer_name]
+        with self._lock:
+            if start_usec is not None:
+                # Only annotations starting within the layer's longest annotation
+                # of start_usec can reach it, so the start index bounds the scan.
+                max_length = self._connection.execute(
+                    'SELECT max_length_usec FROM layers WHERE name = ?',
+                    (layer_name,)).fetchone()
+                query += ' AND start_usec >= ? AND MAX(end_usec, start_usec + 1) > ?'
+                parameters += [int(start_usec) - (max_length[0] if max_length else 0) - 1,
+                               int(start_usec)]
+            if end_usec is not None:
+                query += ' AND start_usec < ?'
+                parameters.append(max(int(end_usec),
+                                      int(start_usec) + 1 if start_usec is not None else 0))
+            if channels is not None:
+                rev_ids = [self.dataset.revision_ids[channel] for channel in channels]
+                query += (' AND id IN (SELECT annotation_id FROM annotation_channels '
+                          'WHERE channel IN (' + ', '.join('?' * len(rev_ids)) + '))')
+                parameters += rev_ids
+            query += ' ORDER BY start_usec, id'
+            rows = self._connection.execute(query, parameters).fetchall()
+        return self._table(rows) if as_table else self._annotations(rows)
+
+    def _annotations(self, rows):
+        return [Annotation(self.dataset, annotator, _type, description, layer, start, end,
+                           portal_id=rev_id, annotated_portal_ids=json.loads(channels))
+                for rev_id, annotator, _type, description, layer, start, end, channels
+                in (row[:8] for row in rows)]
+
+    def _table(self, rows):
+        index_by_portal_id = self.dataset.channel_table.index_by_portal_id
+        channels_by_json = {}
+        channel_lists = []
+        for row in rows:
+            channels = channels_by_json.get(row[7])
+            if channels is None:
+                channels = [index_by_portal_id[rev_id] for rev_id in json.loads(row[7])]
+                channels_by_json[row[7]] = channels
+            channel_lists.append(channels)
+        channel_offsets, channel_indices = AnnotationTable._channel_arrays(channel_lists)
+        columns = [list(column) for column in zip(*rows)] if rows else [[]] * 8
+        return AnnotationTable(self.dataset, np.array(columns[5], dtype=np.int64),
+                               np.array(columns[6], dtype=np.int64), columns[2], columns[4],
+                               columns[1], columns[3], channel_offsets, channel_indices,
+                               np.array(columns[0], dtype=object))
+
+    def add_annotations(self, annotations):
+        """
+        Stores new Annotations, or an AnnotationTable, locally. They are included in
+        queries and uploaded to the IEEG platform by push.
+        """
+        with self._lock, self._connection:
+            self._insert([fields + (None,) for fields in annotation_fields(annotations)])
+
+    def get_local_annotations(self, as_table=False):
+        """
+        Returns the annotations added with add_annotations which have not been pushed.
+        """
+        rows = self._local_rows()
+        return self._table(rows) if as_table else self._annotations(rows)
+
+    def _local_rows(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT rev_id, annotator, type, description, layer, start_usec, end_usec, '
+                'channels, id FROM annotations WHERE rev_id IS NULL ORDER BY id').fetchall()
+
+    def push(self, batch_size=None, max_workers=4, journal=None):
+        """
+        Uploads the annotations added with add_annotations with Dataset.add_annotations,
+        then removes them from the store and syncs their layers, so that the store
+        holds the uploaded copies. If the upload fails they are kept, and with a
+        journal, push can be repeated without adding any annotation twice.
+
+        :param batch_size: The maximum number of annotations in each request
+        :param max_workers: The maximum number of requests in flight
+        :param journal: An optional ieeg.annotation_upload.AnnotationJournal
+        :returns: the number of annotations uploaded
+        """
+        rows = self._local_rows()
+        if not rows:
+            return 0
+        local = self._table(rows)
+        self.dataset.add_annotations(local, batch_size=batch_size, max_workers=max_workers,
+                                     journal=journal)
+        with self._lock, self._connection:
+            # Annotations added during the upload have larger ids and are kept.
+            self._connection.execute('DELETE FROM annotations WHERE rev_id IS NULL AND id <= ?',
+                                     (rows[-1][8],))
+        self.sync(set(local.layers))
+        return len(local)
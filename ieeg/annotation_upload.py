@@ -0,0 +1,258 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+
+def annotation_fields(annotations):
+    """
+    Returns the (annotator, type, description, layer, start, end, channel revisionIds)
+    of each of the given Annotations, or of each row of an ieeg.dataset.AnnotationTable.
+    """
+    if hasattr(annotations, 'to_json'):
+        json_annotations, _ = annotations.to_json()
+        return [(a['annotator'], a['type'], a['description'], a['layer'], a['startTimeUutc'],
+                 a['endTimeUutc'], a['timeseriesRevIds']['timeseriesRevId'])
+                for a in json_annotations]
+    return [(a.annotator, a.type, a.description, a.layer, a.start_time_offset_usec,
+             a.end_time_offset_usec, [detail.portal_id for detail in a.annotated])
+            for a in annotations]
+
+
+def annotation_keys(dataset, annotations):
+    """
+    Returns a key identifying the content of each of the given Annotations, or of
+    each row of an ieeg.dataset.AnnotationTable, in dataset.
+    """
+    return [hashlib.blake2b(json.dumps((dataset.snap_id, annotator, _type, description, layer,
+                                        int(start), int(end), sorted(rev_ids))).encode('utf-8'),
+                            digest_size=12).hexdigest()
+            for annotator, _type, description, layer, start, end, rev_ids
+            in annotation_fields(annotations)]
+
+
+def occurrence_keys(dataset, annotations, occurrences):
+    """
+    Returns the journal key of each of the given annotations in dataset: its content key
+    and the number of identical annotations before it, counted in the
+    collections.Counter occurrences.
+    """
+    keys = []
+    for key in annotation_keys(dataset, annotations):
+        keys.append(key + '-' + str(occurrences[key]))
+        occurrences[key] += 1
+    return keys
+
+
+class AnnotationJournal:
+    """
+    A local file recording the annotations accepted by the IEEG platform, so that a
+    failed or interrupted upload can be repeated without adding annotations twice.
+
+    Each accepted batch is appended to the file as a line of annotation keys, and
+    written to disk before the next batch is recorded. AnnotationUploader keys each
+    annotation by its content and by the number of identical annotations before it
+    in the run, so a run repeated with the same annotations skips exactly those
+    already accepted, including duplicates.
+
+        journal = AnnotationJournal('spikes.journal')
+        dataset.add_annotations(annotations, batch_size=1000, journal=journal)
+
+    Attributes:
+        path: The journal file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._keys = set()
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        self._keys.update(json.loads(line))
+                    except ValueError:
+                        # The last line may be incomplete if a run was killed.
+                        pass
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def record(self, keys):
+        """
+        Records that the annotations with the given keys were accepted.
+        """
+        line = json.dumps(list(keys)) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as journal_file:
+                journal_file.write(line)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._keys.update(keys)
+
+
+class AnnotationUploader:
+    """
+    Adds annotations to a Dataset in batches, uploading up to max_workers batches at once.
+
+    Annotations passed to add are uploaded as soon as a batch is full, and flush
+    uploads the rest and waits for all batches. If an upload fails, no further
+    batches are started and the error is raised by add or flush once the batches in
+    flight are done. With a journal, annotations which it records as accepted are
+    skipped, so the same annotations can simply be uploaded again. The n-th of several
+    identical annotations added to an uploader is skipped only if the n-th was accepted.
+
+        with AnnotationUploader(dataset, batch_size=500, journal=journal) as uploader:
+            for annotation in detect(dataset):
+                uploader.add([annotation])
+
+    Attributes:
+        dataset: The ieeg.dataset.Dataset to which annotations are added.
+        batch_size: The maximum number of annotations in each request.
+        max_workers: The maximum number of requests in flight.
+        journal: An optional AnnotationJournal.
+        uploaded_count: The number of annotations accepted so far.
+        skipped_count: The number of annotations skipped because of the journal.
+    """
+
+    def __init__(self, dataset, batch_size=1000, max_workers=4, journal=None):
+        if batch_size <= 0 or max_workers <= 0:
+            raise ValueError('batch_size and max_workers must be positive')
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.journal = journal
+        self.uploaded_count = 0
+        self.skipped_count = 0
+        self._buffer = []
+        self._buffer_keys = []
+        self._occurrences = collections.Counter()
+        self._pending = collections.deque()
+        self._error = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='ieeg-annotations')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Waits for the uploads in flight without starting new ones and releases the
+        upload threads. Use flush first to upload the queued annotations.
+        """
+        self._wait(0)
+        self._executor.shutdown()
+
+    def add(self, annotations):
+        """
+        Queues the given Annotations, or AnnotationTable, for upload.
+        """
+        self._raise_error()
+        keys = self._journal_keys(annotations) if self.journal is not None else None
+        if hasattr(annotations, 'to_json'):
+            # Annotations queued by earlier calls are uploaded first, in add order.
+            if self._buffer:
+                self._submit_buffer()
+            if keys is not None:
+                new = np.array([key not in self.journal for key in keys], dtype=bool)
+                self.skipped_count += len(keys) - int(new.sum())
+                annotations = annotations[new]
+                keys = [key for key, is_new in zip(keys, new) if is_new]
+            for first in range(0, len(annotations), self.batch_size):
+                self._submit(annotations[first:first + self.batch_size],
+                             keys[first:first + self.batch_size] if keys else None)
+            return
+
+        for position, annotation in enumerate(annotations):
+            if keys is not None:
+                if keys[position] in self.journal:
+                    self.skipped_count += 1
+                    continue
+                self._buffer_keys.append(keys[position])
+            self._buffer.append(annotation)
+            if len(self._buffer) == self.batch_size:
+                self._submit_buffer()
+
+    def _journal_keys(self, annotations):
+        """
+        Returns the journal key of each annotation: its content key and the number of
+        identical annotations added before it.
+        """
+        return occurrence_keys(self.dataset, annotations, self._occurrences)
+
+    def flush(self):
+        """
+        Uploads the queued annotations and waits for all uploads to finish.
+        """
+        self._raise_error()
+        if self._buffer:
+            self._submit_buffer()
+        self._wait(0)
+        self._raise_error()
+
+    def _submit_buffer(self):
+        batch, keys = self._buffer, self._buffer_keys
+        self._buffer = []
+        self._buffer_keys = []
+        self._submit(batch, keys if self.journal is not None else None)
+
+    def _submit(self, batch, keys):
+        self._wait(self.max_workers - 1)
+        self._raise_error()
+        self._pending.append((batch, self._executor.submit(self._upload, batch, keys)))
+
+    def _upload(self, batch, keys):
+        self.dataset.session.api.add_annotations(self.dataset, batch)
+        if keys is not None:
+            self.journal.record(keys)
+
+    def _wait(self, max_pending):
+        """
+        Waits until at most max_pending batches are in flight.
+        """
+        while len(self._pending) > max_pending:
+            batch, future = self._pending.popleft()
+            try:
+                future.result()
+            except Exception as error:
+                if self._error is None:
+                    self._error = error
+                continue
+            self.uploaded_count += len(batch)
+            self.dataset._annotations_added(batch)
+
+    def _raise_error(self):
+        if self._error is not None:
+            # Let the batches in flight finish, so that the journal is complete.
+            self._wait(0)
+            raise self._error
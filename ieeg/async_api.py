@@ -0,0 +1,579 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import asyncio
+import collections
+import json
+import numpy as np
+import requests
+from ieeg.annotation_index import AnnotationIndex
+from ieeg.annotation_upload import occurrence_keys
+from ieeg.auth import Session
+from ieeg.dataset import CURRENT_MONTAGE, AnnotationTable, ChannelTable, Dataset
+from ieeg.fetch import decode_response
+from ieeg.ieeg_api import IeegApi, IeegConnectionError, IeegServiceError
+from ieeg.ieeg_auth import IeegAuth
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+
+class AsyncResponse:
+    """
+    The parts of an HTTP response used by the IEEG client.
+
+    Attributes:
+        status_code: The HTTP status code.
+        headers: A case-insensitive mapping of response headers.
+        content: The response body as bytes.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        """
+        The response body decoded as UTF-8.
+        """
+        return self.content.decode('utf-8')
+
+    def iter_content(self, chunk_size=1):
+        """
+        Iterates over the response body in chunks of chunk_size bytes.
+        """
+        body = memoryview(self.content)
+        for chunk_start in range(0, len(body), chunk_size):
+            yield body[chunk_start:chunk_start + chunk_size]
+
+    def json(self):
+        """
+        The response body parsed as JSON.
+        """
+        return json.loads(self.text)
+
+
+class AsyncIeegApi:
+    """
+    The IEEG REST API for asyncio. Requires aiohttp.
+
+    Requests are signed with IeegAuth and error responses raise IeegServiceError or
+    IeegConnectionError just like IeegApi. At most max_concurrency requests are in
+    flight at a time. A request which takes longer than timeout_sec seconds, if given,
+    raises IeegConnectionError.
+    """
+
+    def __init__(self, username, password,
+                 use_https=True, host='www.ieeg.org', port=None, verify_ssl=True,
+                 max_concurrency=8, timeout_sec=None):
+        if aiohttp is None:
+            raise ImportError('AsyncIeegApi requires aiohttp')
+        self.auth = IeegAuth(username, password)
+        self.verify_ssl = verify_ssl
+        self.scheme = 'https' if use_https else 'http'
+        self.host = host
+        self.port = port
+        authority = host + ':' + str(port) if port else host
+        self.base_url = self.scheme + '://' + authority + '/services'
+        self.max_concurrency = max_concurrency
+        self.timeout_sec = timeout_sec
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._http = None
+
+    async def close(self):
+        """
+        Closes HTTP resources
+        """
+        if self._http:
+            await self._http.close()
+            self._http = None
+
+    async def _request(self, method, url, headers, params=None, data=None, json_body=None):
+        """
+        Signs and sends a request, returning an AsyncResponse.
+        """
+        # Let requests build and sign the request exactly as IeegApi would.
+        prepared = requests.Request(method, url, headers=headers, params=params,
+                                    data=data, json=json_body).prepare()
+        self.auth(prepared)
+        send_headers = {key: value.decode('utf-8') if isinstance(value, bytes) else value
+                        for key, value in prepared.headers.items()
+                        if key.lower() != 'content-length'}
+        if self._http is None:
+            self._http = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout_sec)
+                if self.timeout_sec else aiohttp.client.DEFAULT_TIMEOUT)
+        async with self._semaphore:
+            try:
+                async with self._http.request(method, yarl.URL(prepared.url, encoded=True),
+                                              data=prepared.body, headers=send_headers,
+                                              ssl=None if self.verify_ssl else False) as response:
+                    content = await response.read()
+                    result = AsyncResponse(response.status, response.headers, content)
+            except aiohttp.ClientError as error:
+                raise IeegConnectionError(str(error))
+            except asyncio.TimeoutError:
+                raise IeegConnectionError('Request timed out: ' + method + ' ' + url)
+        IeegApi.raise_ieeg_exception(result)
+        return result
+
+    async def get_dataset_id_by_name(self, dataset_name):
+        """
+        Returns a Response with a dataset's id given its name
+        """
+        url = self.base_url + IeegApi._get_id_by_dataset_name_path + dataset_name
+        return await self._request('GET', url, IeegApi._accept_json)
+
+    async def get_time_series_details(self, dataset_id):
+        """
+        Returns Response with time series details in XML format
+        """
+        url = self.base_url + IeegApi._get_time_series_details_path + dataset_id
+        return await self._request('GET', url, IeegApi._accept_xml)
+
+    async def get_annotation_layers(self, dataset):
+        """
+        Returns Response with Annotation layers and counts in JSON format.
+        """
+        url_str = self.base_url + IeegApi._get_counts_by_layer_path + dataset.snap_id
+        return await self._request('GET', url_str, IeegApi._accept_json)
+
+    async def get_annotations(self, dataset, layer_name,
+                              start_offset_usecs=None, first_result=None, max_results=None):
+        """
+        Returns a Response containing a JSON formatted list of annotations in the given
+        layer ordered by start time. See IeegApi.get_annotations.
+        """
+        url_str = self.base_url + IeegApi._get_annotations_path + \
+            dataset.snap_id + '/' + layer_name
+        params = {'startOffsetUsec': start_offset_usecs,
+                  'firstResult': first_result, 'maxResults': max_results}
+        return await self._request('GET', url_str, IeegApi._accept_json, params=params)
+
+    async def derive_dataset(self, dataset, derived_dataset_name, tool_name):
+        """
+        Returns a Response containing the portal id of a new Dataset.
+        See IeegApi.derive_dataset.
+        """
+        url_str = self.base_url + IeegApi._derive_dataset_path + dataset.snap_id
+        params = {'friendlyName': derived_dataset_name,
+                  'toolName': tool_name}
+        return await self._request('POST', url_str, IeegApi._accept_json, params=params)
+
+    async def get_data(self, dataset, start, duration, channels):
+        """
+        Returns data from the IEEG platform
+        :param start: Start time (usec)
+        :param duration: Number of usec to request samples from
+        :param channels: Integer indices of the channels we want
+        :return: a Response with binary content.
+        """
+        url_str, params, data = IeegApi._get_data_request(
+            self.base_url, dataset, start, duration, channels)
+        return await self._request('POST', url_str, IeegApi._send_xml,
+                                   params=params, data=data)
+
+    async def get_montages(self, dataset_id):
+        """
+        Returns the montages for the given dataset.
+        """
+        url_str = self.base_url + IeegApi._get_montages_path % dataset_id
+        return await self._request('GET', url_str, IeegApi._accept_json)
+
+    async def add_annotations(self, dataset, annotations):
+        """
+        Adds annotations to the given snapshot.
+        :returns: a Response with String body (the datset id)
+        """
+        request_body = IeegApi._add_annotations_body(dataset, annotations)
+        url_str = self.base_url + IeegApi._add_annotations_path + dataset.snap_id
+        return await self._request('POST', url_str, IeegApi._send_accept_json,
+                                   json_body=request_body)
+
+    async def move_annotation_layer(self, dataset, from_layer, to_layer):
+        """
+        Moves annotations in the given dataset from from_layer to to_layer.
+
+        :returns: a Response with JSON body. Has number of moved annotations.
+        """
+        url_str = (self.base_url + '/timeseries/datasets/' + dataset.snap_id
+                   + '/tsAnnotations/' + from_layer)
+        return await self._request('POST', url_str, IeegApi._accept_json,
+                                   params={'toLayerName': to_layer})
+
+    async def delete_annotation_layer(self, dataset, layer):
+        """
+        Deletes annotations in layer from the given dataset.
+
+        :returns: a Response with JSON body. Has number of delelted annotations.
+        """
+        url_str = self.base_url + IeegApi._delete_annotation_layer_path + \
+            dataset.snap_id + '/' + layer
+        return await self._request('POST', url_str, IeegApi._accept_json)
+
+
+class AsyncSession:
+    """
+    Class representing an asyncio Session on the platform. Uses the same host
+    settings as ieeg.auth.Session. AsyncSession is an async context manager:
+
+       async with AsyncSession(username, password) as session:
+           dataset = await session.open_dataset(name)
+           data = await dataset.get_data(0, 1000000, [0, 1])
+    """
+
+    def __init__(self, name, pwd, verify_ssl=True, max_concurrency=8, timeout_sec=None):
+        self.username = name
+        use_https = Session.method.startswith('https')
+        port = Session.port[1:] if Session.port.startswith(
+            ':') else Session.port
+        self.api = AsyncIeegApi(self.username, pwd,
+                                use_https=use_https, host=Session.host, port=port,
+                                verify_ssl=verify_ssl, max_concurrency=max_concurrency,
+                                timeout_sec=timeout_sec)
+        self.mprov_listener = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes AsyncSession resources.
+        """
+        await self.api.close()
+
+    async def open_dataset(self, name):
+        """
+        Return an AsyncDataset object
+        """
+        get_id_response = await self.api.get_dataset_id_by_name(name)
+        snapshot_id = get_id_response.text
+
+        time_series_details_response, montages_response = await asyncio.gather(
+            self.api.get_time_series_details(snapshot_id),
+            self.api.get_montages(snapshot_id))
+        json_montages = Session._parse_montages(montages_response.json())
+        return AsyncDataset(name, ChannelTable.parse(time_series_details_response.content),
+                            snapshot_id, self, json_montages=json_montages)
+
+
+class AsyncDataset(Dataset):
+    """
+    A Dataset opened by an AsyncSession. The methods which contact the
+    IEEG platform are coroutines, and iter_chunks and iter_annotations are
+    asynchronous generators. Data is read with a single request per sample rate,
+    or per window cache block.
+    """
+
+    async def derive_dataset(self, derived_dataset_name, tool_name):
+        """
+        Returns a new AsyncDataset which is a copy of this dataset and which has the given name.
+        """
+        await self.session.api.derive_dataset(self, derived_dataset_name, tool_name)
+        return await self.session.open_dataset(derived_dataset_name)
+
+    async def _get_unmontaged_data(self, start, duration, raw_channels,
+                                   dtype=np.float64, out=None, sample_count=None):
+        if not Dataset._is_raw(dtype):
+            dtype = np.dtype(dtype)
+        groups = self._rate_groups(raw_channels)
+        if len(groups) > 1:
+            if Dataset._is_raw(dtype):
+                raise ValueError("dtype 'raw' requires channels with the same sample rate")
+            group_data = await self._read_rate_groups(start, duration, raw_channels, groups,
+                                                      dtype)
+            return self._resample_rate_groups(start, raw_channels, groups, group_data,
+                                              dtype, out, sample_count)
+        requested = sorted(set(raw_channels))
+        try:
+            response = await self.session.api.get_data(self, start, duration, requested)
+        except IeegServiceError:
+            self._data_request_rejected()
+            raise
+        int_matrix, conv_f = decode_response(response, len(requested))
+        self._learn_gaps(start, requested, int_matrix)
+        position_by_channel = {channel: i for i, channel in enumerate(requested)}
+        return Dataset._convert(int_matrix, conv_f,
+                                [position_by_channel[channel] for channel in raw_channels],
+                                dtype, out, owned=True, sample_count=sample_count)
+
+    async def _read_rate_groups(self, start, duration, raw_channels, groups, dtype):
+        return await asyncio.gather(*[
+            self._get_unmontaged_data(start, duration,
+                                      [raw_channels[position] for position in positions],
+                                      dtype)
+            for _, positions in groups])
+
+    async def _get_montaged_data(self, montage, start, duration, channels,
+                                 dtype=np.float64, out=None, sample_count=None):
+        if not montage:
+            return await self._get_unmontaged_data(start, duration, channels, dtype, out,
+                                                   sample_count)
+        raw_channels = montage.get_raw_channels(channels)
+        raw_data = await self._get_unmontaged_data(start, duration, raw_channels, dtype,
+                                                   sample_count=sample_count)
+        return montage.apply(raw_data, channels, out)
+
+    async def _read(self, start, duration, channels, dtype, out, montage, sample_count=None):
+        dtype = Dataset._read_dtype(dtype, out, montage)
+        sample_grid = self._window_cache_grid(channels, dtype, montage)
+        if sample_grid:
+            sample_rate, grid_offset, end_offset = sample_grid
+            data = await self.window_cache.get_async(
+                (montage, tuple(channels)), start, duration, sample_rate, grid_offset,
+                lambda block_start, block_duration: self._get_montaged_data(
+                    montage, block_start, block_duration, channels), end_offset)
+            return Dataset._window_cache_result(data, dtype, out, sample_count)
+        return await self._get_montaged_data(montage, start, duration, channels, dtype, out,
+                                             sample_count)
+
+    async def get_data(self, start, duration, channels, dtype=np.float64, out=None,
+                       montage=CURRENT_MONTAGE):
+        """
+        Returns data from the IEEG platform using the current montage if any.
+        See Dataset.get_data.
+        """
+        return await self._read(start, duration, channels, dtype, out,
+                                self._resolve_montage(montage))
+
+    async def get_samples(self, first_sample, sample_count, channels, dtype=np.float64,
+                          out=None, montage=CURRENT_MONTAGE):
+        """
+        Returns exactly sample_count samples starting at sample index first_sample.
+        See Dataset.get_samples.
+        """
+        montage = self._resolve_montage(montage)
+        start, duration = self._sample_range(first_sample, sample_count, channels, montage)
+        return await self._read(start, duration, channels, dtype, out, montage, sample_count)
+
+    async def get_data_multi(self, start, duration, channels_by_montage, dtype=np.float64):
+        """
+        Returns data in several montages from a single read of the raw channels they need.
+        See Dataset.get_data_multi.
+        """
+        dtype, montages, raw_channels = self._plan_multi(channels_by_montage, dtype)
+        raw_data = await self._get_unmontaged_data(start, duration, raw_channels, dtype)
+        return Dataset._split_multi(raw_data, raw_channels, channels_by_montage, montages)
+
+    async def get_data_by_rate(self, start, duration, channels, dtype=np.float64):
+        """
+        Returns data from channels with different sample rates without resampling.
+        See Dataset.get_data_by_rate.
+        """
+        dtype = Dataset._read_dtype(dtype, None, None)
+        groups = self._rate_groups(channels)
+        group_data = await self._read_rate_groups(start, duration, channels, groups, dtype)
+        return {sample_rate: ([channels[position] for position in positions], data)
+                for (sample_rate, positions), data in zip(groups, group_data)}
+
+    async def iter_chunks(self, start, duration, channels, chunk_usec, overlap_usec=0,
+                          prefetch=2, montage=CURRENT_MONTAGE):
+        """
+        Yields (chunk_start_usec, data) pairs which cover [start, start + duration) in
+        chunks of chunk_usec microseconds. See Dataset.iter_chunks.
+
+        The next prefetch chunks are read by tasks while the caller works on the current
+        one. Closing the generator early, with aclose, cancels the remaining reads.
+        """
+        montage = self._resolve_montage(montage)
+        end = start + duration
+        pending = collections.deque()
+        try:
+            for chunk_start in Dataset._chunk_starts(start, duration, chunk_usec,
+                                                     overlap_usec):
+                pending.append((chunk_start, asyncio.ensure_future(self.get_data(
+                    chunk_start, min(chunk_usec, end - chunk_start), channels,
+                    montage=montage))))
+                if len(pending) > prefetch:
+                    chunk_start, task = pending.popleft()
+                    yield chunk_start, await task
+            while pending:
+                chunk_start, task = pending.popleft()
+                yield chunk_start, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def get_dataframe(self, start, duration, channels, index=None, dtype=np.float64,
+                            montage=CURRENT_MONTAGE, chunk_usec=None):
+        """
+        Returns data from the IEEG platform as a DataFrame. See Dataset.get_dataframe.
+        """
+        montage = self._resolve_montage(montage)
+        sample_grid = self._dataframe_grid(channels, index, montage, chunk_usec)
+        if chunk_usec:
+            array = Dataset._chunk_array(start, duration, len(channels), np.dtype(dtype),
+                                         sample_grid)
+            filled = 0
+            async for chunk_start, chunk in self.iter_chunks(start, duration, channels,
+                                                             chunk_usec, montage=montage):
+                filled = Dataset._fill_chunk(array, filled, start, sample_grid, chunk_start,
+                                             chunk)
+            array[filled:] = np.nan
+        else:
+            array = await self.get_data(start, duration, channels, dtype=dtype,
+                                        montage=montage)
+        return self._dataframe(array, start, channels, index, montage, sample_grid)
+
+    async def get_annotation_layers(self):
+        """
+        Returns a dictionary mapping layer names to annotation count for this Dataset.
+        """
+        metadata_cache = getattr(self.session, 'metadata_cache', None)
+        if metadata_cache:
+            layers = metadata_cache.get_annotation_layers(self.snap_id)
+            if layers is not None:
+                return layers
+        response = await self.session.api.get_annotation_layers(self)
+        layers = Dataset._parse_annotation_layers(response.json())
+        if metadata_cache:
+            metadata_cache.put_annotation_layers(self.snap_id, layers)
+        return layers
+
+    async def get_annotations(self, layer_name,
+                              start_offset_usecs=None, first_result=None, max_results=None,
+                              as_table=False):
+        """
+        Returns a list of annotations in the given layer ordered by start time.
+        See Dataset.get_annotations.
+        """
+        response = await self.session.api.get_annotations(self, layer_name,
+                                                          start_offset_usecs=start_offset_usecs,
+                                                          first_result=first_result,
+                                                          max_results=max_results)
+        if as_table:
+            return AnnotationTable.from_json(
+                self, Dataset._json_annotation_list(response.json()))
+        return self._parse_annotations(response.json())
+
+    async def get_annotation_index(self, layer_name):
+        """
+        Returns an ieeg.annotation_index.AnnotationIndex of the annotations in the given
+        layer. See Dataset.get_annotation_index.
+        """
+        return AnnotationIndex(await self.get_annotations(layer_name, as_table=True))
+
+    async def iter_annotations(self, layer_name, page_size=1000, max_workers=4):
+        """
+        Yields the annotations in the given layer in start time order, reading up to
+        max_workers pages of page_size annotations at once. See Dataset.iter_annotations.
+        Closing the generator early, with aclose, cancels the remaining reads.
+        """
+        if page_size <= 0 or max_workers <= 0:
+            raise ValueError('page_size and max_workers must be positive')
+        layer_count = (await self.get_annotation_layers()).get(layer_name, 0)
+        pending = collections.deque()
+        next_first_result = 0
+        try:
+            while True:
+                while next_first_result < layer_count and len(pending) < max_workers:
+                    pending.append(asyncio.ensure_future(self.get_annotations(
+                        layer_name, first_result=next_first_result, max_results=page_size)))
+                    next_first_result += page_size
+                if not pending:
+                    return
+                page = await pending.popleft()
+                if (not pending and next_first_result >= layer_count
+                        and len(page) == page_size):
+                    # The layer may have grown since it was counted.
+                    layer_count = next_first_result + page_size
+                for annotation in page:
+                    yield annotation
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def add_annotations(self, annotations, batch_size=None, max_workers=4, journal=None):
+        """
+        Adds a collection of Annotations, or an AnnotationTable, to this dataset.
+
+        By default all annotations are sent in one request. If batch_size or journal is
+        given, they are sent in batches of batch_size with up to max_workers requests at
+        once, skipping the annotations recorded as accepted in journal, like
+        Dataset.add_annotations. If a batch fails, no further batches are started and
+        the error is raised once the batches in flight are done.
+
+        :param annotations: The Annotations or AnnotationTable to add
+        :param batch_size: The maximum number of annotations in each request
+        :param max_workers: The maximum number of requests in flight
+        :param journal: An optional ieeg.annotation_upload.AnnotationJournal
+        """
+        if batch_size is None and journal is None:
+            await self.session.api.add_annotations(self, annotations)
+            self._annotations_added(annotations)
+            return
+        batch_size = batch_size or 1000
+        if batch_size <= 0 or max_workers <= 0:
+            raise ValueError('batch_size and max_workers must be positive')
+        keys = None
+        if journal is not None:
+            keys = occurrence_keys(self, annotations, collections.Counter())
+            new = [key not in journal for key in keys]
+            if isinstance(annotations, AnnotationTable):
+                annotations = annotations[np.array(new, dtype=bool)]
+            else:
+                annotations = [annotation for annotation, is_new in zip(annotations, new)
+                               if is_new]
+            keys = [key for key, is_new in zip(keys, new) if is_new]
+
+        semaphore = asyncio.Semaphore(max_workers)
+        errors = []
+
+        async def upload(first):
+            async with semaphore:
+                if errors:
+                    return
+                batch = annotations[first:first + batch_size]
+                try:
+                    await self.session.api.add_annotations(self, batch)
+                except Exception as error:
+                    errors.append(error)
+                    return
+                if keys is not None:
+                    journal.record(keys[first:first + batch_size])
+                self._annotations_added(batch)
+
+        await asyncio.gather(*[upload(first)
+                               for first in range(0, len(annotations), batch_size)])
+        if errors:
+            raise errors[0]
+
+    async def move_annotation_layer(self, from_layer, to_layer):
+        """
+        Moves all annotations in layer from_layer to layer to_layer.
+
+        :returns: the number of moved annotations.
+        """
+        response = await self.session.api.move_annotation_layer(self, from_layer, to_layer)
+        self._annotation_layers_changed()
+        return Dataset._parse_moved_count(response.json())
+
+    async def delete_annotation_layer(self, layer):
+        """
+        Deletes all annotations in the given layer.
+
+        :returns: the number of deleted annotations.
+        """
+        response = await self.session.api.delete_annotation_layer(self, layer)
+        self._annotation_layers_changed()
+        return Dataset._parse_deleted_count(response.json())
@@ -15,10 +15,14 @@
 ##################################################################################
 
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 from deprecation import deprecated
-from ieeg.dataset import Dataset as DS
-from ieeg.ieeg_api import IeegApi
+import requests
+from ieeg.dataset import ChannelTable, Dataset as DS
+from ieeg.fetch import FetchPlanner
+from ieeg.ieeg_api import IeegApi, IeegConnectionError, IeegServiceError
 
 class Session:
     """
@@ -26,12 +30,29 @@ class Session:
 
        with Session(username, password) as session:
            ...
+
+    Long data requests can be split into tiles which are fetched concurrently:
+
+       with Session(username, password, fetch_tile_usec=60 * 1000000, max_fetch_workers=8) as session:
+           ...
+
+    fetch_tile_usec is the maximum duration of a single request, fetch_tile_channels is
+    the maximum number of channels in a single request, and max_fetch_workers bounds the
+    number of concurrent requests. By default requests are not split.
+
+    Raw samples can be cached on disk by passing an ieeg.block_cache.DiskBlockCache
+    as disk_cache.
+
+    Dataset metadata and annotation layer counts can be cached on disk by passing an
+    ieeg.metadata_cache.MetadataCache as metadata_cache.
     """
     host = "www.ieeg.org"
     port = ""
     method = 'https://'
 
-    def __init__(self, name, pwd, verify_ssl=True, mprov_listener=None):
+    def __init__(self, name, pwd, verify_ssl=True, mprov_listener=None,
+                 fetch_tile_usec=None, fetch_tile_channels=None, max_fetch_workers=4,
+                 disk_cache=None, metadata_cache=None):
         self.username = name
         use_https = Session.method.startswith('https')
         # Session.url_builder requires Session.port == ':8080' to use port 8080.
@@ -39,7 +60,12 @@ class Session:
         port = Session.port[1:] if Session.port.startswith(
             ':') else Session.port
         self.api = IeegApi(self.username, pwd,
-                           use_https=use_https, host=Session.host, port=port, verify_ssl=verify_ssl)
+                           use_https=use_https, host=Session.host, port=port, verify_ssl=verify_ssl,
+                           max_workers=max_fetch_workers)
+        self.fetch_planner = FetchPlanner(
+            self.api, tile_usec=fetch_tile_usec, tile_channels=fetch_tile_channels)
+        self.disk_cache = disk_cache
+        self.metadata_cache = metadata_cache
         self.mprov_listener = mprov_listener
 
     def __enter__(self):
@@ -66,7 +92,13 @@ class Session:
         Returns the montages associated with this Dataset.
         """
         response = self.api.get_montages(dataset_id)
-        response_body = response.json()
+        return Session._parse_montages(response.json())
+
+    @staticmethod
+    def _parse_montages(response_body):
+        """
+        Returns the list of JSON montages in a montages response.
+        """
         # If there is just one montage, response will be a single
         # montage and not an array.
         single_montage_or_list = response_body['montages']['montage']
@@ -79,6 +111,114 @@ class Session:
         Return a dataset object
         """
 
+        dataset = self._open_dataset(name)
+
+        if self.mprov_listener:
+            self.mprov_listener.on_open_dataset(name, dataset)
+
+        return dataset
+
+    def _open_dataset(self, name):
+        snapshot_id, time_series_details, json_montages = self._get_dataset_metadata(name)
+        dataset = DS(name, ChannelTable.parse(time_series_details),
+                     snapshot_id, self, json_montages=json_montages)
+        if self.metadata_cache:
+            self._load_gaps(dataset)
+        return dataset
+
+    def _load_gaps(self, dataset):
+        """
+        Loads the cached gaps of the channels of dataset whose dataCheck is unchanged.
+        """
+        entries = self.metadata_cache.get_gaps(dataset.snap_id)
+
+        def channel_of(portal_id):
+            channel = dataset.channel_table.index_by_portal_id.get(portal_id)
+            if (channel is None
+                    or dataset.data_checks[channel] != entries[portal_id]['data_check']):
+                return None
+            return channel
+        dataset.gap_index.load_json(entries, channel_of)
+
+    def open_datasets(self, names, max_workers=8):
+        """
+        Opens many datasets concurrently.
+
+        Returns a dict mapping each name to its Dataset, or to the IeegServiceError
+        (or IeegConnectionError) raised while opening it, so that one failure does
+        not stop the others. Network errors and metadata which cannot be parsed are
+        returned as IeegConnectionErrors. The dict is in the order of names.
+
+        :param names: The names of the datasets to open
+        :param max_workers: The maximum number of datasets opened at once
+        """
+        unique_names = list(collections.OrderedDict.fromkeys(names))
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix='ieeg-open') as executor:
+            futures = [(name, executor.submit(self._open_dataset, name))
+                       for name in unique_names]
+            try:
+                for name, future in futures:
+                    try:
+                        results[name] = future.result()
+                    except IeegConnectionError as error:
+                        results[name] = error
+                    except requests.RequestException as error:
+                        results[name] = Session._connection_error(str(error), error)
+                    except (ET.ParseError, KeyError, ValueError) as error:
+                        results[name] = Session._connection_error(
+                            'Could not parse the metadata of ' + name + ': ' + repr(error),
+                            error)
+            finally:
+                for _, future in futures:
+                    future.cancel()
+
+        if self.mprov_listener:
+            for name in unique_names:
+                if isinstance(results[name], DS):
+                    self.mprov_listener.on_open_dataset(name, results[name])
+        return results
+
+    @staticmethod
+    def _connection_error(message, cause):
+        """
+        Returns an IeegConnectionError with message caused by cause.
+        """
+        error = IeegConnectionError(message)
+        error.__cause__ = cause
+        return error
+
+    def _get_dataset_metadata(self, name):
+        """
+        Returns the (snapshot id, time series details XML, JSON montages) of the named
+        dataset, from metadata_cache if it is set and the entry is still valid.
+
+        An expired entry is validated with a single request for the time series details
+        of the cached snapshot id. If no channel's revisionId or dataCheck changed, the
+        cached snapshot id and montages are reused. Otherwise the entry and its cached
+        annotation layer counts are dropped and all of the metadata is fetched again.
+        """
+        cache = self.metadata_cache
+        cached = cache.get_dataset(name) if cache else None
+        if cached and cache.is_fresh(cached.fetched_time):
+            return cached.snapshot_id, cached.time_series_details, cached.json_montages
+
+        if cached:
+            try:
+                time_series_details = self.api.get_time_series_details(
+                    cached.snapshot_id).text
+            except IeegServiceError:
+                time_series_details = None
+            if (time_series_details is not None
+                    and Session._channel_versions(time_series_details)
+                    == Session._channel_versions(cached.time_series_details)):
+                cache.put_dataset(name, cached.snapshot_id, time_series_details,
+                                  cached.json_montages)
+                return cached.snapshot_id, time_series_details, cached.json_montages
+            cache.invalidate_dataset(name)
+            cache.invalidate_annotation_layers(cached.snapshot_id)
+
         get_id_response = self.api.get_dataset_id_by_name(name)
 
         snapshot_id = get_id_response.text
@@ -87,21 +227,32 @@ class Session:
             snapshot_id)
 
         json_montages = self._get_montages(snapshot_id)
-        dataset = DS(name, ET.fromstring(
-            time_series_details_response.text), snapshot_id, self, json_montages=json_montages)
-
-        if self.mprov_listener:
-            self.mprov_listener.on_open_dataset(name, dataset)
+        if cache:
+            cache.put_dataset(name, snapshot_id,
+                              time_series_details_response.text, json_montages)
+        return snapshot_id, time_series_details_response.text, json_montages
 
-        return dataset
+    @staticmethod
+    def _channel_versions(time_series_details):
+        """
+        Returns the (revisionId, dataCheck) of each channel in the given time series details.
+        """
+        table = ChannelTable.parse(time_series_details)
+        return list(zip(table.portal_ids, table.data_checks))
 
     def close_dataset(self, ds):
         """
-        Close connection (for future use)
+        Close connection. Saves the gaps learned while reading ds to metadata_cache if it is set.
         :param ds: Dataset to close
         :return:
         """
-        return
+        if self.metadata_cache and ds.gap_index.changed:
+            entries = ds.gap_index.to_json(lambda channel: ds.revision_ids[channel])
+            for portal_id, entry in entries.items():
+                entry['data_check'] = ds.data_checks[
+                    ds.channel_table.index_by_portal_id[portal_id]]
+            self.metadata_cache.put_gaps(ds.snap_id, entries)
+            ds.gap_index.changed = False
 
     # For backward-compatibility
     @deprecated
@@ -0,0 +1,479 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import asyncio
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from ieeg.ieeg_api import IeegConnectionError
+
+
+def sample_index(offset_usec, sample_rate):
+    """
+    Returns the index of the first sample at or after offset_usec for a channel
+    whose sample 0 is at offset 0.
+    """
+    # Tolerate floating point error when offset_usec falls exactly on a sample.
+    return int(math.ceil(offset_usec * sample_rate / 1e6 - 1e-6))
+
+
+def sample_usec(sample, sample_rate, grid_offset=0):
+    """
+    Returns the whole microsecond offset to request sample at: the last one at or
+    before it, which sample_index maps back to sample.
+
+    :param grid_offset: offset in usec of the channel's sample 0.
+    """
+    return int(math.floor(grid_offset + sample * (1e6 / sample_rate) + 1e-6))
+
+
+def block_span(start, duration, block_usec):
+    """
+    Returns the range of indices of the block_usec sized blocks, aligned to offset 0,
+    which cover [start, start + duration).
+    """
+    first_block = int(start // block_usec)
+    last_block = int(math.ceil((start + duration) / block_usec))
+    return range(first_block, max(last_block, first_block + 1))
+
+
+def block_rows(block_index, block_usec, start, duration, sample_rate, grid_offset=0):
+    """
+    Returns the (first_row, last_row) slice of the given block which lies in
+    [start, start + duration).
+
+    :param grid_offset: offset in usec of the channel's sample 0.
+    """
+    block_start = block_index * block_usec
+    block_first_sample = sample_index(block_start - grid_offset, sample_rate)
+    first_row = sample_index(max(start, block_start) - grid_offset,
+                             sample_rate) - block_first_sample
+    last_row = sample_index(min(start + duration, block_start + block_usec) - grid_offset,
+                            sample_rate) - block_first_sample
+    return max(first_row, 0), max(last_row, 0)
+
+
+class DiskBlockCache:
+    """
+    An opt-in, on-disk LRU cache of raw int32 samples.
+
+    Samples are stored per channel in fixed-size blocks of block_usec microseconds
+    aligned to offset 0, keyed by snapshot id, channel revisionId and dataCheck.
+    Requests are served from cached blocks and only missing blocks are fetched.
+    When the cache grows beyond max_bytes the least recently used blocks are removed.
+
+        cache = DiskBlockCache('/data/ieeg-cache', max_bytes=50 * 2**30)
+        with Session(username, password, disk_cache=cache) as session:
+            ...
+
+    Attributes:
+        directory: The directory holding the cached blocks.
+        max_bytes: The maximum total size of the cached blocks.
+        block_usec: The length of a block in microseconds.
+    """
+
+    _block_suffix = '.npy'
+    _conversion_file = 'conversion'
+
+    def __init__(self, directory, max_bytes=10 * 2**30, block_usec=60 * 1000000):
+        if block_usec <= 0:
+            raise ValueError('block_usec must be positive')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.block_usec = block_usec
+        self._lock = threading.Lock()
+        # Block path to size in bytes, least recently used first.
+        self._blocks = OrderedDict()
+        self._total_bytes = 0
+        self._conversion_factors = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """
+        Rebuilds the LRU index from the blocks already on disk.
+        """
+        found = []
+        for dir_path, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if file_name.endswith(DiskBlockCache._block_suffix):
+                    path = os.path.join(dir_path, file_name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(found):
+            self._blocks[path] = size
+            self._total_bytes += size
+
+    def _channel_dir(self, dataset, channel):
+        """
+        Returns the directory for the given dataset channel index.
+        """
+        key = '\0'.join([dataset.snap_id,
+                         dataset.revision_ids[channel],
+                         dataset.data_checks[channel]])
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _block_path(self, channel_dir, block_index):
+        return os.path.join(channel_dir, str(block_index) + DiskBlockCache._block_suffix)
+
+    def _read_block(self, path):
+        """
+        Returns the cached block at path or None if it is not cached.
+        """
+        with self._lock:
+            if path not in self._blocks:
+                return None
+            self._blocks.move_to_end(path)
+        try:
+            block = np.load(path, mmap_mode='r')
+            os.utime(path)
+            return block
+        except (IOError, OSError, ValueError):
+            with self._lock:
+                size = self._blocks.pop(path, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+
+    def _write_block(self, path, block):
+        """
+        Atomically writes block to path and evicts blocks if over budget.
+        """
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            np.save(temp_file, np.ascontiguousarray(block, dtype=np.int32))
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        evicted = []
+        with self._lock:
+            self._total_bytes += size - self._blocks.pop(path, 0)
+            self._blocks[path] = size
+            while self._total_bytes > self.max_bytes and len(self._blocks) > 1:
+                old_path, old_size = self._blocks.popitem(last=False)
+                self._total_bytes -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def _get_conversion_factor(self, channel_dir):
+        factor = self._conversion_factors.get(channel_dir)
+        if factor is None:
+            try:
+                with open(os.path.join(channel_dir, DiskBlockCache._conversion_file)) as conv_file:
+                    factor = float(conv_file.read())
+            except (IOError, OSError, ValueError):
+                return None
+            self._conversion_factors[channel_dir] = factor
+        return factor
+
+    def _set_conversion_factor(self, channel_dir, factor):
+        os.makedirs(channel_dir, exist_ok=True)
+        with open(os.path.join(channel_dir, DiskBlockCache._conversion_file), 'w') as conv_file:
+            conv_file.write(repr(float(factor)))
+        self._conversion_factors[channel_dir] = float(factor)
+
+    def clear(self):
+        """
+        Removes all cached blocks and the channel directories holding them.
+        """
+        with self._lock:
+            self._blocks.clear()
+            self._total_bytes = 0
+            self._conversion_factors.clear()
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def fetch(self, dataset, start, duration, channels, fetcher):
+        """
+        Returns raw data as a (int_matrix, conversion_factors) tuple, serving
+        cached blocks from disk and fetching only the missing blocks.
+
+        :param dataset: The Dataset to read
+        :param start: Start time (usec)
+        :param duration: Number of usec to request samples from
+        :param channels: Integer indices of the channels we want
+        :param fetcher: A function with the signature of FetchPlanner.fetch used to
+                        read missing blocks from the IEEG platform.
+        """
+        details = [dataset.ts_details[dataset.ch_labels[channel]] for channel in channels]
+        sample_rates = set(detail.sample_rate for detail in details)
+        if duration <= 0 or not channels or len(sample_rates) != 1:
+            return fetcher(dataset, start, duration, channels)
+        sample_rate = sample_rates.pop()
+        grid_offsets = [detail.start_time - dataset.start_time for detail in details]
+
+        block_indices = block_span(start, duration, self.block_usec)
+        unique_channels = sorted(set(channels))
+        channel_dirs = {channel: self._channel_dir(dataset, channel)
+                        for channel in unique_channels}
+        blocks = {}
+        missing = {}
+        for block_index in block_indices:
+            for channel in unique_channels:
+                block = self._read_block(
+                    self._block_path(channel_dirs[channel], block_index))
+                if block is None:
+                    missing.setdefault(block_index, []).append(channel)
+                else:
+                    blocks[(channel, block_index)] = block
+        for run_start, run_length, run_channels in self._missing_runs(missing):
+            self._fetch_run(dataset, run_start, run_length, sorted(run_channels),
+                            sample_rate, channel_dirs, blocks, fetcher)
+
+        columns = []
+        for channel, grid_offset in zip(channels, grid_offsets):
+            pieces = []
+            for block_index in block_indices:
+                block = blocks[(channel, block_index)]
+                first_row, last_row = block_rows(block_index, self.block_usec,
+                                                 start, duration, sample_rate, grid_offset)
+                pieces.append(block[first_row:last_row])
+            columns.append(pieces)
+
+        row_count = sum(len(piece) for piece in columns[0])
+        if any(sum(len(piece) for piece in pieces) != row_count for pieces in columns):
+            raise IeegConnectionError(
+                'Not all channels in response have equal length')
+        int_matrix = np.empty((row_count, len(channels)), dtype=np.int32)
+        for column, pieces in enumerate(columns):
+            row = 0
+            for piece in pieces:
+                int_matrix[row:row + len(piece), column] = piece
+                row += len(piece)
+        conv_f = [self._get_conversion_factor(channel_dirs[channel]) for channel in channels]
+        if None in conv_f:
+            return fetcher(dataset, start, duration, channels)
+        return int_matrix, np.array(conv_f)
+
+    @staticmethod
+    def _missing_runs(missing):
+        """
+        Groups consecutive missing blocks which need the same channels into runs.
+        Returns a list of (first_block_index, block_count, channels) tuples.
+        """
+        runs = []
+        for block_index in sorted(missing):
+            block_channels = set(missing[block_index])
+            if (runs and runs[-1][0] + runs[-1][1] == block_index
+                    and runs[-1][2] == block_channels):
+                runs[-1][1] += 1
+            else:
+                runs.append([block_index, 1, block_channels])
+        return [tuple(run) for run in runs if run[2]]
+
+    def _fetch_run(self, dataset, run_start, run_length, run_channels,
+                   sample_rate, channel_dirs, blocks, fetcher):
+        """
+        Fetches a run of consecutive blocks in one request, then splits and stores them.
+
+        Raises IeegConnectionError, before storing any block, if a block other than the
+        last one of the recording has fewer samples than its span.
+        """
+        start = run_start * self.block_usec
+        int_matrix, conv_f = fetcher(dataset, start, run_length * self.block_usec, run_channels)
+        run_blocks = []
+        for column, channel in enumerate(run_channels):
+            details = dataset.ts_details[dataset.ch_labels[channel]]
+            grid_offset = details.start_time - dataset.start_time
+            end_time = details.end_time - dataset.start_time
+            run_first_sample = sample_index(start - grid_offset, sample_rate)
+            for block_index in range(run_start, run_start + run_length):
+                block_start = block_index * self.block_usec
+                first_row = sample_index(block_start - grid_offset,
+                                         sample_rate) - run_first_sample
+                last_row = sample_index(block_start + self.block_usec - grid_offset,
+                                        sample_rate) - run_first_sample
+                block = np.array(int_matrix[first_row:last_row, column], dtype=np.int32)
+                if len(block) != last_row - first_row and block_start + self.block_usec < end_time:
+                    raise IeegConnectionError(
+                        'Block ' + str(block_index) + ' has ' + str(len(block))
+                        + ' samples, expected ' + str(last_row - first_row))
+                run_blocks.append((column, channel, block_index, block))
+
+        for column, channel, block_index, block in run_blocks:
+            channel_dir = channel_dirs[channel]
+            if self._get_conversion_factor(channel_dir) is None:
+                self._set_conversion_factor(channel_dir, conv_f[column])
+            self._write_block(self._block_path(channel_dir, block_index), block)
+            blocks[(channel, block_index)] = block
+
+
+class WindowCache:
+    """
+    A bounded, in-memory LRU cache of data blocks for overlapping reads of a Dataset,
+    such as sliding windows with a slide smaller than the window.
+
+    Blocks are block_usec microseconds long, aligned to offset 0 and keyed by the
+    requesting montage and channel list, so a different montage or channel subset
+    never shares blocks.
+
+    Attributes:
+        max_bytes: The maximum total size of the cached blocks.
+        block_usec: The length of a block in microseconds.
+        hits: The number of block lookups served from the cache.
+        misses: The number of block lookups which had to be fetched.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, block_usec=10 * 1000000):
+        if block_usec <= 0:
+            raise ValueError('block_usec must be positive')
+        self.max_bytes = max_bytes
+        self.block_usec = block_usec
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._total_bytes = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    @property
+    def total_bytes(self):
+        """
+        The total size of the cached blocks.
+        """
+        return self._total_bytes
+
+    def clear(self):
+        """
+        Removes all cached blocks and resets the hit and miss counters.
+        """
+        with self._lock:
+            self._blocks.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _get_block(self, key, block_index, fetch, sample_rate, grid_offset, end_offset):
+        block_key = (key, block_index)
+        block = self._lookup(block_key)
+        if block is None:
+            block = fetch(block_index * self.block_usec, self.block_usec)
+            self._check_block(block_index, block, sample_rate, grid_offset, end_offset)
+            block = self._store(block_key, block)
+        return block
+
+    def _check_block(self, block_index, block, sample_rate, grid_offset, end_offset):
+        """
+        Raises IeegConnectionError if a fetched block does not have one row for each
+        sample in it. Only a block which reaches end_offset may be short.
+        """
+        block_start = block_index * self.block_usec
+        expected_rows = (sample_index(block_start + self.block_usec - grid_offset, sample_rate)
+                         - sample_index(block_start - grid_offset, sample_rate))
+        if len(block) != expected_rows and (
+                end_offset is None or block_start + self.block_usec < end_offset
+                or len(block) > expected_rows):
+            raise IeegConnectionError(
+                'Block ' + str(block_index) + ' has ' + str(len(block))
+                + ' samples, expected ' + str(expected_rows))
+
+    def _lookup(self, block_key):
+        """
+        Returns the cached block for block_key, or None, and counts the hit or miss.
+        """
+        with self._lock:
+            block = self._blocks.get(block_key)
+            if block is not None:
+                self._blocks.move_to_end(block_key)
+                self.hits += 1
+                return block
+            self.misses += 1
+            return None
+
+    def _store(self, block_key, block):
+        """
+        Caches a fetched block, evicting the least recently used blocks if needed,
+        and returns it.
+        """
+        block.setflags(write=False)
+        with self._lock:
+            if block_key not in self._blocks and block.nbytes <= self.max_bytes:
+                self._blocks[block_key] = block
+                self._total_bytes += block.nbytes
+                while self._total_bytes > self.max_bytes:
+                    _, old_block = self._blocks.popitem(last=False)
+                    self._total_bytes -= old_block.nbytes
+        return block
+
+    def get(self, key, start, duration, sample_rate, grid_offset, fetch, end_offset=None):
+        """
+        Returns the samples x channels data for [start, start + duration) assembled
+        from cached blocks. A fetched block with the wrong number of samples raises
+        IeegConnectionError and is not cached.
+
+        :param key: A hashable identifying the montage and channels being read.
+        :param start: Start time (usec)
+        :param duration: Number of usec to request samples from
+        :param sample_rate: The sample rate of the channels being read.
+        :param grid_offset: offset in usec of the channels' sample 0.
+        :param fetch: A function of (start, duration) returning a samples x channels
+                      array. Called for blocks which are not cached.
+        :param end_offset: offset in usec of the end of the channels' data. Only blocks
+                           which reach it may have fewer samples than their length.
+                           If None, every block must be complete.
+        """
+        block_indices = list(block_span(start, duration, self.block_usec))
+        blocks = [self._get_block(key, block_index, fetch, sample_rate, grid_offset,
+                                  end_offset)
+                  for block_index in block_indices]
+        return self._assemble(block_indices, blocks, start, duration, sample_rate,
+                              grid_offset)
+
+    async def get_async(self, key, start, duration, sample_rate, grid_offset, fetch,
+                        end_offset=None):
+        """
+        Like get, but fetch is a coroutine function. The blocks which are not cached
+        are fetched concurrently.
+        """
+        block_indices = list(block_span(start, duration, self.block_usec))
+        blocks = [self._lookup((key, block_index)) for block_index in block_indices]
+        missing = [position for position, block in enumerate(blocks) if block is None]
+        fetched = await asyncio.gather(*[
+            fetch(block_indices[position] * self.block_usec, self.block_usec)
+            for position in missing])
+        for position, block in zip(missing, fetched):
+            self._check_block(block_indices[position], block, sample_rate, grid_offset,
+                              end_offset)
+        for position, block in zip(missing, fetched):
+            blocks[position] = self._store((key, block_indices[position]), block)
+        return self._assemble(block_indices, blocks, start, duration, sample_rate,
+                              grid_offset)
+
+    def _assemble(self, block_indices, blocks, start, duration, sample_rate, grid_offset):
+        """
+        Returns the rows of blocks which fall in [start, start + duration) as one array.
+        """
+        pieces = []
+        for block_index, block in zip(block_indices, blocks):
+            first_row, last_row = block_rows(block_index, self.block_usec,
+                                             start, duration, sample_rate, grid_offset)
+            pieces.append(block[first_row:last_row])
+        if len(pieces) == 1:
+            return pieces[0].copy()
+        return np.concatenate(pieces)
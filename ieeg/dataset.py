@@ -13,41 +13,180 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 ##################################################################################
+import collections
 from collections import namedtuple
+from collections.abc import Mapping
+import io
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from deprecation import deprecated
-from ieeg.ieeg_api import IeegConnectionError
+from ieeg.annotation_index import AnnotationIndex
+from ieeg.annotation_upload import AnnotationUploader
+from ieeg.block_cache import WindowCache, sample_index, sample_usec
+from ieeg.fetch import staging_buffer
+from ieeg.gap_index import GapIndex
+from ieeg.ieeg_api import DataRequestBodies, IeegServiceError
+
+
+class ChannelTable:
+    """
+    The metadata of every channel in a dataset, stored by column.
+
+    Attributes:
+        labels: The channel labels in channel index order.
+        names: The channel names.
+        portal_ids: The channel revisionIds.
+        data_checks: The channel dataChecks.
+        values: A NumPy structured array with one record per channel. See ChannelTable.dtype
+                for the fields.
+        index_by_label: A dict mapping each label to the index of its first channel.
+        index_by_portal_id: A dict mapping each revisionId to its channel index.
+    """
+    dtype = np.dtype([('duration', np.float64),
+                      ('min_sample', np.int64),
+                      ('max_sample', np.int64),
+                      ('number_of_samples', np.int64),
+                      ('start_time', np.int64),
+                      ('end_time', np.int64),
+                      ('sample_rate', np.float64),
+                      ('voltage_conversion_factor', np.float64)])
+
+    # The XML element of each field in dtype.
+    _value_tags = ['duration', 'minSample', 'maxSample', 'numberOfSamples',
+                   'startTime', 'endTime', 'sampleRate', 'voltageConversionFactor']
+
+    def __init__(self, labels, names, portal_ids, data_checks, values):
+        self.labels = labels
+        self.names = names
+        self.portal_ids = portal_ids
+        self.data_checks = data_checks
+        self.values = values
+        self.index_by_label = {}
+        for i, label in enumerate(labels):
+            self.index_by_label.setdefault(label, i)
+        self.index_by_portal_id = {portal_id: i for i, portal_id in enumerate(portal_ids)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def _from_detail_fields(cls, detail_fields):
+        """
+        Returns a ChannelTable from a list of dicts mapping the tags of a detail
+        element's children to their text.
+        """
+        rows = [tuple(numpy_type(fields[tag]) for tag, numpy_type in zip(
+            cls._value_tags, [float, int, int, int, int, int, float, float]))
+                for fields in detail_fields]
+        return cls([fields['channelLabel'] for fields in detail_fields],
+                   [fields['name'] for fields in detail_fields],
+                   [fields['revisionId'] for fields in detail_fields],
+                   [fields.get('dataCheck') for fields in detail_fields],
+                   np.array(rows, dtype=cls.dtype))
+
+    @classmethod
+    def parse(cls, xml_content):
+        """
+        Returns a ChannelTable parsed in a single pass from a
+        getDataSnapshotTimeSeriesDetails response body.
+
+        :param xml_content: The response body as bytes or str
+        """
+        if isinstance(xml_content, str):
+            xml_content = xml_content.encode('utf-8')
+        detail_fields = []
+        for _, element in ET.iterparse(io.BytesIO(xml_content)):
+            if element.tag == 'detail':
+                detail_fields.append({child.tag: child.text for child in element})
+                element.clear()
+        return cls._from_detail_fields(detail_fields)
+
+    def to_elements(self):
+        """
+        Returns a getDataSnapshotTimeSeriesDetails detail element for each channel.
+        """
+        elements = []
+        for i in range(len(self)):
+            detail = ET.Element('detail')
+            for tag, text in [('channelLabel', self.labels[i]), ('name', self.names[i]),
+                              ('revisionId', self.portal_ids[i]),
+                              ('dataCheck', self.data_checks[i])]:
+                if text is not None:
+                    ET.SubElement(detail, tag).text = text
+            for tag, field in zip(self._value_tags, self.dtype.names):
+                ET.SubElement(detail, tag).text = str(self.values[field][i])
+            elements.append(detail)
+        return elements
+
+    @classmethod
+    def from_element(cls, ts_details):
+        """
+        Returns a ChannelTable from a parsed getDataSnapshotTimeSeriesDetails response.
+        """
+        # only one details in timeseriesdetails
+        xml_details = ts_details.findall('details')[0]
+        return cls._from_detail_fields([{child.tag: child.text for child in detail}
+                                        for detail in xml_details.findall('detail')])
+
+
+def _table_value(field, python_type):
+    return property(lambda self: python_type(self.table.values[field][self.index]))
+
+
+def _table_list(attribute):
+    return property(lambda self: getattr(self.table, attribute)[self.index])
 
 
 class TimeSeriesDetails:
     """
-    Metadata on a given time series
+    Metadata on a given time series. Those of a Dataset are views of one channel of its
+    ChannelTable.
     """
-    portal_id = ""
+    __slots__ = ('table', 'index')
     acquisition = ""
-    name = ""
-    duration = 0.
-    channel_label = ""
-    min_sample = 0
-    max_sample = 0
-    number_of_samples = 0
-    start_time = 0
-    voltage_conversion_factor = 1.
-
-    def __init__(self, portal_id, name, label, duration, min_sample, max_sample, number_of_samples, start_time, end_time, sample_rate, voltage_conversion):
-        self.portal_id = portal_id
-        self.name = name
-        self.channel_label = label
-        self.duration = float(duration)
-        self.min_sample = int(min_sample)
-        self.max_sample = int(max_sample)
-        self.number_of_samples = int(number_of_samples)
-        self.start_time = int(start_time)
-        self.end_time = int(end_time)
-        self.sample_rate = float(sample_rate)
-        self.voltage_conversion_factor = float(voltage_conversion)
-        return
+
+    portal_id = _table_list('portal_ids')
+    name = _table_list('names')
+    channel_label = _table_list('labels')
+    duration = _table_value('duration', float)
+    min_sample = _table_value('min_sample', int)
+    max_sample = _table_value('max_sample', int)
+    number_of_samples = _table_value('number_of_samples', int)
+    start_time = _table_value('start_time', int)
+    end_time = _table_value('end_time', int)
+    sample_rate = _table_value('sample_rate', float)
+    voltage_conversion_factor = _table_value('voltage_conversion_factor', float)
+
+    def __init__(self, portal_id, name, label, duration, min_sample, max_sample,
+                 number_of_samples, start_time, end_time, sample_rate, voltage_conversion):
+        values = np.array([(float(duration), int(min_sample), int(max_sample),
+                            int(number_of_samples), int(start_time), int(end_time),
+                            float(sample_rate), float(voltage_conversion))],
+                          dtype=ChannelTable.dtype)
+        self.table = ChannelTable([label], [name], [portal_id], [None], values)
+        self.index = 0
+
+    @classmethod
+    def _view(cls, table, index):
+        """
+        Returns a TimeSeriesDetails which is a view of channel index of table.
+        """
+        details = cls.__new__(cls)
+        details.table = table
+        details.index = index
+        return details
+
+    def __eq__(self, other):
+        return (isinstance(other, TimeSeriesDetails)
+                and self.table is other.table and self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.table), self.index))
 
     def __str__(self):
         return ('{}({}) spans {} usec, range [{}-{}] in {} samples. ' +
@@ -58,6 +197,26 @@ class TimeSeriesDetails:
                     self.start_time, self.end_time, self.sample_rate,
                     self.voltage_conversion_factor)
 
+
+class _TimeSeriesDetailsMapping(Mapping):
+    """
+    A read-only dict of TimeSeriesDetails views keyed by label or portal id.
+    """
+
+    def __init__(self, table, index_by_key):
+        self._table = table
+        self._index_by_key = index_by_key
+
+    def __getitem__(self, key):
+        return TimeSeriesDetails._view(self._table, self._index_by_key[key])
+
+    def __iter__(self):
+        return iter(self._index_by_key)
+
+    def __len__(self):
+        return len(self._index_by_key)
+
+
 class Annotation:
     """
     A timeseries annotation on the platform
@@ -123,23 +282,229 @@ class Annotation:
         return "annotation({}): {}({},{})".format(self.portal_id, self.type, self.start_time_offset_usec, self.end_time_offset_usec)
 
 
+class AnnotationTable:
+    """
+    Annotations of a Dataset stored by column, for working with many annotations at once.
+
+    The type, layer, annotator and description columns are pandas Categoricals, so
+    each distinct string is stored once. The annotated channels of row i are
+    channel_indices[channel_offsets[i]:channel_offsets[i + 1]].
+
+    A table can be indexed like a NumPy array with an integer, slice, index array or
+    boolean mask, which returns a new table of the selected rows:
+
+        spikes = table[(table.types == 'spike') & (table.end_usec - table.start_usec < 70000)]
+        dataset.add_annotations(spikes)
+
+    Attributes:
+        parent: The Dataset to which the annotations belong.
+        start_usec: int64 array of start times in microseconds since the recording start.
+        end_usec: int64 array of end times in microseconds since the recording start.
+        types: pandas.Categorical of the types.
+        layers: pandas.Categorical of the layers.
+        annotators: pandas.Categorical of the annotators.
+        descriptions: pandas.Categorical of the descriptions.
+        channel_offsets: int64 array of len(table) + 1 offsets into channel_indices.
+        channel_indices: int32 array of the annotated channel indices of all rows.
+        portal_ids: object array of the annotation ids, None for new annotations.
+    """
+
+    def __init__(self, parent, start_usec, end_usec, types, layers, annotators, descriptions,
+                 channel_offsets, channel_indices, portal_ids=None):
+        self.parent = parent
+        self.start_usec = np.asarray(start_usec, dtype=np.int64)
+        self.end_usec = np.asarray(end_usec, dtype=np.int64)
+        self.types = pd.Categorical(types)
+        self.layers = pd.Categorical(layers)
+        self.annotators = pd.Categorical(annotators)
+        self.descriptions = pd.Categorical(descriptions)
+        self.channel_offsets = np.asarray(channel_offsets, dtype=np.int64)
+        self.channel_indices = np.asarray(channel_indices, dtype=np.int32)
+        if portal_ids is None:
+            portal_ids = np.full(len(self.start_usec), None, dtype=object)
+        self.portal_ids = np.asarray(portal_ids, dtype=object)
+        columns = [self.end_usec, self.types, self.layers, self.annotators,
+                   self.descriptions, self.portal_ids]
+        if (any(len(column) != len(self.start_usec) for column in columns)
+                or len(self.channel_offsets) != len(self.start_usec) + 1):
+            raise ValueError('AnnotationTable columns must have the same length')
+
+    def __len__(self):
+        return len(self.start_usec)
+
+    def __repr__(self):
+        return 'AnnotationTable with: ' + str(len(self)) + ' annotations.'
+
+    def __getitem__(self, key):
+        rows = np.arange(len(self))[key]
+        if rows.ndim == 0:
+            rows = rows.reshape(1)
+        counts = np.diff(self.channel_offsets)[rows]
+        channel_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=channel_offsets[1:])
+        # The position in channel_indices of each channel of the selected rows.
+        positions = (np.repeat(self.channel_offsets[rows] - channel_offsets[:-1], counts)
+                     + np.arange(channel_offsets[-1]))
+        return AnnotationTable(self.parent, self.start_usec[rows], self.end_usec[rows],
+                               self.types[rows], self.layers[rows], self.annotators[rows],
+                               self.descriptions[rows], channel_offsets,
+                               self.channel_indices[positions], self.portal_ids[rows])
+
+    def channels(self, row):
+        """
+        Returns the annotated channel indices of the given row.
+        """
+        return self.channel_indices[self.channel_offsets[row]:self.channel_offsets[row + 1]]
+
+    @staticmethod
+    def _channel_arrays(channel_lists):
+        """
+        Returns the (channel_offsets, channel_indices) of a list of channel index lists.
+        """
+        channel_offsets = np.zeros(len(channel_lists) + 1, dtype=np.int64)
+        np.cumsum([len(channels) for channels in channel_lists], out=channel_offsets[1:])
+        channel_indices = np.fromiter(
+            (channel for channels in channel_lists for channel in channels),
+            dtype=np.int32, count=int(channel_offsets[-1]))
+        return channel_offsets, channel_indices
+
+    @classmethod
+    def from_json(cls, parent, json_annotations):
+        """
+        Returns a table of the annotation records of a getTsAnnotations response.
+        """
+        index_by_portal_id = parent.channel_table.index_by_portal_id
+        channels_by_rev_ids = {}
+        channel_lists = []
+        for json_annotation in json_annotations:
+            rev_ids = json_annotation['timeseriesRevIds']['timeseriesRevId']
+            rev_ids = (rev_ids,) if isinstance(rev_ids, str) else tuple(rev_ids)
+            channels = channels_by_rev_ids.get(rev_ids)
+            if channels is None:
+                channels = [index_by_portal_id[rev_id] for rev_id in rev_ids]
+                channels_by_rev_ids[rev_ids] = channels
+            channel_lists.append(channels)
+        channel_offsets, channel_indices = AnnotationTable._channel_arrays(channel_lists)
+        return cls(parent,
+                   [json_annotation['startTimeUutc'] for json_annotation in json_annotations],
+                   [json_annotation['endTimeUutc'] for json_annotation in json_annotations],
+                   [json_annotation['type'] for json_annotation in json_annotations],
+                   [json_annotation['layer'] for json_annotation in json_annotations],
+                   [json_annotation['annotator'] for json_annotation in json_annotations],
+                   [json_annotation.get('description', '')
+                    for json_annotation in json_annotations],
+                   channel_offsets, channel_indices,
+                   [json_annotation['revId'] for json_annotation in json_annotations])
+
+    @classmethod
+    def from_annotations(cls, parent, annotations):
+        """
+        Returns a table of the given Annotations, which must belong to parent.
+        """
+        annotations = list(annotations)
+        for annotation in annotations:
+            if annotation.parent is not parent:
+                raise ValueError('Annotation does not belong to this dataset.')
+        channel_offsets, channel_indices = AnnotationTable._channel_arrays(
+            [[detail.index for detail in annotation.annotated] for annotation in annotations])
+        return cls(parent,
+                   [annotation.start_time_offset_usec for annotation in annotations],
+                   [annotation.end_time_offset_usec for annotation in annotations],
+                   [annotation.type for annotation in annotations],
+                   [annotation.layer for annotation in annotations],
+                   [annotation.annotator for annotation in annotations],
+                   [annotation.description for annotation in annotations],
+                   channel_offsets, channel_indices,
+                   [annotation.portal_id for annotation in annotations])
+
+    def to_annotations(self):
+        """
+        Returns the rows of this table as a list of Annotations.
+        """
+        revision_ids = self.parent.revision_ids
+        return [Annotation(self.parent, annotator, _type, description, layer, start, end,
+                           portal_id=portal_id,
+                           annotated_portal_ids=[revision_ids[channel]
+                                                 for channel in self.channels(row)])
+                for row, (annotator, _type, description, layer, start, end, portal_id)
+                in enumerate(zip(np.asarray(self.annotators), np.asarray(self.types),
+                                 np.asarray(self.descriptions), np.asarray(self.layers),
+                                 self.start_usec.tolist(), self.end_usec.tolist(),
+                                 self.portal_ids))]
+
+    def to_json(self):
+        """
+        Returns the (annotation records, annotated channel revisionIds) of an
+        add_annotations request for this table.
+        """
+        revision_ids = self.parent.revision_ids
+        rev_ids_by_channels = {}
+        json_annotations = []
+        for row, (annotator, _type, description, layer, start, end, portal_id) in enumerate(
+                zip(np.asarray(self.annotators), np.asarray(self.types),
+                    np.asarray(self.descriptions), np.asarray(self.layers),
+                    self.start_usec.tolist(), self.end_usec.tolist(), self.portal_ids)):
+            channels = self.channels(row).tobytes()
+            rev_ids = rev_ids_by_channels.get(channels)
+            if rev_ids is None:
+                rev_ids = [revision_ids[channel] for channel in self.channels(row).tolist()]
+                rev_ids_by_channels[channels] = rev_ids
+            json_annotation = {
+                'timeseriesRevIds': {'timeseriesRevId': rev_ids},
+                'annotator': annotator,
+                'type': _type,
+                'description': description,
+                'layer': layer,
+                'startTimeUutc': start,
+                'endTimeUutc': end
+            }
+            if portal_id:
+                json_annotation['revId'] = portal_id
+            json_annotations.append(json_annotation)
+        annotated = np.unique(self.channel_indices).tolist()
+        return json_annotations, [revision_ids[channel] for channel in annotated]
+
+    def to_dataframe(self):
+        """
+        Returns the columns of this table, except the annotated channels, as a DataFrame.
+        """
+        return pd.DataFrame({'start_usec': self.start_usec,
+                             'end_usec': self.end_usec,
+                             'type': self.types,
+                             'layer': self.layers,
+                             'annotator': self.annotators,
+                             'description': self.descriptions,
+                             'portal_id': self.portal_ids})
+
+
 HalfMontageChannel = namedtuple(
     'HalfMontageChannel', ['raw_label', 'raw_index'])
 
 
+# The default montage argument of Dataset methods, meaning Dataset.current_montage.
+CURRENT_MONTAGE = object()
+
+MontagePlan = namedtuple(
+    'MontagePlan', ['raw_channels', 'channel_columns', 'reference_columns', 'reference_ids'])
+
+
 class Montage:
     """
     A montage.
 
+    Each montage channel is a raw channel minus the mean of a group of reference
+    raw channels. For montages from ieeg.org the group is the single reference
+    channel of the pair, if any. Montages are stored as these channel indices and
+    reference groups, and are applied by gathering and subtracting columns rather
+    than by a matrix product.
+
     Attributes:
     parent: The dataset to which the montage applies.
-    portal_id: The montage's id on ieeg.org.
+    portal_id: The montage's id on ieeg.org. None for montages computed locally.
     name: The montage's name. May not be unique.
     pairs: The list of channel label pairs in the montage
            in the form (channel label, optional reference channel label).
-    matrix: A NumPy matrix representation of the montage with respect to the parent dataset.
-            Shape is n x m where n is # of channels in the dataset and m is # of channel
-            pairs in the Montage.
+    pair_index_by_pair: A dict mapping each pair to its index in pairs.
     """
 
     def __init__(self, dataset_parent, portal_id, name, json_pairs):
@@ -147,9 +512,42 @@ class Montage:
         self.portal_id = portal_id
         self.name = name
         self.indexed_pairs = self._json_pairs_to_pairs(json_pairs)
-        self.pairs = [(channel.raw_label, reference.raw_label if reference else None)
-                      for channel, reference in self.indexed_pairs]
-        self._matrix = self._calculate_matrix()
+        self._set_channels(
+            [(channel.raw_label, reference.raw_label if reference else None)
+             for channel, reference in self.indexed_pairs],
+            [channel.raw_index for channel, _ in self.indexed_pairs],
+            [[reference.raw_index] if reference and reference.raw_index is not None else []
+             for _, reference in self.indexed_pairs])
+
+    def _set_channels(self, pairs, channel_indices, reference_groups):
+        """
+        Sets the montage channels. Montage channel i is raw channel channel_indices[i]
+        minus the mean of the raw channels in reference_groups[i]. A channel index
+        of None or an empty reference group contributes nothing.
+        """
+        self.pairs = pairs
+        self.pair_index_by_pair = {}
+        for i, pair in enumerate(self.pairs):
+            self.pair_index_by_pair.setdefault(pair, i)
+        self._channel_indices = np.array(
+            [-1 if index is None else index for index in channel_indices], dtype=np.intp)
+        # Equal reference groups, such as the common average, are stored once.
+        self._reference_groups = []
+        group_id_by_group = {}
+        self._reference_ids = np.empty(len(reference_groups), dtype=np.intp)
+        for i, group in enumerate(reference_groups):
+            group = tuple(sorted(set(group)))
+            if not group:
+                self._reference_ids[i] = -1
+                continue
+            group_id = group_id_by_group.get(group)
+            if group_id is None:
+                group_id = len(self._reference_groups)
+                group_id_by_group[group] = group_id
+                self._reference_groups.append(group)
+            self._reference_ids[i] = group_id
+        # A cache mapping montage channel indices tuples to MontagePlans
+        self._montage_channels_to_plan = {}
         # A cache mapping montage channel indices tuples to the info
         # returned by get_montage_info(...)
         self._montage_channels_to_info = {}
@@ -158,11 +556,7 @@ class Montage:
         """
         Returns a HalfMontageChannel for the given raw dataset channel label.
         """
-        try:
-            chan_index = self.parent.ch_labels.index(raw_label)
-            return HalfMontageChannel(raw_label, chan_index)
-        except ValueError:
-            return HalfMontageChannel(raw_label, None)
+        return HalfMontageChannel(raw_label, self.parent.channel_index_by_label.get(raw_label))
 
     def _json_pair_to_pair(self, json_pair):
         """
@@ -190,19 +584,60 @@ class Montage:
             return [self._json_pair_to_pair(json_pairs)]
         return [self._json_pair_to_pair(json_pair) for json_pair in json_pairs]
 
-    def _calculate_matrix(self):
+    @classmethod
+    def _local(cls, dataset, name, labels, reference_labels, reference_groups):
+        """
+        Returns a montage computed locally in which the channel with label labels[i]
+        is referenced to the mean of the channels labeled reference_groups[i].
+        """
+        montage = cls.__new__(cls)
+        montage.parent = dataset
+        montage.portal_id = None
+        montage.name = name
+        index_by_label = dataset.channel_index_by_label
+        for label in labels + [label for group in reference_groups for label in group]:
+            if label not in index_by_label:
+                raise ValueError(repr(label) + ' is not a channel label')
+        montage.indexed_pairs = [(HalfMontageChannel(label, index_by_label[label]),
+                                  HalfMontageChannel(reference_label, None))
+                                 for label, reference_label in zip(labels, reference_labels)]
+        montage._set_channels(
+            list(zip(labels, reference_labels)),
+            [index_by_label[label] for label in labels],
+            [[index_by_label[label] for label in group] for group in reference_groups])
+        return montage
+
+    @classmethod
+    def common_average(cls, dataset, labels=None, name='Common Average'):
+        """
+        Returns a montage in which each channel is referenced to the mean of all of
+        the given channels. Its pairs are (label, 'average').
+
+        :param dataset: The parent Dataset
+        :param labels: The labels of the channels to include. Default is all channels.
+        :param name: The montage's name
         """
-        Returns the matrix corresponding to this montage with respect parent dataset.
+        if labels is None:
+            labels = dataset.get_channel_labels()
+        labels = list(labels)
+        return cls._local(dataset, name, labels, ['average'] * len(labels),
+                          [labels] * len(labels))
+
+    @classmethod
+    def laplacian(cls, dataset, neighbors, name='Laplacian'):
+        """
+        Returns a montage in which each channel is referenced to the mean of its neighbors.
+        Its pairs are (label, 'average(neighbor labels)').
+
+        :param dataset: The parent Dataset
+        :param neighbors: A dict mapping the label of each channel to include
+                          to the list of labels of its neighbors.
+        :param name: The montage's name
         """
-        matrix_columns = []
-        for pair_channel, pair_ref in self.indexed_pairs:
-            column = [0] * len(self.parent.ch_labels)
-            if pair_channel.raw_index is not None:
-                column[pair_channel.raw_index] = 1
-            if pair_ref and pair_ref.raw_index is not None:
-                column[pair_ref.raw_index] = -1
-            matrix_columns.append(column)
-        return np.column_stack(matrix_columns)
+        labels = list(neighbors)
+        groups = [list(neighbors[label]) for label in labels]
+        return cls._local(dataset, name, labels,
+                          ['average(' + ', '.join(group) + ')' for group in groups], groups)
 
     @classmethod
     def create_montage_map(cls, dataset, json_montages):
@@ -230,7 +665,76 @@ class Montage:
         May be smaller than the length of pairs if some pairs refer to labels that do
         not exist in the parent dataset.
         """
-        return np.count_nonzero(np.count_nonzero(self._matrix, axis=0))
+        return int(np.count_nonzero((self._channel_indices >= 0) | (self._reference_ids >= 0)))
+
+    def _get_plan(self, montage_channels):
+        """
+        Returns the MontagePlan used to compute the requested montage_channels.
+
+        raw_channels are the sorted raw channel indices to read. channel_columns
+        holds the column of raw data for each montage channel, or -1.
+        reference_columns holds the raw data columns of each reference group used,
+        and reference_ids the reference group of each montage channel, or -1.
+        """
+        key = tuple(montage_channels)
+        plan = self._montage_channels_to_plan.get(key)
+        if plan:
+            return plan
+        channel_indices = self._channel_indices[list(montage_channels)]
+        group_ids = self._reference_ids[list(montage_channels)]
+        used_group_ids = sorted(set(group_ids[group_ids >= 0].tolist()))
+        raw_channels = set(channel_indices[channel_indices >= 0].tolist())
+        for group_id in used_group_ids:
+            raw_channels.update(self._reference_groups[group_id])
+        raw_channels = sorted(raw_channels)
+        column_by_raw_channel = {channel: i for i, channel in enumerate(raw_channels)}
+        column_by_raw_channel[-1] = -1
+        new_id_by_group_id = {group_id: i for i, group_id in enumerate(used_group_ids)}
+        new_id_by_group_id[-1] = -1
+        plan = MontagePlan(
+            raw_channels,
+            np.array([column_by_raw_channel[channel] for channel in channel_indices.tolist()],
+                     dtype=np.intp),
+            [np.array([column_by_raw_channel[channel]
+                       for channel in self._reference_groups[group_id]], dtype=np.intp)
+             for group_id in used_group_ids],
+            np.array([new_id_by_group_id[group_id] for group_id in group_ids.tolist()],
+                     dtype=np.intp))
+        self._montage_channels_to_plan[key] = plan
+        return plan
+
+    def get_pair_labels(self, montage_channels):
+        """
+        Returns a label for each of the given montage channels: 'channel-reference',
+        or 'channel' if the pair has no reference.
+
+        :param montage_channels a list of indices into the list of pairs in this montage
+        """
+        return [channel + '-' + reference if reference else channel
+                for channel, reference in (self.pairs[i] for i in montage_channels)]
+
+    @staticmethod
+    def _remap_plan(plan, raw_channels):
+        """
+        Returns plan with its columns renumbered for raw data whose columns are raw_channels.
+        """
+        column_by_channel = {channel: i for i, channel in enumerate(raw_channels)}
+        columns = np.array([column_by_channel[channel] for channel in plan.raw_channels],
+                           dtype=np.intp)
+        return MontagePlan(
+            list(raw_channels),
+            np.where(plan.channel_columns >= 0, columns[plan.channel_columns], -1),
+            [columns[reference_columns] for reference_columns in plan.reference_columns],
+            plan.reference_ids)
+
+    def get_raw_channels(self, montage_channels):
+        """
+        Returns the sorted list of raw channel indices required to compute the
+        requested montage_channels.
+
+        :param montage_channels a list of indices into the list of pairs in this montage
+        """
+        return self._get_plan(montage_channels).raw_channels
 
     def get_montage_info(self, montage_channels):
         """
@@ -252,23 +756,90 @@ class Montage:
         cached_info = self._montage_channels_to_info.get(key)
         if cached_info:
             return cached_info
-        # remove columns that correspond to non-requested montage pairs.
-        requested_matrix = self._matrix[:, montage_channels]
-        # figure out the raw channels we need to request in order to caclulate montage
-        nonzero_channel_indices = requested_matrix.nonzero()[0]
-        uniq_sorted_indices = list(set(nonzero_channel_indices))
-        uniq_sorted_indices.sort()
-        # remove rows of zeros (raw channels we are not using)
-        reduced_matrix = requested_matrix[~np.all(
-            requested_matrix == 0, axis=1), :]
-        computed_info = (uniq_sorted_indices, reduced_matrix)
+        plan = self._get_plan(montage_channels)
+        matrix = np.zeros((len(plan.raw_channels), len(montage_channels)))
+        for column, (channel_column, reference_id) in enumerate(
+                zip(plan.channel_columns, plan.reference_ids)):
+            if channel_column >= 0:
+                matrix[channel_column, column] += 1
+            if reference_id >= 0:
+                reference_columns = plan.reference_columns[reference_id]
+                matrix[reference_columns, column] -= 1.0 / len(reference_columns)
+        computed_info = (plan.raw_channels, matrix)
         self._montage_channels_to_info[key] = computed_info
         return computed_info
 
+    def apply(self, raw_data, montage_channels, out=None, raw_channels=None):
+        """
+        Returns the montage_channels of this montage computed from raw_data.
+
+        :param raw_data: samples x channels data of the raw channels returned by
+                         get_raw_channels(montage_channels)
+        :param montage_channels: a list of indices into the list of pairs in this montage
+        :param out: Optional samples x montage_channels array for the result
+        :param raw_channels: The raw channel index of each column of raw_data if raw_data
+                             has other columns than get_raw_channels(montage_channels).
+        """
+        plan = self._get_plan(montage_channels)
+        if raw_channels is not None:
+            plan = Montage._remap_plan(plan, raw_channels)
+        shape = (raw_data.shape[0], len(montage_channels))
+        if out is None:
+            out = np.empty(shape, dtype=raw_data.dtype, order='F')
+        elif out.shape != shape:
+            raise ValueError('out has shape ' + str(out.shape) +
+                             ' but the montage has shape ' + str(shape))
+
+        has_channel = plan.channel_columns >= 0
+        if has_channel.all() and out.dtype == raw_data.dtype:
+            np.take(raw_data, plan.channel_columns, axis=1, out=out)
+        elif has_channel.all():
+            out[...] = raw_data[:, plan.channel_columns]
+        else:
+            out[...] = 0
+            out[:, has_channel] = raw_data[:, plan.channel_columns[has_channel]]
+
+        if plan.reference_columns:
+            references = np.empty((shape[0], len(plan.reference_columns)),
+                                  dtype=out.dtype, order='F')
+            for reference_id, columns in enumerate(plan.reference_columns):
+                if len(columns) == 1:
+                    references[:, reference_id] = raw_data[:, columns[0]]
+                else:
+                    group_data = raw_data if len(columns) == raw_data.shape[1] \
+                        else raw_data[:, columns]
+                    np.mean(group_data, axis=1, out=references[:, reference_id])
+            has_reference = plan.reference_ids >= 0
+            if has_reference.all():
+                out -= references[:, plan.reference_ids]
+            else:
+                out[:, has_reference] -= references[:, plan.reference_ids[has_reference]]
+        return out
+
     def __repr__(self):
         return "montage(" + self.name + "): " + str(self.pairs)
 
 
+class _DetachedSession:
+    """
+    The session of an unpickled Dataset, for example one sent to a process pool worker.
+    It has no connection, so reading data or annotations raises an AttributeError
+    which explains why.
+    """
+    mprov_listener = None
+
+    def __init__(self, dataset_name):
+        self.dataset_name = dataset_name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        raise AttributeError(
+            'Dataset ' + self.dataset_name + ' was copied to another process, such as a '
+            'process pool worker, and cannot make requests to the IEEG platform '
+            '(session.' + name + ')')
+
+
 class Dataset:
     """
     Class representing Dataset on the platform
@@ -277,52 +848,47 @@ class Dataset:
     _SERVER_GAP_VALUE = np.iinfo(np.int32).min
 
     def __init__(self, dataset_name, ts_details, snapshot_id, parent, json_montages=None):
-        # type: (str, xml.etree.Element, str, ieeg.auth.Session) -> None
-        self.snap_id = ""
-        self.ts_details = {}  # Time series details by label
-        self.ts_details_by_id = {}  # Time series details by portal_id
-        self.ch_labels = []  # Channel Labels
-        self.ts_array = []   # Channel
+        # type: (str, Union[ChannelTable, xml.etree.Element], str, ieeg.auth.Session) -> None
         self.name = dataset_name
         self.session = parent
         self.snap_id = snapshot_id
-        # only one details in timeseriesdetails
-        xml_details = ts_details.findall('details')[0]
-
-        dataset_start_time = float('inf')
-        dataset_end_time = -1
-        for dt in xml_details.findall('detail'):
-            # ET.dump(dt)
-            name = dt.findall('channelLabel')[0].text
-            portal_id = dt.findall('revisionId')[0].text
-            start_time = int(dt.findall('startTime')[0].text)
-            end_time = int(dt.findall('endTime')[0].text)
-            details = TimeSeriesDetails(portal_id,
-                                        dt.findall('name')[0].text,
-                                        name,
-                                        dt.findall('duration')[0].text,
-                                        dt.findall('minSample')[0].text,
-                                        dt.findall('maxSample')[0].text,
-                                        dt.findall('numberOfSamples')[0].text,
-                                        start_time,
-                                        end_time,
-                                        dt.findall('sampleRate')[0].text,
-                                        dt.findall('voltageConversionFactor')[0].text,)
-            self.ch_labels.append(name)
-            self.ts_array.append(dt)
-            self.ts_details[name] = details
-            self.ts_details_by_id[portal_id] = details
-            if start_time < dataset_start_time:
-                dataset_start_time = start_time
-            if end_time > dataset_end_time:
-                dataset_end_time = end_time
-
-        self.start_time = dataset_start_time
-        self.end_time = dataset_end_time
+        self.channel_table = ts_details if isinstance(
+            ts_details, ChannelTable) else ChannelTable.from_element(ts_details)
+        table = self.channel_table
+        self.ch_labels = table.labels  # Channel Labels
+        self.ts_details = _TimeSeriesDetailsMapping(
+            table, table.index_by_label)  # Time series details by label
+        self.ts_details_by_id = _TimeSeriesDetailsMapping(
+            table, table.index_by_portal_id)  # Time series details by portal_id
+        self.channel_index_by_label = table.index_by_label
+        self.revision_ids = table.portal_ids  # Channel revisionIds by channel index
+        self.data_checks = table.data_checks  # Channel dataChecks by channel index
+
+        self.start_time = int(table.values['start_time'].min()) if len(table) else float('inf')
+        self.end_time = int(table.values['end_time'].max()) if len(table) else -1
+        self.data_request_bodies = DataRequestBodies(self.revision_ids, self.data_checks)
 
         self.montages = Montage.create_montage_map(
             self, json_montages if json_montages else [])
         self.current_montage = None
+        self.window_cache = None
+        self.gap_index = GapIndex()
+
+    @property
+    @deprecated(details='Use channel_table instead.')
+    def ts_array(self):
+        """
+        The detail XML element of each channel, rebuilt from channel_table.
+        """
+        return self.channel_table.to_elements()
+
+    def __getstate__(self):
+        # Session resources and caches stay behind when a Dataset is pickled,
+        # for example when it is sent to a process pool worker.
+        state = dict(self.__dict__)
+        state['session'] = _DetachedSession(self.name)
+        state['window_cache'] = None
+        return state
 
     def __repr__(self):
         return "Dataset with: " + str(len(self.ch_labels)) + " channels."
@@ -355,9 +921,13 @@ class Dataset:
         :return: Ordered list of channel indices
         """
         if self.current_montage is None:
-            return [self.ch_labels.index(x) for x in list_of_labels]
-
-        return [self.current_montage.pairs.index(x) for x in list_of_labels]
+            index_by_label = self.channel_index_by_label
+        else:
+            index_by_label = self.current_montage.pair_index_by_pair
+        try:
+            return [index_by_label[x] for x in list_of_labels]
+        except KeyError as error:
+            raise ValueError(repr(error.args[0]) + ' is not in list')
 
     def get_time_series_details(self, label):
         """
@@ -377,23 +947,44 @@ class Dataset:
             self.current_montage = None
             return
 
+        self.current_montage = self.get_montage(montage_name, portal_id)
+
+    def get_montage(self, montage_name, portal_id=None):
+        """
+        Returns the named montage. If more than one montage has the name,
+        portal_id selects the montage.
+        """
         montages_with_name = self.montages[montage_name]
         if len(montages_with_name) == 1:
-            self.current_montage = montages_with_name[0]
-        else:
-            new_montage = None
-            for montage in montages_with_name:
-                if montage.portal_id == portal_id:
-                    new_montage = montage
-                    break
-            if new_montage:
-                self.current_montage = new_montage
-            else:
-                raise ValueError('Montage '
-                                 + montage_name
-                                 + ', id '
-                                 + portal_id
-                                 + ' does not exist')
+            return montages_with_name[0]
+        for montage in montages_with_name:
+            if montage.portal_id == portal_id:
+                return montage
+        raise ValueError('Montage '
+                         + montage_name
+                         + ', id '
+                         + str(portal_id)
+                         + ' does not exist')
+
+    def _resolve_montage(self, montage):
+        """
+        Returns the Montage or None selected by a montage argument.
+        """
+        if montage is CURRENT_MONTAGE:
+            return self.current_montage
+        if isinstance(montage, str):
+            return self.get_montage(montage)
+        return montage
+
+    def add_montage(self, montage):
+        """
+        Adds a locally computed montage, such as Montage.common_average(dataset),
+        to montages so that it can be selected with set_current_montage.
+
+        :returns: montage
+        """
+        self.montages.setdefault(montage.name, []).append(montage)
+        return montage
 
     def get_current_montage(self):
         """
@@ -401,71 +992,693 @@ class Dataset:
         """
         return self.current_montage
 
-    def _get_unmontaged_data(self, start, duration, raw_channels):
+    def _get_unmontaged_data(self, start, duration, raw_channels, dtype=np.float64, out=None,
+                             sample_count=None):
         """
         Returns unmontaged data from the IEEG platform
         :param start: Start time (usec)
         :param duration: Number of usec to request samples from
         :param raw_channels: Integer indices of the channels we want
+        :param dtype: A floating point numpy dtype or 'raw'. See get_data.
+        :param out: Optional array for the result. See get_data.
+        :param sample_count: If given, the exact number of rows of the result. See get_samples.
         :return: 2D array, rows = samples, columns = channels
         """
 
-        def all_same(items):
-            return all(x == items[0] for x in items)
+        if not Dataset._is_raw(dtype):
+            dtype = np.dtype(dtype)
+        groups = self._rate_groups(raw_channels)
+        if len(groups) > 1:
+            if Dataset._is_raw(dtype):
+                raise ValueError("dtype 'raw' requires channels with the same sample rate. "
+                                 'See get_data_by_rate.')
+            group_data = self._read_rate_groups(start, duration, raw_channels, groups, dtype)
+            return self._resample_rate_groups(start, raw_channels, groups, group_data,
+                                              dtype, out, sample_count)
+        disk_cache = getattr(self.session, 'disk_cache', None)
+        if disk_cache:
+            # The cache returns a new array in the order of raw_channels.
+            try:
+                int_matrix, conv_f = disk_cache.fetch(
+                    self, start, duration, raw_channels, self.session.fetch_planner.fetch)
+            except IeegServiceError:
+                self._data_request_rejected()
+                raise
+            self._learn_gaps(start, raw_channels, int_matrix)
+            return Dataset._convert(int_matrix, conv_f, list(range(len(raw_channels))),
+                                    dtype, out, owned=True, sample_count=sample_count)
+
+        requested = sorted(set(raw_channels))
+        # Decode into a new array only if it can become the result in place,
+        # otherwise into this thread's reusable staging buffer.
+        in_place = (out is None and requested == list(raw_channels)
+                    and (Dataset._is_raw(dtype) or dtype.itemsize == 4))
+        try:
+            int_matrix, conv_f = self.session.fetch_planner.fetch(
+                self, start, duration, requested, allocate=None if in_place else staging_buffer)
+        except IeegServiceError:
+            self._data_request_rejected()
+            raise
+        self._learn_gaps(start, requested, int_matrix)
+        position_by_channel = {channel: i for i, channel in enumerate(requested)}
+        return Dataset._convert(int_matrix, conv_f,
+                                [position_by_channel[channel] for channel in raw_channels],
+                                dtype, out, owned=in_place, sample_count=sample_count)
+
+    def _data_request_rejected(self):
+        """
+        Called when the IEEG platform rejects a data request, for example because a
+        channel's dataCheck changed, so that the next open_dataset fetches the
+        metadata again instead of reusing the cached dataCheck.
+        """
+        metadata_cache = getattr(self.session, 'metadata_cache', None)
+        if metadata_cache:
+            metadata_cache.invalidate_dataset(self.name)
 
-        response = self.session.api.get_data(
-            self, start, duration, raw_channels)
-        # collect data in numpy array
-        int_array = np.frombuffer(response.content, dtype='>i4')
+    def _learn_gaps(self, start, raw_channels, int_matrix):
+        """
+        Records the gaps in int_matrix, read from start, in gap_index.
+        Nothing is recorded unless the channels share a sample grid.
+        """
+        sample_grid = self._get_sample_grid(raw_channels) if len(raw_channels) else None
+        if not sample_grid or int_matrix.shape[0] == 0:
+            return
+        sample_rate, grid_offset = sample_grid
+        sample_usec = 1e6 / sample_rate
+        first_time = grid_offset + sample_index(start - grid_offset, sample_rate) * sample_usec
+        end_time = first_time + int_matrix.shape[0] * sample_usec
+        not_gap = np.array([False])
+        for column, channel in enumerate(raw_channels):
+            samples = int_matrix[:, column]
+            gaps = []
+            # Most reads have no gaps, and a minimum is cheaper than a mask.
+            if samples.min() == Dataset._SERVER_GAP_VALUE:
+                edges = np.flatnonzero(np.diff(np.concatenate(
+                    (not_gap, samples == Dataset._SERVER_GAP_VALUE, not_gap))))
+                gaps = [(first_time + gap_start * sample_usec, first_time + gap_end * sample_usec)
+                        for gap_start, gap_end in zip(edges[0::2].tolist(),
+                                                      edges[1::2].tolist())]
+            self.gap_index.record(channel, first_time, end_time, gaps)
+
+    def get_gaps(self, channels=None):
+        """
+        Returns the gaps known in the given channels from the data read so far.
 
-        # Check all channels are the same length
-        samples_per_row_array = [int(numeric_string)
-                                 for numeric_string in response.headers['samples-per-row'].split(',')]
-        if not all_same(samples_per_row_array):
-            raise IeegConnectionError(
-                'Not all channels in response have equal length')
-        samples_per_row = samples_per_row_array[0]
-        conv_f = np.array([float(numeric_string)
-                           for numeric_string in response.headers['voltage-conversion-factors-mv'].split(',')])
+        Gaps are learned from every read. A gap of all requested channels which is
+        at least session.fetch_planner.min_gap_usec long is not fetched again.
 
-        # Reshape to 2D array and Multiply by conversionFactor
-        int_matrix = np.reshape(
-            int_array, (samples_per_row, len(raw_channels)), order='F')
-        unmontaged_data = int_matrix * conv_f[np.newaxis, :]
-        unmontaged_data[int_matrix == Dataset._SERVER_GAP_VALUE] = np.nan
+        :param channels: Integer indices of the (unmontaged) channels. All channels by default.
+        :return: a dict mapping each channel label to a list of (start, end) gaps in usec
+                 from the dataset start
+        """
+        channels = range(len(self.ch_labels)) if channels is None else channels
+        return {self.ch_labels[channel]: self.gap_index.get_gaps(channel) for channel in channels}
 
-        return unmontaged_data
+    def coverage(self, start, duration, channels=None):
+        """
+        Returns the fraction of [start, start + duration) in which each channel is known
+        to have data. Regions which have not been read yet count as not covered.
 
-    def get_data(self, start, duration, channels):
+        :param start: Start time (usec)
+        :param duration: Length of the interval in usec
+        :param channels: Integer indices of the (unmontaged) channels. All channels by default.
+        :return: a dict mapping each channel label to a fraction between 0 and 1
+        """
+        channels = range(len(self.ch_labels)) if channels is None else channels
+        return {self.ch_labels[channel]: self.gap_index.coverage(channel, start, start + duration)
+                for channel in channels}
+
+    def _rate_groups(self, raw_channels):
+        """
+        Returns a list of (sample_rate, positions) pairs, highest sample rate first,
+        where positions are the indices into raw_channels of the channels with that rate.
+        """
+        positions_by_rate = {}
+        rates = self.channel_table.values['sample_rate'][list(raw_channels)]
+        for position, rate in enumerate(rates.tolist()):
+            positions_by_rate.setdefault(rate, []).append(position)
+        return sorted(positions_by_rate.items(), reverse=True)
+
+    def _read_rate_groups(self, start, duration, raw_channels, groups, dtype):
+        """
+        Returns the data of each rate group of raw_channels, reading the groups concurrently.
+        """
+        group_channels = [[raw_channels[position] for position in positions]
+                          for _, positions in groups]
+        if len(group_channels) == 1:
+            return [self._get_unmontaged_data(start, duration, group_channels[0], dtype)]
+        with ThreadPoolExecutor(max_workers=len(group_channels),
+                                thread_name_prefix='ieeg-rates') as executor:
+            futures = [executor.submit(self._get_unmontaged_data, start, duration, channels,
+                                       dtype)
+                       for channels in group_channels]
+            return [future.result() for future in futures]
+
+    def _first_sample(self, start, raw_channel):
+        """
+        Returns the (sample_rate, grid_offset, first_sample) of raw_channel for a read
+        starting at start.
+        """
+        values = self.channel_table.values[raw_channel]
+        sample_rate = float(values['sample_rate'])
+        grid_offset = int(values['start_time']) - self.start_time
+        return sample_rate, grid_offset, sample_index(start - grid_offset, sample_rate)
+
+    def _resample_rate_groups(self, start, raw_channels, groups, group_data, dtype,
+                              out=None, sample_count=None):
+        """
+        Returns the data of the rate groups read from start resampled to the highest
+        sample rate by linear interpolation, with one column per raw channel.
+        """
+        if sample_count is None:
+            sample_count = group_data[0].shape[0]
+        shape = (sample_count, len(raw_channels))
+        if out is None:
+            out = np.empty(shape, dtype=dtype, order='F')
+        Dataset._check_out(out, shape)
+
+        target_rate, target_offset, target_first = self._first_sample(
+            start, raw_channels[groups[0][1][0]])
+        sample_times = target_offset + (
+            target_first + np.arange(sample_count)) * (1e6 / target_rate)
+        for (sample_rate, positions), data in zip(groups, group_data):
+            if sample_rate == target_rate:
+                available = min(data.shape[0], sample_count)
+                out[:available, positions] = data[:available]
+                out[available:, positions] = np.nan
+                continue
+            _, grid_offset, first_sample = self._first_sample(start, raw_channels[positions[0]])
+            rows = (sample_times - grid_offset) * (sample_rate / 1e6) - first_sample
+            Dataset._interpolate_rows(data, rows, out, positions)
+        return out
+
+    @staticmethod
+    def _interpolate_rows(data, rows, out, columns):
+        """
+        Sets the given columns of out to data linearly interpolated at the fractional
+        row positions rows. Positions less than one row outside of data take the value
+        of the nearest row and positions further out are gaps. A gap in data only
+        affects the positions next to it.
+        """
+        outside = (rows <= -1) | (rows >= data.shape[0])
+        if data.shape[0] == 0:
+            out[:, columns] = np.nan
+            return
+        rows = np.clip(rows, 0, data.shape[0] - 1)
+        nearest = np.round(rows)
+        rows = np.where(np.abs(rows - nearest) < 1e-6, nearest, rows)
+        lower = rows.astype(np.intp)
+        weights = rows - lower
+        between = weights > 0
+        result = data[lower]
+        result[between] += ((data[lower[between] + 1] - result[between])
+                            * weights[between, np.newaxis])
+        result[outside] = np.nan
+        out[:, columns] = result
+
+    def get_data_by_rate(self, start, duration, channels, dtype=np.float64):
+        """
+        Returns data from channels with different sample rates without resampling.
+
+        The channels are grouped by sample rate and the groups are read concurrently.
+        get_data instead resamples all channels to the highest sample rate.
+
+            for sample_rate, (rate_channels, data) in dataset.get_data_by_rate(
+                    start, duration, channels).items():
+                ...
+
+        :param start: Start time (usec)
+        :param duration: Number of usec to request samples from
+        :param channels: Integer indices of the channels we want. No montage is used.
+        :param dtype: np.float64, np.float32 or 'raw'. See get_data.
+        :return: a dict mapping each sample rate to a (channel_indices, data) pair, where
+                 data has one column per channel of channel_indices
+        """
+        dtype = Dataset._read_dtype(dtype, None, None)
+        groups = self._rate_groups(channels)
+        group_data = self._read_rate_groups(start, duration, channels, groups, dtype)
+        return {sample_rate: ([channels[position] for position in positions], data)
+                for (sample_rate, positions), data in zip(groups, group_data)}
+
+    @staticmethod
+    def _is_raw(dtype):
+        return isinstance(dtype, str) and dtype == 'raw'
+
+    @staticmethod
+    def _check_out(out, shape):
+        if out.shape != shape:
+            raise ValueError('out has shape ' + str(out.shape) +
+                             ' but the data has shape ' + str(shape))
+        return out
+
+    @staticmethod
+    def _convert(int_matrix, conv_f, columns, dtype, out=None, owned=False, sample_count=None):
+        """
+        Returns the given columns of int_matrix as requested by get_data's dtype and out.
+
+        :param owned: True if int_matrix is not used elsewhere, so that it can be
+                      converted in place.
+        :param sample_count: If given, the result has exactly this many rows.
+                             Extra rows are dropped and missing rows are gaps.
+        """
+        if sample_count is None:
+            sample_count = int_matrix.shape[0]
+        int_matrix = int_matrix[:sample_count]
+        available = int_matrix.shape[0]
+        shape = (sample_count, len(columns))
+        in_place = (owned and out is None and available == sample_count
+                    and columns == list(range(int_matrix.shape[1])))
+        if Dataset._is_raw(dtype):
+            if in_place:
+                return int_matrix, conv_f
+            if out is None:
+                out = np.empty(shape, dtype=np.int32, order='F')
+            Dataset._check_out(out, shape)
+            for column, source in enumerate(columns):
+                out[:available, column] = int_matrix[:, source]
+            out[available:] = Dataset._SERVER_GAP_VALUE
+            return out, conv_f[columns]
+
+        if in_place and dtype.itemsize == int_matrix.itemsize:
+            out = int_matrix.view(dtype)
+        elif out is None:
+            out = np.empty(shape, dtype=dtype, order='F')
+        Dataset._check_out(out, shape)
+        Dataset._scale(int_matrix, conv_f, columns, out[:available])
+        out[available:] = np.nan
+        return out
+
+    @staticmethod
+    def _scale(int_matrix, conv_f, columns=None, out=None):
+        """
+        Returns raw samples multiplied by their conversion factors with gaps set to np.nan.
+
+        Column i of the result is computed from column columns[i] of int_matrix,
+        a column at a time so that out may share int_matrix's memory.
+        """
+        if columns is None:
+            columns = range(int_matrix.shape[1])
+        if out is None:
+            out = np.empty((int_matrix.shape[0], len(columns)), order='F')
+        for column, source in enumerate(columns):
+            raw_column = int_matrix[:, source]
+            gaps = raw_column == Dataset._SERVER_GAP_VALUE
+            # Multiply by conversionFactor
+            np.multiply(raw_column, conv_f[source], out=out[:, column], casting='unsafe')
+            if gaps.any():
+                out[gaps, column] = np.nan
+
+        return out
+
+    def enable_window_cache(self, max_bytes=256 * 2**20, block_usec=10 * 1000000):
+        """
+        Attaches an in-memory ieeg.block_cache.WindowCache to this Dataset so that
+        overlapping get_data calls, such as sliding windows, are served from memory.
+        Set the window_cache attribute to None to turn the cache off again.
+
+        :param max_bytes: The maximum total size of the cached blocks.
+        :param block_usec: The length of a cached block in microseconds.
+        :returns: the new WindowCache. It has hits and misses counters.
+        """
+        self.window_cache = WindowCache(max_bytes=max_bytes, block_usec=block_usec)
+        return self.window_cache
+
+    def _get_sample_grid(self, raw_channels):
+        """
+        Returns a (sample_rate, grid_offset) tuple shared by the given raw channels,
+        or None if they do not share one.
+        """
+        values = self.channel_table.values[list(raw_channels)]
+        grids = set(zip(values['sample_rate'].tolist(),
+                        (values['start_time'] - self.start_time).tolist()))
+        return grids.pop() if len(grids) == 1 else None
+
+    @staticmethod
+    def _fit_rows(data, sample_count):
+        """
+        Returns data with exactly sample_count rows, padded with np.nan if it is short.
+        """
+        if data.shape[0] >= sample_count:
+            return data[:sample_count]
+        padded = np.full((sample_count, data.shape[1]), np.nan, dtype=data.dtype)
+        padded[:data.shape[0]] = data
+        return padded
+
+    def _get_montaged_data(self, montage, start, duration, channels,
+                           dtype=np.float64, out=None, sample_count=None):
+        """
+        Returns data from the IEEG platform in the given montage, or unmontaged if montage is None.
+        """
+        if not montage:
+            return self._get_unmontaged_data(start, duration, channels, dtype, out,
+                                             sample_count)
+
+        raw_channels = montage.get_raw_channels(channels)
+        raw_data = self._get_unmontaged_data(start, duration, raw_channels, dtype,
+                                             sample_count=sample_count)
+        return montage.apply(raw_data, channels, out)
+
+    def get_data(self, start, duration, channels, dtype=np.float64, out=None,
+                 montage=CURRENT_MONTAGE):
         """
         Returns data from the IEEG platform using the current montage if any.
         :param start: Start time (usec)
         :param duration: Number of usec to request samples from
         :param channels: Integer indices of the channels we want.
-                         If the current montage is set, the indices
+                         If a montage is used, the indices
                          are interpreted as montage channels.
+        :param dtype: np.float64 or np.float32 for scaled data, or 'raw' for
+                      a (int32 array, conversion factors) tuple of unscaled samples
+                      in which gaps are np.iinfo(np.int32).min. 'raw' cannot be used
+                      with a montage.
+        :param out: Optional array of shape (samples, len(channels)) in which to place
+                    the result. Its dtype is used instead of dtype unless dtype is 'raw',
+                    in which case out must be int32.
+        :param montage: The Montage, or montage name, to use for this call instead of the
+                        current montage. None for unmontaged data.
+        :return: 2D array, rows = samples, columns = channels.
+                 If the channels have different sample rates, they are read concurrently
+                 in one request per rate and resampled to the highest rate by linear
+                 interpolation. See get_data_by_rate for the data at the original rates.
+        """
+        return self._read(start, duration, channels, dtype, out,
+                          self._resolve_montage(montage))
+
+    def get_samples(self, first_sample, sample_count, channels, dtype=np.float64, out=None,
+                    montage=CURRENT_MONTAGE):
+        """
+        Returns exactly sample_count samples starting at sample index first_sample,
+        using the current montage if any.
+
+        Sample indices count from the start time of the channels, which must share
+        their sample rate and start time. Samples the server does not return are
+        gaps, so the result always has shape (sample_count, len(channels)).
+
+        :param first_sample: The index of the first sample
+        :param sample_count: The number of samples
+        :param channels: Integer indices of the channels we want.
+                         If a montage is used, the indices
+                         are interpreted as montage channels.
+        :param dtype: As for get_data
+        :param out: Optional array of shape (sample_count, len(channels)). See get_data.
+        :param montage: The Montage, or montage name, to use for this call instead of the
+                        current montage. None for unmontaged data.
         :return: 2D array, rows = samples, columns = channels
         """
+        montage = self._resolve_montage(montage)
+        start, duration = self._sample_range(first_sample, sample_count, channels, montage)
+        return self._read(start, duration, channels, dtype, out, montage, sample_count)
 
-        if not self.current_montage:
-            return self._get_unmontaged_data(start, duration, channels)
+    def _sample_range(self, first_sample, sample_count, channels, montage):
+        """
+        Returns the (start, duration) in whole usec of the samples read by get_samples,
+        so that the server maps start back to first_sample.
+        """
+        if first_sample < 0 or sample_count < 0:
+            raise ValueError('first_sample and sample_count must not be negative')
+        sample_grid = self._get_sample_grid(
+            montage.get_raw_channels(channels) if montage else channels)
+        if not sample_grid:
+            raise ValueError('get_samples requires channels with the same '
+                             'sample rate and start time')
+        sample_rate, grid_offset = sample_grid
+        start = sample_usec(first_sample, sample_rate, grid_offset)
+        return start, sample_usec(first_sample + sample_count, sample_rate, grid_offset) - start
+
+    @staticmethod
+    def _read_dtype(dtype, out, montage):
+        """
+        Returns the dtype of a get_data result, checking that it can be used.
+        """
+        if Dataset._is_raw(dtype):
+            if montage:
+                raise ValueError("dtype 'raw' cannot be used with a montage")
+            return dtype
+        dtype = np.dtype(dtype if out is None else out.dtype)
+        if dtype.kind != 'f':
+            raise ValueError('dtype must be a floating point type or \'raw\'')
+        return dtype
+
+    def _read(self, start, duration, channels, dtype, out, montage, sample_count=None):
+        """
+        Implements get_data and get_samples for a resolved montage.
+        """
+        dtype = Dataset._read_dtype(dtype, out, montage)
+        sample_grid = self._window_cache_grid(channels, dtype, montage)
+        if sample_grid:
+            sample_rate, grid_offset, end_offset = sample_grid
+            data = self.window_cache.get(
+                (montage, tuple(channels)), start, duration, sample_rate, grid_offset,
+                lambda block_start, block_duration: self._get_montaged_data(
+                    montage, block_start, block_duration, channels), end_offset)
+            return Dataset._window_cache_result(data, dtype, out, sample_count)
+        return self._get_montaged_data(montage, start, duration, channels, dtype, out,
+                                       sample_count)
+
+    def _window_cache_grid(self, channels, dtype, montage):
+        """
+        Returns the (sample_rate, grid_offset, end_offset) of the channels if a read of
+        them can use the window cache, otherwise None. end_offset is the offset in usec
+        of the end of the channel with the least data.
+        """
+        if self.window_cache is None or Dataset._is_raw(dtype):
+            return None
+        raw_channels = montage.get_raw_channels(channels) if montage else channels
+        sample_grid = self._get_sample_grid(raw_channels)
+        if not sample_grid:
+            return None
+        end_time = self.channel_table.values['end_time'][list(raw_channels)].min()
+        return sample_grid + (float(end_time) - self.start_time,)
+
+    @staticmethod
+    def _window_cache_result(data, dtype, out, sample_count):
+        """
+        Returns data assembled by the window cache as the result of a read.
+        """
+        if sample_count is not None:
+            data = Dataset._fit_rows(data, sample_count)
+        if out is not None:
+            Dataset._check_out(out, data.shape)[...] = data
+            return out
+        return data.astype(dtype, copy=False)
+
+    def get_data_multi(self, start, duration, channels_by_montage, dtype=np.float64):
+        """
+        Returns data in several montages from a single read of the raw channels they need.
+
+            views = dataset.get_data_multi(start, duration,
+                                           {'Bipolar': [0, 1], None: [0, 1, 2]})
+
+        :param start: Start time (usec)
+        :param duration: Number of usec to request samples from
+        :param channels_by_montage: A dict mapping a Montage, montage name, or None for
+                                    unmontaged data to the channel indices wanted in it.
+        :param dtype: np.float64 or np.float32
+        :return: a dict with the same keys mapping to 2D arrays, rows = samples,
+                 columns = channels
+        """
+        dtype, montages, raw_channels = self._plan_multi(channels_by_montage, dtype)
+        raw_data = self._get_unmontaged_data(start, duration, raw_channels, dtype)
+        return Dataset._split_multi(raw_data, raw_channels, channels_by_montage, montages)
+
+    def _plan_multi(self, channels_by_montage, dtype):
+        """
+        Returns the (dtype, montages by key, sorted raw channels) of a get_data_multi call.
+        """
+        dtype = np.dtype(dtype)
+        if dtype.kind != 'f':
+            raise ValueError('dtype must be a floating point type')
+        montages = {key: (None if key is None else self._resolve_montage(key))
+                    for key in channels_by_montage}
+        raw_channels = set()
+        for key, channels in channels_by_montage.items():
+            montage = montages[key]
+            raw_channels.update(montage.get_raw_channels(channels) if montage else channels)
+        return dtype, montages, sorted(raw_channels)
+
+    @staticmethod
+    def _split_multi(raw_data, raw_channels, channels_by_montage, montages):
+        """
+        Returns the views of a get_data_multi call computed from the raw channel data.
+        """
+        column_by_channel = {channel: i for i, channel in enumerate(raw_channels)}
+        views = {}
+        for key, channels in channels_by_montage.items():
+            montage = montages[key]
+            if montage:
+                views[key] = montage.apply(raw_data, channels, raw_channels=raw_channels)
+            else:
+                views[key] = np.take(raw_data, [column_by_channel[channel]
+                                                for channel in channels], axis=1)
+        return views
+
+    def iter_chunks(self, start, duration, channels, chunk_usec, overlap_usec=0, prefetch=2,
+                    montage=CURRENT_MONTAGE):
+        """
+        Yields (chunk_start_usec, data) pairs which cover [start, start + duration) in
+        chunks of chunk_usec microseconds, using the current montage if any.
+        Consecutive chunks overlap by overlap_usec and the last chunk may be shorter.
 
-        raw_channels, montage_matrix = self.current_montage.get_montage_info(
-            channels)
-        raw_data = self._get_unmontaged_data(start, duration, raw_channels)
-        return np.matmul(raw_data, montage_matrix)
+        The next prefetch chunks are read in a background thread while the caller works
+        on the current one, so at most prefetch + 1 chunks are held at a time. Closing
+        the generator early cancels the remaining reads.
 
-    def get_dataframe(self, start, duration, channels):
+        :param start: Start time (usec)
+        :param duration: Number of usec to read
+        :param channels: Integer indices of the channels we want
+        :param chunk_usec: The length of each chunk in usec
+        :param overlap_usec: The overlap of consecutive chunks in usec
+        :param prefetch: The number of chunks to read ahead
+        :param montage: The Montage, or montage name, to use instead of the
+                        current montage. None for unmontaged data.
+        """
+        montage = self._resolve_montage(montage)
+        end = start + duration
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ieeg-prefetch')
+        pending = collections.deque()
+        try:
+            for chunk_start in Dataset._chunk_starts(start, duration, chunk_usec,
+                                                     overlap_usec):
+                pending.append((chunk_start, executor.submit(
+                    self.get_data, chunk_start, min(chunk_usec, end - chunk_start), channels,
+                    montage=montage)))
+                if len(pending) > prefetch:
+                    chunk_start, future = pending.popleft()
+                    yield chunk_start, future.result()
+            while pending:
+                chunk_start, future = pending.popleft()
+                yield chunk_start, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _chunk_starts(start, duration, chunk_usec, overlap_usec):
+        """
+        Returns the start of each chunk read by iter_chunks.
+        """
+        if overlap_usec < 0 or overlap_usec >= chunk_usec:
+            raise ValueError('overlap_usec must be at least 0 and less than chunk_usec')
+        end = start + duration
+        chunk_starts = []
+        chunk_start = start
+        while chunk_start < end:
+            chunk_starts.append(chunk_start)
+            if chunk_start + chunk_usec >= end:
+                break
+            chunk_start += chunk_usec - overlap_usec
+        return chunk_starts
+
+    def get_dataframe(self, start, duration, channels, index=None, dtype=np.float64,
+                      montage=CURRENT_MONTAGE, chunk_usec=None):
         """
         Returns data from the IEEG platform
+
+        The DataFrame wraps the data array without copying it.
+
         :param start: Start time (usec)
         :param duration: Number of usec to request samples from
         :param channels: Integer indices of the channels we want
-        :return: dataframe, rows = samples, columns = labeled channels
+        :param index: None for integer row positions, 'usec' for the offset of each sample
+                      in usec from the dataset start, or 'datetime' for a UTC DatetimeIndex
+                      of sample times. A time index requires channels with the same
+                      sample rate and start time.
+        :param dtype: np.float64 or np.float32
+        :param montage: The Montage, or montage name, to use instead of the
+                        current montage. None for unmontaged data.
+        :param chunk_usec: If given, the data is read with iter_chunks, chunk_usec at a time,
+                           directly into the rows of one preallocated array.
+        :return: dataframe, rows = samples, columns = labeled channels, or
+                 montage pairs labeled 'channel-reference'
+        """
+        montage = self._resolve_montage(montage)
+        sample_grid = self._dataframe_grid(channels, index, montage, chunk_usec)
+        if chunk_usec:
+            array = self._read_chunks_into_array(start, duration, channels, chunk_usec,
+                                                 np.dtype(dtype), montage, sample_grid)
+        else:
+            array = self.get_data(start, duration, channels, dtype=dtype, montage=montage)
+        return self._dataframe(array, start, channels, index, montage, sample_grid)
+
+    def _dataframe_grid(self, channels, index, montage, chunk_usec):
+        """
+        Returns the sample grid of the channels of a get_dataframe call, checking that
+        they have one if chunk_usec or a time index needs it.
+        """
+        raw_channels = montage.get_raw_channels(channels) if montage else channels
+        sample_grid = self._get_sample_grid(raw_channels)
+        if (chunk_usec or index is not None) and not sample_grid:
+            raise ValueError('chunk_usec and a time index require channels with the same '
+                             'sample rate and start time')
+        return sample_grid
+
+    def _dataframe(self, array, start, channels, index, montage, sample_grid):
+        """
+        Returns a DataFrame wrapping the data array read by get_dataframe.
         """
+        frame_index = None if index is None else self._time_index(
+            index, start, array.shape[0], sample_grid)
+        column_labels = montage.get_pair_labels(channels) if montage else [
+            self.ch_labels[i] for i in channels]
+        return pd.DataFrame(array, index=frame_index, columns=column_labels, copy=False)
 
-        array = self.get_data(start, duration, channels)
-        return pd.DataFrame(array, columns=[self.ch_labels[i] for i in channels])
+    def _time_index(self, index, start, sample_count, sample_grid):
+        """
+        Returns a pandas Index of the times of sample_count samples read from start.
+        """
+        sample_rate, grid_offset = sample_grid
+        first_sample = sample_index(start - grid_offset, sample_rate)
+        offsets = grid_offset + (first_sample + np.arange(sample_count)) * (1e6 / sample_rate)
+        if index == 'usec':
+            return pd.Index(offsets, name='usec')
+        if index == 'datetime':
+            return pd.DatetimeIndex(pd.to_datetime(
+                np.round(self.start_time + offsets).astype(np.int64), unit='us', utc=True),
+                                    name='time')
+        raise ValueError("index must be None, 'usec' or 'datetime'")
+
+    def _read_chunks_into_array(self, start, duration, channels, chunk_usec, dtype, montage,
+                                sample_grid):
+        """
+        Returns the samples in [start, start + duration) read chunk by chunk into
+        one preallocated array. Rows the server does not return are np.nan.
+        """
+        array = Dataset._chunk_array(start, duration, len(channels), dtype, sample_grid)
+        filled = 0
+        for chunk_start, chunk in self.iter_chunks(start, duration, channels, chunk_usec,
+                                                   montage=montage):
+            filled = Dataset._fill_chunk(array, filled, start, sample_grid, chunk_start, chunk)
+        array[filled:] = np.nan
+        return array
+
+    @staticmethod
+    def _chunk_array(start, duration, channel_count, dtype, sample_grid):
+        """
+        Returns an uninitialized array for the samples in [start, start + duration).
+        """
+        sample_rate, grid_offset = sample_grid
+        first_sample = sample_index(start - grid_offset, sample_rate)
+        sample_count = sample_index(start + duration - grid_offset, sample_rate) - first_sample
+        return np.empty((sample_count, channel_count), dtype=dtype, order='F')
+
+    @staticmethod
+    def _fill_chunk(array, filled, start, sample_grid, chunk_start, chunk):
+        """
+        Copies a chunk read from chunk_start into the rows of array, an array from
+        _chunk_array for samples read from start. Rows between the filled rows and the
+        chunk are set to np.nan.
+
+        :returns: the number of leading rows of array which are now filled.
+        """
+        sample_rate, grid_offset = sample_grid
+        row = sample_index(chunk_start - grid_offset, sample_rate) - sample_index(
+            start - grid_offset, sample_rate)
+        if row > filled:
+            array[filled:row] = np.nan
+        rows = min(chunk.shape[0], array.shape[0] - row)
+        array[row:row + rows] = chunk[:rows]
+        return max(filled, row + rows)
 
     def get_annotation_layers(self):
         """
@@ -474,9 +1687,29 @@ class Dataset:
         :returns: a dictionary which maps layer names to annotation count for layer
         """
 
+        metadata_cache = getattr(self.session, 'metadata_cache', None)
+        if metadata_cache:
+            layers = metadata_cache.get_annotation_layers(self.snap_id)
+            if layers is not None:
+                return layers
+
         # response to request
         response = self.session.api.get_annotation_layers(self)
-        response_body = response.json()
+        layers = Dataset._parse_annotation_layers(response.json())
+        if metadata_cache:
+            metadata_cache.put_annotation_layers(self.snap_id, layers)
+        return layers
+
+    def _annotation_layers_changed(self):
+        metadata_cache = getattr(self.session, 'metadata_cache', None)
+        if metadata_cache:
+            metadata_cache.invalidate_annotation_layers(self.snap_id)
+
+    @staticmethod
+    def _parse_annotation_layers(response_body):
+        """
+        Returns the layer name to annotation count dictionary in a getCountsByLayer response.
+        """
         counts_by_layer = response_body['countsByLayer']['countsByLayer']
         if not counts_by_layer:
             return {}
@@ -489,7 +1722,8 @@ class Dataset:
             return {e['key']: e['value'] for e in entry}
 
     def get_annotations(self, layer_name,
-                        start_offset_usecs=None, first_result=None, max_results=None):
+                        start_offset_usecs=None, first_result=None, max_results=None,
+                        as_table=False):
         """
         Returns a list of annotations in the given layer ordered by start time.
 
@@ -503,6 +1737,7 @@ class Dataset:
                                   start offset >= start_offset_usec
         :param first_result: If specified, the zero-based index of the first annotation to return.
         :param max_results: If specified, the maximum number of annotations to return.
+        :param as_table: If True, an AnnotationTable is returned instead of a list.
         :returns: a list of annotations in the given layer ordered by start offset.
         """
 
@@ -510,44 +1745,123 @@ class Dataset:
                                                     start_offset_usecs=start_offset_usecs,
                                                     first_result=first_result,
                                                     max_results=max_results)
-        response_body = response.json()
-        timeseries_annotations = response_body['timeseriesannotations']
-        json_annotations = timeseries_annotations['annotations']['annotation']
+        if as_table:
+            return AnnotationTable.from_json(
+                self, Dataset._json_annotation_list(response.json()))
+        return self._parse_annotations(response.json())
+
+    def get_annotation_index(self, layer_name):
+        """
+        Returns an ieeg.annotation_index.AnnotationIndex of the annotations in the given
+        layer for overlap, stabbing and nearest event queries by time and channel.
+        """
+        return AnnotationIndex(self.get_annotations(layer_name, as_table=True))
+
+    @staticmethod
+    def _json_annotation_list(response_body):
+        """
+        Returns the list of annotation records in a getTsAnnotations response.
+        """
+        # A page past the end of a layer has no annotation element.
+        json_annotations = (response_body['timeseriesannotations'].get('annotations')
+                            or {}).get('annotation', [])
+        # If there is just one annotation, it is not in a list.
+        return [json_annotations] if isinstance(json_annotations, dict) else json_annotations
 
+    def iter_annotations(self, layer_name, page_size=1000, max_workers=4):
+        """
+        Yields the annotations in the given layer in start time order, reading them
+        in pages of page_size annotations.
+
+        The page offsets are planned from the layer's count in get_annotation_layers and
+        up to max_workers pages are read concurrently, so at most max_workers + 1 pages
+        are held at a time. If the last page is full, pages are read until a shorter one
+        in case annotations were added since the layer was counted. Closing the generator
+        early cancels the remaining reads.
+
+        :param layer_name: The annotation layer to read
+        :param page_size: The number of annotations in each request
+        :param max_workers: The maximum number of pages read at once
+        """
+        if page_size <= 0 or max_workers <= 0:
+            raise ValueError('page_size and max_workers must be positive')
+        layer_count = self.get_annotation_layers().get(layer_name, 0)
+        if not layer_count:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_workers,
+                                      thread_name_prefix='ieeg-annotations')
+        pending = collections.deque()
+        next_first_result = 0
         try:
-            annotations = [Annotation(
-                self,
-                a['annotator'],
-                a['type'],
-                a.get('description', ''),
-                a['layer'],
-                a['startTimeUutc'],
-                a['endTimeUutc'],
-                portal_id=a['revId'],
-                annotated_portal_ids=a['timeseriesRevIds']['timeseriesRevId'])
-                for a in json_annotations]
-        except TypeError:
-            # If there is only one annotation in the layer,
-            # json_annotations won't be a list. It'll be an annotation.
-            annotations = [Annotation(
-                self,
-                json_annotations['annotator'],
-                json_annotations['type'],
-                json_annotations.get('description', ''),
-                json_annotations['layer'],
-                json_annotations['startTimeUutc'],
-                json_annotations['endTimeUutc'],
-                portal_id=json_annotations['revId'],
-                annotated_portal_ids=json_annotations['timeseriesRevIds']['timeseriesRevId'])]
-        return annotations
-
-    def add_annotations(self, annotations):
-        """
-        Adds a collection of Annotations to this dataset.
-        """
-        self.session.api.add_annotations(self, annotations)
+            while True:
+                while next_first_result < layer_count and len(pending) < max_workers:
+                    pending.append(executor.submit(
+                        self.get_annotations, layer_name,
+                        first_result=next_first_result, max_results=page_size))
+                    next_first_result += page_size
+                if not pending:
+                    return
+                page = pending.popleft().result()
+                if (not pending and next_first_result >= layer_count
+                        and len(page) == page_size):
+                    # The layer may have grown since it was counted.
+                    layer_count = next_first_result + page_size
+                for annotation in page:
+                    yield annotation
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _parse_annotations(self, response_body):
+        """
+        Returns the list of Annotations in a getTsAnnotations response.
+        """
+        return [Annotation(
+            self,
+            a['annotator'],
+            a['type'],
+            a.get('description', ''),
+            a['layer'],
+            a['startTimeUutc'],
+            a['endTimeUutc'],
+            portal_id=a['revId'],
+            annotated_portal_ids=a['timeseriesRevIds']['timeseriesRevId'])
+            for a in Dataset._json_annotation_list(response_body)]
+
+    def add_annotations(self, annotations, batch_size=None, max_workers=4, journal=None):
+        """
+        Adds a collection of Annotations, or an AnnotationTable, to this dataset.
+
+        By default all annotations are sent in one request. If batch_size or journal is
+        given, they are sent in batches of batch_size with up to max_workers requests at
+        once by an ieeg.annotation_upload.AnnotationUploader. Annotations recorded as
+        accepted in the ieeg.annotation_upload.AnnotationJournal journal are skipped, so a
+        failed call can be repeated with the same journal.
+
+        :param annotations: The Annotations or AnnotationTable to add
+        :param batch_size: The maximum number of annotations in each request
+        :param max_workers: The maximum number of requests in flight
+        :param journal: An optional AnnotationJournal
+        """
+        if batch_size is None and journal is None:
+            self.session.api.add_annotations(self, annotations)
+            self._annotations_added(annotations)
+            return
+        with AnnotationUploader(self, batch_size=batch_size or 1000, max_workers=max_workers,
+                                journal=journal) as uploader:
+            uploader.add(annotations)
+
+    def _annotations_added(self, annotations):
+        """
+        Called after annotations were added to this dataset.
+        """
+        self._annotation_layers_changed()
         if self.session.mprov_listener:
-            self.session.mprov_listener.on_add_annotations(annotations)
+            self.session.mprov_listener.on_add_annotations(
+                annotations.to_annotations() if isinstance(annotations, AnnotationTable)
+                else annotations)
 
     def move_annotation_layer(self, from_layer, to_layer):
         """
@@ -557,7 +1871,11 @@ class Dataset:
         """
         response = self.session.api.move_annotation_layer(
             self, from_layer, to_layer)
-        response_body = response.json()
+        self._annotation_layers_changed()
+        return Dataset._parse_moved_count(response.json())
+
+    @staticmethod
+    def _parse_moved_count(response_body):
         moved = response_body['tsAnnotationsMoved']['moved']
         return int(moved)
 
@@ -568,7 +1886,11 @@ class Dataset:
         :returns: the number of deleted annotations.
         """
         response = self.session.api.delete_annotation_layer(self, layer)
-        response_body = response.json()
+        self._annotation_layers_changed()
+        return Dataset._parse_deleted_count(response.json())
+
+    @staticmethod
+    def _parse_deleted_count(response_body):
         deleted = response_body['tsAnnotationsDeleted']['noDeleted']
         return int(deleted)
 
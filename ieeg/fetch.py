@@ -0,0 +1,346 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+from collections import namedtuple
+import math
+import sys
+import threading
+import numpy as np
+from ieeg.block_cache import sample_index, sample_usec
+from ieeg.ieeg_api import IeegConnectionError
+
+FetchTile = namedtuple(
+    'FetchTile', ['start', 'duration', 'column_offset', 'channels', 'gap'], defaults=(False,))
+
+
+_STREAM_CHUNK_BYTES = 2**20
+
+# Staging buffers larger than this many values (4 MiB) are allocated per call
+# rather than kept for reuse, so that each thread holds at most this much.
+_MAX_STAGING_VALUES = 2**20
+
+_staging = threading.local()
+
+
+def staging_buffer(size):
+    """
+    Returns a 1-D int32 array of the given size for temporary use by the calling thread.
+
+    The memory is reused by the thread's next call, so the result must not be
+    kept or returned to callers.
+    """
+    if size > _MAX_STAGING_VALUES:
+        return np.empty(size, dtype=np.int32)
+    buffer = getattr(_staging, 'buffer', None)
+    if buffer is None or buffer.size < size:
+        buffer = np.empty(size, dtype=np.int32)
+        _staging.buffer = buffer
+    return buffer[:size]
+
+
+def _read_headers(response):
+    """
+    Returns the (samples_per_row, conversion_factors) of a
+    getUnscaledTimeSeriesSetBinaryRaw response.
+    """
+    def all_same(items):
+        return all(x == items[0] for x in items)
+
+    # Check all channels are the same length
+    samples_per_row_array = [int(numeric_string)
+                             for numeric_string in response.headers['samples-per-row'].split(',')]
+    if not all_same(samples_per_row_array):
+        raise IeegConnectionError(
+            'Not all channels in response have equal length')
+    conv_f = np.array([float(numeric_string)
+                       for numeric_string in response.headers['voltage-conversion-factors-mv'].split(',')])
+    return samples_per_row_array[0], conv_f
+
+
+def _check_length(byte_count, expected_byte_count):
+    if byte_count != expected_byte_count:
+        raise IeegConnectionError(
+            'Response has %d bytes of samples but its headers describe %d'
+            % (byte_count, expected_byte_count))
+
+
+def decode_response(response, channel_count, allocate=None):
+    """
+    Returns a (int_matrix, conversion_factors) tuple for a
+    getUnscaledTimeSeriesSetBinaryRaw response.
+
+    The body is read in chunks straight into the int32 storage and converted to
+    native byte order in place, so a response opened with stream=True is never
+    held in memory as a whole.
+
+    int_matrix is a samples x channels native int32 array.
+    conversion_factors is a float array with one entry per channel.
+
+    :param allocate: Optional function which returns the 1-D int32 storage for
+                     the given number of values. np.empty by default.
+    """
+    samples_per_row, conv_f = _read_headers(response)
+    size = samples_per_row * channel_count
+    storage = allocate(size) if allocate else np.empty(size, dtype=np.int32)
+    storage_bytes = storage.view(np.uint8)
+    byte_count = 0
+    for chunk in response.iter_content(_STREAM_CHUNK_BYTES):
+        chunk_end = byte_count + len(chunk)
+        if chunk_end > storage_bytes.size:
+            _check_length(chunk_end, storage_bytes.size)
+        storage_bytes[byte_count:chunk_end] = np.frombuffer(chunk, dtype=np.uint8)
+        byte_count = chunk_end
+    _check_length(byte_count, storage_bytes.size)
+    if sys.byteorder == 'little':
+        storage.byteswap(inplace=True)
+
+    # The server sends all samples of one channel before the next.
+    return storage.reshape((channel_count, samples_per_row)).T, conv_f
+
+
+class FetchPlanner:
+    """
+    Splits a data request into tiles in time and, optionally, in channel groups,
+    fetches the tiles concurrently and stitches them back into a single array.
+
+    Attributes:
+        api: The ieeg.ieeg_api.IeegApi used to fetch tiles.
+        tile_usec: The maximum duration of a tile in microseconds.
+                   None means requests are not split in time.
+        tile_channels: The maximum number of channels in a tile.
+                       None means requests are not split by channel.
+        min_gap_usec: The minimum length of a gap, known from the Dataset's gap_index,
+                      which is skipped instead of fetched.
+    """
+
+    def __init__(self, api, tile_usec=None, tile_channels=None, min_gap_usec=1000000):
+        if tile_usec is not None and tile_usec <= 0:
+            raise ValueError('tile_usec must be positive')
+        if tile_channels is not None and tile_channels <= 0:
+            raise ValueError('tile_channels must be positive')
+        self.api = api
+        self.tile_usec = tile_usec
+        self.tile_channels = tile_channels
+        self.min_gap_usec = min_gap_usec
+
+    def plan(self, start, duration, channels, gaps=(), sample_grid=None):
+        """
+        Returns the tiles needed to cover the given request as a list of rows.
+        Each row is a list of FetchTiles covering the same time span.
+
+        The boundaries between rows are whole microseconds. Given the channels'
+        sample_grid, each boundary is the last whole microsecond at or before a
+        sample, so that every sample falls in exactly one row.
+
+        :param start: Start time (usec)
+        :param duration: Number of usec to request samples from
+        :param channels: Integer indices of the channels we want
+        :param gaps: Sorted (start, end) gaps of all of the channels. Each gap
+                     becomes a row of one tile with gap set, which is not fetched.
+        :param sample_grid: The (sample_rate, grid_offset) shared by the channels, if any
+        """
+        end = start + duration
+        spans = []
+        span_start = start
+        for gap_start, gap_end in gaps:
+            gap_start = max(FetchPlanner._snap(gap_start, sample_grid), span_start)
+            gap_end = min(FetchPlanner._snap(gap_end, sample_grid), end)
+            if gap_end <= gap_start:
+                continue
+            spans.extend(self._split(span_start, gap_start - span_start, sample_grid))
+            spans.append((gap_start, gap_end - gap_start, True))
+            span_start = gap_end
+        if span_start < end or not spans:
+            spans.extend(self._split(span_start, end - span_start, sample_grid))
+
+        group_size = self.tile_channels or max(len(channels), 1)
+        groups = [(offset, channels[offset:offset + group_size])
+                  for offset in range(0, len(channels), group_size)] or [(0, channels)]
+        return [[FetchTile(span_start, span_duration, 0, channels, True)] if gap else
+                [FetchTile(span_start, span_duration, offset, group)
+                 for offset, group in groups]
+                for span_start, span_duration, gap in spans]
+
+    @staticmethod
+    def _snap(time, sample_grid):
+        """
+        Returns the whole microsecond boundary for time: the last one at or before
+        the first sample at or after time given the sample_grid, or time rounded
+        down without one.
+        """
+        if sample_grid:
+            sample_rate, grid_offset = sample_grid
+            return sample_usec(sample_index(time - grid_offset, sample_rate), sample_rate,
+                               grid_offset)
+        return int(math.floor(time + 1e-6))
+
+    def _split(self, start, duration, sample_grid=None):
+        """
+        Returns the (start, duration, False) spans of about tile_usec or less covering
+        a span, with boundaries snapped to sample_grid.
+        """
+        if duration <= 0:
+            return []
+        if not self.tile_usec or duration <= self.tile_usec:
+            return [(start, duration, False)]
+        end = start + duration
+        edges = [start]
+        edge_count = int(math.ceil(duration / self.tile_usec))
+        for tile in range(1, edge_count):
+            edge = FetchPlanner._snap(start + tile * self.tile_usec, sample_grid)
+            if edges[-1] < edge < end:
+                edges.append(edge)
+        edges.append(end)
+        return [(tile_start, tile_end - tile_start, False)
+                for tile_start, tile_end in zip(edges[:-1], edges[1:])]
+
+    def _known_gaps(self, dataset, start, duration, channels):
+        """
+        Returns the skippable gaps shared by channels in a request. There are none if
+        the channels do not share a sample grid.
+        """
+        gap_index = getattr(dataset, 'gap_index', None)
+        if not gap_index or not channels or not dataset._get_sample_grid(channels):
+            return []
+        return [(gap_start, gap_end) for gap_start, gap_end
+                in gap_index.common_gaps(channels, start, start + duration)
+                if gap_end - gap_start >= self.min_gap_usec]
+
+    def fetch(self, dataset, start, duration, channels, allocate=None):
+        """
+        Returns raw data from the IEEG platform as a (int_matrix, conversion_factors) tuple.
+
+        int_matrix is an int32 samples x channels array whose columns are in the
+        order of channels. Gaps keep the server's gap value.
+
+        :param dataset: The Dataset to read
+        :param start: Start time (usec)
+        :param duration: Number of usec to request samples from
+        :param channels: Integer indices of the channels we want
+        :param allocate: Optional function which returns the 1-D int32 storage for
+                         the given number of values. If channels are sorted and
+                         unique int_matrix is a view of this storage.
+        """
+        # IeegApi.get_data lists channels in dataset order, so only request
+        # each channel once and in sorted order, then reorder at the end.
+        requested = sorted(set(channels))
+        gaps = self._known_gaps(dataset, start, duration, requested)
+        sample_grid = dataset._get_sample_grid(requested) if requested else None
+        tile_rows = self.plan(start, duration, requested, gaps, sample_grid)
+        # The number of samples in each row, if the channels share a sample grid.
+        # Rows reaching the end of the recording may be short, so are not checked.
+        gap_lengths = [None] * len(tile_rows)
+        row_samples = [None] * len(tile_rows)
+        if sample_grid:
+            sample_rate, grid_offset = sample_grid
+            end_time = int(dataset.channel_table.values['end_time'][requested].max()
+                           ) - dataset.start_time
+            for row_index, row in enumerate(tile_rows):
+                tile_end = row[0].start + row[0].duration
+                length = (sample_index(tile_end - grid_offset, sample_rate)
+                          - sample_index(row[0].start - grid_offset, sample_rate))
+                if row[0].gap:
+                    gap_lengths[row_index] = length
+                elif tile_end < end_time:
+                    row_samples[row_index] = length
+
+        if all(length is not None for length in gap_lengths):
+            size = sum(gap_lengths) * len(requested)
+            storage = allocate(size) if allocate else np.empty(size, dtype=np.int32)
+            storage[:] = np.iinfo(np.int32).min
+            int_matrix = storage.reshape((len(requested), sum(gap_lengths))).T
+            conv_f = dataset.channel_table.values['voltage_conversion_factor'][requested]
+        elif len(tile_rows) == 1 and len(tile_rows[0]) == 1:
+            response = self.api.get_data(dataset, start, duration, requested, stream=True)
+            try:
+                int_matrix, conv_f = decode_response(response, len(requested), allocate)
+            finally:
+                response.close()
+        else:
+            futures = [[] if row[0].gap else
+                       [self.api.submit_get_data(dataset, tile.start, tile.duration,
+                                                 tile.channels)
+                        for tile in row]
+                       for row in tile_rows]
+            try:
+                responses = [[future.result() for future in row_futures]
+                             for row_futures in futures]
+            finally:
+                for row_futures in futures:
+                    for future in row_futures:
+                        future.cancel()
+            int_matrix, conv_f = self._stitch(tile_rows, responses, len(requested), allocate,
+                                              gap_lengths, row_samples)
+
+        if requested != list(channels):
+            position_by_channel = {channel: i for i, channel in enumerate(requested)}
+            positions = [position_by_channel[channel] for channel in channels]
+            return int_matrix[:, positions], conv_f[positions]
+        return int_matrix, conv_f
+
+    @staticmethod
+    def _stitch(tile_rows, responses, channel_count, allocate=None, gap_lengths=None,
+                row_samples=None):
+        """
+        Decodes tile responses directly into one samples x channels array.
+
+        :param gap_lengths: The number of samples of each row, if it is a skipped gap
+                            without responses, or None.
+        :param row_samples: The expected number of samples of each row, or None if
+                            it is not known. A row which differs, so that a sample would
+                            be duplicated or lost at a seam, raises IeegConnectionError.
+        """
+        gap_lengths = gap_lengths or [None] * len(tile_rows)
+        row_samples = row_samples or [None] * len(tile_rows)
+        headers = [[_read_headers(response) for response in row_responses]
+                   for row_responses in responses]
+        row_lengths = []
+        for row, row_headers, gap_length, expected in zip(tile_rows, headers, gap_lengths,
+                                                          row_samples):
+            if gap_length is not None:
+                row_lengths.append(gap_length)
+                continue
+            lengths = [samples_per_row for samples_per_row, _ in row_headers]
+            if any(length != lengths[0] for length in lengths):
+                raise IeegConnectionError(
+                    'Not all channels in response have equal length')
+            if expected is not None and lengths[0] != expected:
+                raise IeegConnectionError(
+                    'Tile at ' + str(row[0].start) + ' usec has ' + str(lengths[0])
+                    + ' samples, expected ' + str(expected))
+            row_lengths.append(lengths[0])
+
+        size = sum(row_lengths) * channel_count
+        storage = allocate(size) if allocate else np.empty(size, dtype=np.int32)
+        int_matrix = storage.reshape((channel_count, sum(row_lengths))).T
+        conv_f = np.empty(channel_count)
+        row_offset = 0
+        for row, row_responses, row_headers, row_length, gap_length in zip(
+                tile_rows, responses, headers, row_lengths, gap_lengths):
+            if gap_length is not None:
+                int_matrix[row_offset:row_offset + row_length] = np.iinfo(np.int32).min
+                row_offset += row_length
+                continue
+            for tile, response, (_, tile_conv_f) in zip(row, row_responses, row_headers):
+                tile_values = np.frombuffer(response.content, dtype='>i4')
+                _check_length(tile_values.size, row_length * len(tile.channels))
+                columns = slice(tile.column_offset,
+                                tile.column_offset + len(tile.channels))
+                # Converts from big-endian while copying.
+                int_matrix[row_offset:row_offset + row_length, columns] = np.reshape(
+                    tile_values, (row_length, len(tile.channels)), order='F')
+                conv_f[columns] = tile_conv_f
+            row_offset += row_length
+        return int_matrix, conv_f
@@ -0,0 +1,262 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import bisect
+import threading
+import numpy as np
+
+
+class Intervals:
+    """
+    A sorted list of disjoint [start, end) intervals.
+
+    Attributes:
+        starts: The interval starts in increasing order.
+        ends: The interval ends in increasing order.
+    """
+
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, pairs=()):
+        self.starts = []
+        self.ends = []
+        for start, end in pairs:
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def pairs(self):
+        """
+        Returns the intervals as a list of (start, end) tuples.
+        """
+        return list(zip(self.starts, self.ends))
+
+    def add(self, start, end):
+        """
+        Adds [start, end), merging it with the intervals it overlaps or touches.
+        """
+        if end <= start:
+            return
+        low = bisect.bisect_left(self.ends, start)
+        high = bisect.bisect_right(self.starts, end)
+        if low < high:
+            start = min(start, self.starts[low])
+            end = max(end, self.ends[high - 1])
+        self.starts[low:high] = [start]
+        self.ends[low:high] = [end]
+
+    def remove(self, start, end):
+        """
+        Removes [start, end), splitting an interval that extends past either side.
+        """
+        if end <= start:
+            return
+        low = bisect.bisect_right(self.ends, start)
+        high = bisect.bisect_left(self.starts, end)
+        if low >= high:
+            return
+        starts = []
+        ends = []
+        if self.starts[low] < start:
+            starts.append(self.starts[low])
+            ends.append(start)
+        if self.ends[high - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[high - 1])
+        self.starts[low:high] = starts
+        self.ends[low:high] = ends
+
+    def covers(self, start, end):
+        """
+        Returns True if [start, end) lies within a single interval.
+        """
+        index = bisect.bisect_right(self.starts, start) - 1
+        return index >= 0 and self.ends[index] >= end
+
+    def covers_each(self, starts, ends):
+        """
+        Returns a boolean array which is True where [starts[i], ends[i]) lies
+        within a single interval.
+        """
+        starts = np.asarray(starts, dtype=np.float64)
+        if not self.starts:
+            return np.zeros(starts.shape, dtype=bool)
+        indices = np.searchsorted(self.starts, starts, side='right') - 1
+        return (indices >= 0) & (np.asarray(self.ends)[np.maximum(indices, 0)]
+                                 >= np.asarray(ends, dtype=np.float64))
+
+    def clipped(self, start, end):
+        """
+        Returns the parts of the intervals within [start, end) as a new Intervals.
+        """
+        low = bisect.bisect_right(self.ends, start)
+        high = bisect.bisect_left(self.starts, end)
+        clipped = Intervals()
+        clipped.starts = [max(interval_start, start)
+                          for interval_start in self.starts[low:high]]
+        clipped.ends = [min(interval_end, end) for interval_end in self.ends[low:high]]
+        return clipped
+
+    def intersection(self, other):
+        """
+        Returns the intervals common to self and other as a new Intervals.
+        """
+        result = Intervals()
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            start = max(self.starts[i], other.starts[j])
+            end = min(self.ends[i], other.ends[j])
+            if start < end:
+                result.starts.append(start)
+                result.ends.append(end)
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def length(self, start, end):
+        """
+        Returns the total length of the intervals within [start, end).
+        """
+        clipped = self.clipped(start, end)
+        return sum(clipped.ends) - sum(clipped.starts)
+
+
+class GapIndex:
+    """
+    The gaps known in the channels of a Dataset, learned from the data read from it.
+
+    For each channel the index keeps the observed intervals, which have been read,
+    and the gap intervals within them, in microseconds from the dataset start.
+    A region which has not been read is never a known gap. The index is safe to
+    use from several threads.
+
+    Attributes:
+        changed: True if the index was updated since it was loaded or created.
+    """
+
+    def __init__(self):
+        self._observed = {}
+        self._gaps = {}
+        self._lock = threading.Lock()
+        self.changed = False
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, channel, start, end, gaps):
+        """
+        Records that channel was read over [start, end) and had the given gaps there.
+
+        :param channel: The channel key, such as its index in the Dataset
+        :param gaps: A list of (gap_start, gap_end) intervals within [start, end)
+        """
+        with self._lock:
+            observed = self._observed.setdefault(channel, Intervals())
+            channel_gaps = self._gaps.setdefault(channel, Intervals())
+            observed.add(start, end)
+            channel_gaps.remove(start, end)
+            for gap_start, gap_end in gaps:
+                channel_gaps.add(gap_start, gap_end)
+            self.changed = True
+
+    def get_gaps(self, channel):
+        """
+        Returns the known gaps of channel as a list of (start, end) tuples.
+        """
+        with self._lock:
+            channel_gaps = self._gaps.get(channel)
+            return channel_gaps.pairs() if channel_gaps else []
+
+    def is_gap(self, channels, start, end):
+        """
+        Returns True if [start, end) is a known gap of all of the given channels.
+        """
+        with self._lock:
+            return all(channel in self._gaps and self._gaps[channel].covers(start, end)
+                       for channel in channels)
+
+    def gap_windows(self, channels, starts, ends):
+        """
+        Returns a boolean array which is True for each window [starts[i], ends[i])
+        which is a known gap of all of the given channels.
+        """
+        result = np.ones(len(starts), dtype=bool)
+        with self._lock:
+            for channel in channels:
+                channel_gaps = self._gaps.get(channel)
+                if not channel_gaps:
+                    return np.zeros(len(starts), dtype=bool)
+                result &= channel_gaps.covers_each(starts, ends)
+        return result
+
+    def common_gaps(self, channels, start, end):
+        """
+        Returns the known gaps shared by all of the given channels within [start, end)
+        as a list of (start, end) tuples.
+        """
+        with self._lock:
+            common = None
+            for channel in channels:
+                channel_gaps = self._gaps.get(channel)
+                if not channel_gaps:
+                    return []
+                clipped = channel_gaps.clipped(start, end)
+                common = clipped if common is None else common.intersection(clipped)
+            return common.pairs() if common else []
+
+    def coverage(self, channel, start, end):
+        """
+        Returns the fraction of [start, end) in which channel is known to have data,
+        that is, which has been read and is not a gap.
+        """
+        if end <= start:
+            return 0.0
+        with self._lock:
+            observed = self._observed.get(channel)
+            if not observed:
+                return 0.0
+            data_length = observed.length(start, end) - self._gaps[channel].length(start, end)
+        return data_length / (end - start)
+
+    def to_json(self, key_function=str):
+        """
+        Returns the index as a JSON-serializable dict keyed by key_function(channel).
+        """
+        with self._lock:
+            return {key_function(channel): {'observed': self._observed[channel].pairs(),
+                                            'gaps': self._gaps[channel].pairs()}
+                    for channel in self._observed}
+
+    def load_json(self, entries, channel_function):
+        """
+        Adds the channels of a dict returned by to_json. channel_function maps each
+        key to its channel, or to None to leave the entry out.
+        """
+        with self._lock:
+            for key, entry in entries.items():
+                channel = channel_function(key)
+                if channel is None:
+                    continue
+                self._observed[channel] = Intervals(entry['observed'])
+                self._gaps[channel] = Intervals(entry['gaps'])
@@ -13,8 +13,12 @@
  See the License for the specific language governing permissions and
  limitations under the License.
 '''
+import collections
+import threading
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from ieeg.ieeg_auth import IeegAuth
 
 
@@ -43,8 +47,13 @@ class IeegApi:
         'Content-Type': _json_content, 'Accept': _json_content}
 
     def __init__(self, username, password,
-                 use_https=True, host='www.ieeg.org', port=None, verify_ssl=True):
+                 use_https=True, host='www.ieeg.org', port=None, verify_ssl=True,
+                 max_workers=4):
         self.http = requests.Session()
+        # Make sure concurrent requests do not have to wait on the connection pool.
+        adapter = HTTPAdapter(pool_maxsize=max(max_workers, 10))
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
         self.http.hooks['response'].append(
             IeegApi.raise_ieeg_exception)
         self.http.auth = IeegAuth(username, password)
@@ -54,6 +63,9 @@ class IeegApi:
         self.port = port
         authority = host + ':' + str(port) if port else host
         self.base_url = self.scheme + '://' + authority + '/services'
+        self.max_workers = max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
     @staticmethod
     def raise_ieeg_exception(response, *args, **kwargs):
@@ -79,8 +91,22 @@ class IeegApi:
         """
         Closes HTTP resources
         """
+        with self._executor_lock:
+            if self._executor:
+                self._executor.shutdown(wait=False)
+                self._executor = None
         self.http.close()
 
+    def _get_executor(self):
+        """
+        Returns the thread pool used for concurrent requests, creating it if necessary.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='ieeg-api')
+            return self._executor
+
     def get_dataset_id_by_name(self, dataset_name):
         """
         Returns a Response with a dataset's id given its name
@@ -156,37 +182,41 @@ class IeegApi:
             url_str, headers=IeegApi._accept_json, params=params)
         return response
 
-    def get_data(self, dataset, start, duration, channels):
+    def get_data(self, dataset, start, duration, channels, stream=False):
         """
         Returns data from the IEEG platform
         :param start: Start time (usec)
         :param duration: Number of usec to request samples from
         :param channels: Integer indices of the channels we want
+        :param stream: If True the body is not read until the caller iterates over
+                       it, and the caller must close the Response.
         :return: a Response with binary content.
         """
-        # Build Data Content XML
-        wrapper1 = ET.Element('timeSeriesIdAndDChecks')
-        wrapper2 = ET.SubElement(wrapper1, 'timeSeriesIdAndDChecks')
-        i = 0
-        for ts_details in dataset.ts_array:
-            if i in channels:
-                el1 = ET.SubElement(wrapper2, 'timeSeriesIdAndCheck')
-                el2 = ET.SubElement(el1, 'dataCheck')
-                el2.text = ts_details.findall('dataCheck')[0].text
-                el3 = ET.SubElement(el1, 'id')
-                el3.text = ts_details.findall('revisionId')[0].text
-            i += 1
-
-        data = ET.tostring(wrapper1, encoding="us-ascii",
-                           method="xml").decode('utf-8')
-        data = '<?xml version="1.0" encoding="UTF-8" standalone="no"?>' + data
+        url_str, params, data = IeegApi._get_data_request(
+            self.base_url, dataset, start, duration, channels)
 
+        response = self.http.post(url_str, params=params, data=data,
+                                  headers=IeegApi._send_xml, stream=stream)
+        return response
+
+    @staticmethod
+    def _get_data_request(base_url, dataset, start, duration, channels):
+        """
+        Returns the (url, query parameters, XML body) of a get_data request.
+        """
+        data = dataset.data_request_bodies.get(channels)
         params = {'start': start, 'duration': duration}
-        url_str = self.base_url + IeegApi._get_data_path + dataset.snap_id
+        url_str = base_url + IeegApi._get_data_path + dataset.snap_id
+        return url_str, params, data
 
-        response = self.http.post(url_str,
-                                  params=params, data=data, headers=IeegApi._send_xml)
-        return response
+    def submit_get_data(self, dataset, start, duration, channels):
+        """
+        Schedules get_data(dataset, start, duration, channels) on this IeegApi's
+        bounded thread pool.
+
+        :return: a concurrent.futures.Future for a Response with binary content.
+        """
+        return self._get_executor().submit(self.get_data, dataset, start, duration, channels)
 
     def get_montages(self, dataset_id):
         """
@@ -202,7 +232,27 @@ class IeegApi:
         Adds annotations to the given snapshot.
         :returns: a Response with String body (the datset id)
         """
+        request_body = IeegApi._add_annotations_body(dataset, annotations)
+        url_str = self.base_url + IeegApi._add_annotations_path + dataset.snap_id
+        response = self.http.post(url_str,
+                                  json=request_body,
+                                  headers=IeegApi._send_accept_json)
+        return response
+
+    @staticmethod
+    def _add_annotations_body(dataset, annotations):
+        """
+        Returns the JSON body of an add_annotations request.
+        """
         # request_body is oddly verbose because it was originally designed as XML.
+        if hasattr(annotations, 'to_json'):
+            # An ieeg.dataset.AnnotationTable
+            if annotations.parent != dataset:
+                raise ValueError(
+                    'Annotation does not belong to this dataset. It belongs to dataset '
+                    + annotations.parent.snap_id)
+            ts_annotations, ts_revids = annotations.to_json()
+            return IeegApi._annotations_request_body(dataset, ts_annotations, ts_revids)
         ts_revids = set()
         ts_annotations = []
         for annotation in annotations:
@@ -225,10 +275,17 @@ class IeegApi:
                 ts_annotation['revId'] = annotation.portal_id
             ts_annotations.append(ts_annotation)
             ts_revids.update(annotated_revids)
+        return IeegApi._annotations_request_body(dataset, ts_annotations, ts_revids)
 
+    @staticmethod
+    def _annotations_request_body(dataset, ts_annotations, ts_revids):
+        """
+        Returns the JSON body of an add_annotations request with the given annotation
+        records, which annotate the channels with the given revisionIds.
+        """
         timeseries = [{'revId': ts_revid, 'label': dataset.ts_details_by_id[ts_revid].channel_label}
                       for ts_revid in ts_revids]
-        request_body = {'timeseriesannotations': {
+        return {'timeseriesannotations': {
             'timeseries': {
                 'timeseries': timeseries
             },
@@ -236,11 +293,6 @@ class IeegApi:
                 'annotation': ts_annotations
             }
         }}
-        url_str = self.base_url + IeegApi._add_annotations_path + dataset.snap_id
-        response = self.http.post(url_str,
-                                  json=request_body,
-                                  headers=IeegApi._send_accept_json)
-        return response
 
     def move_annotation_layer(self, dataset, from_layer, to_layer):
         """
@@ -273,6 +325,65 @@ class IeegApi:
         return response
 
 
+class DataRequestBodies:
+    """
+    The XML bodies of get_data requests for one dataset.
+
+    Each channel's timeSeriesIdAndCheck element is serialized once, and the bodies
+    for recently requested channel sets are kept, so that repeated requests for the
+    same channels do no XML work.
+
+    Attributes:
+        max_entries: The maximum number of channel sets whose bodies are kept.
+    """
+
+    def __init__(self, revision_ids, data_checks, max_entries=256):
+        self.max_entries = max_entries
+        self._fragments = []
+        for revision_id, data_check in zip(revision_ids, data_checks):
+            el1 = ET.Element('timeSeriesIdAndCheck')
+            el2 = ET.SubElement(el1, 'dataCheck')
+            el2.text = data_check
+            el3 = ET.SubElement(el1, 'id')
+            el3.text = revision_id
+            self._fragments.append(ET.tostring(el1, encoding="us-ascii",
+                                               method="xml").decode('utf-8'))
+        self._bodies = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'max_entries': self.max_entries, '_fragments': self._fragments}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bodies = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, channels):
+        """
+        Returns the XML body requesting the given channel indices. The channels are
+        listed once each, in dataset order.
+        """
+        key = frozenset(channels)
+        with self._lock:
+            data = self._bodies.get(key)
+            if data is not None:
+                self._bodies.move_to_end(key)
+                return data
+
+        fragments = [self._fragments[i] for i in sorted(key)
+                     if 0 <= i < len(self._fragments)]
+        inner = ('<timeSeriesIdAndDChecks>' + ''.join(fragments) + '</timeSeriesIdAndDChecks>'
+                 if fragments else '<timeSeriesIdAndDChecks />')
+        data = ('<?xml version="1.0" encoding="UTF-8" standalone="no"?>'
+                + '<timeSeriesIdAndDChecks>' + inner + '</timeSeriesIdAndDChecks>')
+        with self._lock:
+            self._bodies[key] = data
+            while len(self._bodies) > self.max_entries:
+                self._bodies.popitem(last=False)
+        return data
+
+
 class IeegConnectionError(Exception):
     """
     A simple exception for connectivity errors
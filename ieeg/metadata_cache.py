@@ -0,0 +1,176 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+from collections import namedtuple
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+CachedDataset = namedtuple(
+    'CachedDataset', ['snapshot_id', 'time_series_details', 'json_montages', 'fetched_time'])
+
+
+class MetadataCache:
+    """
+    An opt-in, on-disk cache of the metadata fetched by Session.open_dataset and
+    Dataset.get_annotation_layers, and of the gaps learned by Dataset.gap_index.
+
+    Dataset metadata is keyed by dataset name and annotation layer counts by snapshot id.
+    Dataset entries younger than ttl_sec are used without contacting the IEEG platform.
+    Older ones are revalidated by Session.open_dataset with one request for the time
+    series details, and are fetched again in full only if a channel's dataCheck changed.
+    An entry is also dropped when the IEEG platform rejects a data request for the
+    dataset, for example because of a changed dataCheck. Annotation layer counts
+    change whenever anyone annotates the dataset, so they are only kept for
+    layers_ttl_sec. Gaps are saved by Session.close_dataset and are kept for as long as
+    the channel's dataCheck does not change.
+
+        cache = MetadataCache('/data/ieeg-metadata', ttl_sec=3600)
+        with Session(username, password, metadata_cache=cache) as session:
+            ...
+
+    Attributes:
+        directory: The directory holding the cached metadata.
+        ttl_sec: The number of seconds for which dataset metadata is used without validation.
+        layers_ttl_sec: The number of seconds for which annotation layer counts are used.
+    """
+
+    def __init__(self, directory, ttl_sec=24 * 3600, layers_ttl_sec=60):
+        if ttl_sec < 0 or layers_ttl_sec < 0:
+            raise ValueError('ttl_sec and layers_ttl_sec must not be negative')
+        self.directory = directory
+        self.ttl_sec = ttl_sec
+        self.layers_ttl_sec = layers_ttl_sec
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, key):
+        file_name = kind + '-' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+        return os.path.join(self.directory, file_name)
+
+    def _read(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            # Missing, or partly written by an older version.
+            return None
+
+    def _write(self, path, entry):
+        """
+        Atomically writes entry to path as JSON.
+        """
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as temp_file:
+            json.dump(entry, temp_file)
+        os.replace(temp_path, path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def is_fresh(self, fetched_time, ttl_sec=None):
+        """
+        Returns True if an entry fetched at fetched_time can be used without validation.
+
+        :param ttl_sec: The entry's time to live, ttl_sec by default
+        """
+        return time.time() - fetched_time < (self.ttl_sec if ttl_sec is None else ttl_sec)
+
+    def get_dataset(self, name):
+        """
+        Returns the CachedDataset for the named dataset, or None if there is none.
+        The entry may be stale. See is_fresh.
+        """
+        entry = self._read(self._path('dataset', name))
+        if entry is None or entry.get('name') != name:
+            return None
+        return CachedDataset(entry['snapshot_id'], entry['time_series_details'],
+                             entry['json_montages'], entry['fetched_time'])
+
+    def put_dataset(self, name, snapshot_id, time_series_details, json_montages):
+        """
+        Stores the metadata of the named dataset.
+
+        :param time_series_details: The getDataSnapshotTimeSeriesDetails response body as a str
+        :param json_montages: The list of JSON montages
+        """
+        self._write(self._path('dataset', name),
+                    {'name': name,
+                     'snapshot_id': snapshot_id,
+                     'time_series_details': time_series_details,
+                     'json_montages': json_montages,
+                     'fetched_time': time.time()})
+
+    def invalidate_dataset(self, name):
+        """
+        Removes the named dataset's metadata.
+        """
+        self._remove(self._path('dataset', name))
+
+    def get_annotation_layers(self, snapshot_id):
+        """
+        Returns the cached annotation layer counts of the given snapshot,
+        or None if there are none or they are older than layers_ttl_sec.
+        """
+        entry = self._read(self._path('layers', snapshot_id))
+        if (entry is None or entry.get('snapshot_id') != snapshot_id
+                or not self.is_fresh(entry['fetched_time'], self.layers_ttl_sec)):
+            return None
+        return entry['layers']
+
+    def put_annotation_layers(self, snapshot_id, layers):
+        """
+        Stores the annotation layer counts of the given snapshot.
+        """
+        self._write(self._path('layers', snapshot_id),
+                    {'snapshot_id': snapshot_id, 'layers': layers, 'fetched_time': time.time()})
+
+    def invalidate_annotation_layers(self, snapshot_id):
+        """
+        Removes the annotation layer counts of the given snapshot.
+        Called when annotations are added, moved or deleted.
+        """
+        self._remove(self._path('layers', snapshot_id))
+
+    def get_gaps(self, snapshot_id):
+        """
+        Returns the cached gap index entries of the given snapshot as a dict mapping
+        channel revisionIds to entries with a data_check, or an empty dict.
+        """
+        entry = self._read(self._path('gaps', snapshot_id))
+        if entry is None or entry.get('snapshot_id') != snapshot_id:
+            return {}
+        return entry['channels']
+
+    def put_gaps(self, snapshot_id, channels):
+        """
+        Stores the gap index entries of the given snapshot.
+
+        :param channels: A dict mapping channel revisionIds to entries with a data_check
+        """
+        self._write(self._path('gaps', snapshot_id),
+                    {'snapshot_id': snapshot_id, 'channels': channels})
+
+    def clear(self):
+        """
+        Removes all cached metadata.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
@@ -13,9 +13,15 @@
  See the License for the specific language governing permissions and
  limitations under the License.
 '''
+import collections
 import math
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 from pennprov.metadata.stream_metadata import BasicTuple, BasicSchema
+from ieeg.block_cache import sample_index
+from ieeg.window_reducers import WindowReducer
 
 class Window:
     """
@@ -30,6 +36,8 @@ class Window:
         window_index: The index of this window in the stream of windows to which it belongs.
         window_start_usec: The microsecond offset into dataset of this window.
         window_size_usec: The length of this window in microseconds.
+        annotation_index: An optional ieeg.annotation_index.AnnotationIndex of the
+                          annotations to show through the annotations property.
     """
 
     def __init__(self,
@@ -38,13 +46,378 @@ class Window:
                  data_block,
                  window_index,
                  window_start_usec,
-                 window_size_usec):
+                 window_size_usec,
+                 annotation_index=None):
         self.dataset = dataset
         self.input_channel_labels = input_channel_labels
         self.data_block = data_block
         self.window_index = window_index
         self.window_start_usec = window_start_usec
         self.window_size_usec = window_size_usec
+        self.annotation_index = annotation_index
+
+    @property
+    def annotations(self):
+        """
+        The ieeg.dataset.AnnotationTable of the annotations in annotation_index which
+        overlap this window on any of its input channels, or None if there is no index.
+        """
+        if self.annotation_index is None:
+            return None
+        channel_indices = [self.dataset.channel_index_by_label.get(label)
+                           for label in self.input_channel_labels]
+        rows = self.annotation_index.overlapping(
+            self.window_start_usec, self.window_start_usec + self.window_size_usec,
+            # Montage pair labels are not channels, so all channels are searched.
+            None if None in channel_indices else channel_indices)
+        return self.annotation_index.table[rows]
+
+class SlidingWindowBlocks:
+    """
+    Reads the windows of a sliding window run over a Dataset in large contiguous blocks.
+
+    Iterating yields (first_window_index, windows) pairs where windows is a read-only
+    windows x samples x channels array. When the window starts fall on a regular
+    sample stride, windows is a zero-copy view into the block. If window_size_usec is
+    not a whole number of samples the windows differ in length, and windows is instead
+    a list of read-only samples x channels views. The samples shared by the last
+    windows of one block and the first windows of the next are carried over instead
+    of being fetched again.
+
+    Each block is read with Dataset.get_samples directly into a block buffer
+    allocated for it. If reuse_buffer is True a single buffer of block size is
+    allocated once and refilled instead, so that a block and its windows are only
+    valid until the next block is read.
+
+    Windows end at the end of the recording, so the last windows may be shorter than
+    the others, just as get_data returns fewer samples past the end.
+
+    If the channels do not share a sample rate and start time, each window is
+    read with its own get_data call and yielded as a block of one window.
+
+    If skip_gaps is True, windows which are known gaps of all of the channels
+    in the Dataset's gap_index are not read or yielded. Blocks end before them.
+
+    Attributes:
+        dataset: The ieeg.dataset.Dataset being read.
+        channel_indices: The channel indices passed to get_data.
+        window_count: The number of windows.
+        window_starts_usec: The start offset in microseconds of each window.
+        window_size_usec: The length of each window in microseconds.
+        block_usec: The approximate length of each fetched block in microseconds.
+        reuse_buffer: True if every block is read into the same buffer.
+        skip_gaps: True if windows in known gaps are skipped.
+    """
+
+    default_block_usec = 60 * 1000000
+
+    def __init__(self, dataset, channel_indices, start_time_usec, window_size_usec,
+                 slide_usec, window_count, block_usec=None, reuse_buffer=False,
+                 skip_gaps=False):
+        self.dataset = dataset
+        self.channel_indices = channel_indices
+        self.window_count = window_count
+        self.window_starts_usec = [start_time_usec + window * slide_usec
+                                   for window in range(window_count)]
+        self.window_size_usec = window_size_usec
+        self.block_usec = block_usec or SlidingWindowBlocks.default_block_usec
+        self.reuse_buffer = reuse_buffer
+        self.skip_gaps = skip_gaps
+        self._block_buffer = None
+
+        self._montage = dataset.get_current_montage()
+        self._raw_channels = self._montage.get_raw_channels(
+            channel_indices) if self._montage else channel_indices
+        self.sample_grid = dataset._get_sample_grid(self._raw_channels)
+        if self.sample_grid:
+            sample_rate, grid_offset = self.sample_grid
+            self._first_sample = sample_index(start_time_usec - grid_offset, sample_rate)
+            self._window_rows = np.array(
+                [sample_index(window_start - grid_offset, sample_rate) - self._first_sample
+                 for window_start in self.window_starts_usec], dtype=np.int64)
+            self._window_end_rows = np.array(
+                [sample_index(window_start + window_size_usec - grid_offset, sample_rate)
+                 - self._first_sample
+                 for window_start in self.window_starts_usec], dtype=np.int64)
+            end_time = int(dataset.channel_table.values['end_time'][
+                list(self._raw_channels)].max()) - dataset.start_time
+            end_row = sample_index(end_time - grid_offset, sample_rate) - self._first_sample
+            np.minimum(self._window_rows, end_row, out=self._window_rows)
+            np.minimum(self._window_end_rows, end_row, out=self._window_end_rows)
+            window_lengths = self._window_end_rows - self._window_rows
+            self.window_samples = int(window_lengths.max()) if window_count else 0
+            self.uniform_windows = bool(np.all(window_lengths == self.window_samples))
+            self._block_samples = max(int(self.block_usec * sample_rate / 1e6),
+                                      self.window_samples, 1)
+
+    def __iter__(self):
+        for first_window, buffer, window_rows, window_end_rows in self.iter_buffers():
+            yield first_window, cut_windows(buffer, window_rows, window_end_rows)
+
+    def iter_buffers(self):
+        """
+        Yields (first_window_index, buffer, window_rows, window_end_rows) tuples where
+        buffer is a samples x channels block and window i of the block is
+        buffer[window_rows[i]:window_end_rows[i]].
+        """
+        skipped = self._skipped_windows()
+        if not self.sample_grid:
+            for window, window_start in enumerate(self.window_starts_usec):
+                if skipped[window]:
+                    continue
+                data_block = self.dataset.get_data(window_start, self.window_size_usec,
+                                                   self.channel_indices, montage=self._montage)
+                yield window, data_block, np.array([0]), np.array([data_block.shape[0]])
+            return
+
+        buffer = None
+        buffer_first_row = 0
+        first_window = 0
+        while first_window < self.window_count:
+            if skipped[first_window]:
+                remaining = skipped[first_window:]
+                if remaining.all():
+                    return
+                first_window += int(np.argmin(remaining))
+            # Take as many windows as fit in a block, but always at least one.
+            block_end_row = self._window_rows[first_window] + self._block_samples
+            last_window = int(np.searchsorted(
+                self._window_end_rows, block_end_row, side='right'))
+            last_window = min(max(last_window, first_window + 1), self.window_count)
+            next_skipped = np.flatnonzero(skipped[first_window:last_window])
+            if len(next_skipped):
+                last_window = first_window + int(next_skipped[0])
+
+            needed_first_row = self._window_rows[first_window]
+            needed_end_row = self._window_end_rows[first_window:last_window].max()
+            buffer = self._extend(buffer, buffer_first_row, needed_first_row, needed_end_row)
+            buffer_first_row = needed_first_row
+
+            yield (first_window, buffer,
+                   self._window_rows[first_window:last_window] - buffer_first_row,
+                   self._window_end_rows[first_window:last_window] - buffer_first_row)
+            first_window = last_window
+
+    def _skipped_windows(self):
+        """
+        Returns a boolean array which is True for the windows to skip.
+        """
+        if not self.skip_gaps:
+            return np.zeros(self.window_count, dtype=bool)
+        window_starts = np.asarray(self.window_starts_usec, dtype=np.float64)
+        return self.dataset.gap_index.gap_windows(self._raw_channels, window_starts,
+                                                  window_starts + self.window_size_usec)
+
+    def _extend(self, buffer, buffer_first_row, needed_first_row, needed_end_row):
+        """
+        Returns a buffer holding rows [needed_first_row, needed_end_row), reusing
+        the overlapping rows of the previous buffer.
+        """
+        row_count = needed_end_row - needed_first_row
+        carried_count = 0
+        if buffer is not None:
+            carried_count = min(max(buffer_first_row + buffer.shape[0] - needed_first_row, 0),
+                                row_count)
+        shape = (row_count, len(self.channel_indices))
+        if self.reuse_buffer:
+            # A block never needs more than _block_samples rows.
+            if self._block_buffer is None:
+                self._block_buffer = np.empty(
+                    (self._block_samples, shape[1]), order='F')
+            extended = self._block_buffer[:row_count]
+        else:
+            extended = np.empty(shape, order='F')
+        if carried_count:
+            # numpy copies overlapping memory correctly, as when reusing the buffer.
+            offset = needed_first_row - buffer_first_row
+            extended[:carried_count] = buffer[offset:offset + carried_count]
+        if carried_count < row_count:
+            self.dataset.get_samples(self._first_sample + needed_first_row + carried_count,
+                                     row_count - carried_count, self.channel_indices,
+                                     out=extended[carried_count:], montage=self._montage)
+        return extended
+
+
+def cut_windows(buffer, window_rows, window_end_rows):
+    """
+    Returns the windows buffer[window_rows[i]:window_end_rows[i]] as a read-only
+    windows x samples x channels array, which is a zero-copy view if the windows
+    start at a regular stride. If the windows differ in length a list of read-only
+    samples x channels views is returned instead.
+    """
+    read_only = buffer.view()
+    read_only.setflags(write=False)
+    window_lengths = np.asarray(window_end_rows) - np.asarray(window_rows)
+    if np.any(window_lengths != window_lengths[0]):
+        return [read_only[window_row:window_end_row]
+                for window_row, window_end_row in zip(window_rows, window_end_rows)]
+    all_windows = np.lib.stride_tricks.sliding_window_view(
+        read_only, int(window_lengths[0]), axis=0)
+    steps = np.diff(window_rows)
+    if len(steps) == 0 or (steps[0] > 0 and np.all(steps == steps[0])):
+        step = int(steps[0]) if len(steps) else 1
+        windows = all_windows[window_rows[0]:window_rows[-1] + 1:step]
+    else:
+        windows = all_windows[window_rows]
+    return windows.transpose(0, 2, 1)
+
+
+# Per-process state of process pool workers, set by _init_window_worker.
+_worker_state = {}
+
+
+def _init_window_worker(block_function, pickled_block_args):
+    _worker_state['block_function'] = block_function
+    _worker_state['block_args'] = pickle.loads(pickled_block_args)
+
+
+def _run_window_task(shared_memory_name, shape, dtype, window_rows, window_end_rows,
+                     first_window):
+    """
+    Runs the worker's block function over windows of a block held in shared memory.
+    """
+    block = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        buffer = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        windows = cut_windows(buffer, window_rows, window_end_rows)
+        results = _worker_state['block_function'](
+            _worker_state['block_args'], first_window, windows)
+        # Results must not refer to the shared memory once it is closed.
+        results = [np.array(result) if isinstance(result, np.ndarray) else result
+                   for result in results]
+        del windows, buffer
+    finally:
+        block.close()
+    return results
+
+
+def run_blocks_in_process_pool(blocks, block_function, block_args, max_workers):
+    """
+    Runs block_function(block_args, first_window_index, windows) over the windows of
+    blocks in a pool of max_workers processes. block_function must return one result
+    per window and, like block_args, must be picklable.
+
+    Each block is copied once into shared memory and its windows are split among the
+    workers. At most max_workers blocks are in flight at a time. A Dataset in block_args
+    is pickled without its session, so reading from it in a worker raises AttributeError.
+
+    Yields (first_window_index, buffer, window_rows, window_end_rows, results) tuples
+    in block order, where results holds one result per window of the block.
+    """
+    pending = collections.deque()
+
+    def finish(block):
+        first_window, buffer, window_rows, window_end_rows, shared, futures = block
+        try:
+            results = []
+            for future in futures:
+                results.extend(future.result())
+        finally:
+            shared.close()
+            shared.unlink()
+        return first_window, buffer, window_rows, window_end_rows, results
+
+    # block_args are pickled even when workers are forked, so that they never share
+    # the parent's session and its connections.
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_window_worker,
+                             initargs=(block_function, pickle.dumps(block_args))) as pool:
+        try:
+            for first_window, buffer, window_rows, window_end_rows in blocks.iter_buffers():
+                buffer = np.ascontiguousarray(buffer)
+                shared = shared_memory.SharedMemory(create=True, size=max(buffer.nbytes, 1))
+                shared_buffer = np.ndarray(buffer.shape, dtype=buffer.dtype, buffer=shared.buf)
+                shared_buffer[...] = buffer
+                del shared_buffer
+                task_size = int(math.ceil(len(window_rows) / max_workers))
+                futures = [pool.submit(_run_window_task, shared.name, buffer.shape,
+                                       buffer.dtype.str, window_rows[task:task + task_size],
+                                       window_end_rows[task:task + task_size],
+                                       first_window + task)
+                           for task in range(0, len(window_rows), task_size)]
+                pending.append((first_window, buffer, window_rows, window_end_rows,
+                                shared, futures))
+                while len(pending) > max_workers:
+                    yield finish(pending.popleft())
+            while pending:
+                yield finish(pending.popleft())
+        finally:
+            while pending:
+                _, _, _, _, shared, futures = pending.popleft()
+                for future in futures:
+                    future.cancel()
+                for future in futures:
+                    if not future.cancelled():
+                        future.exception()
+                shared.close()
+                shared.unlink()
+
+
+def _make_window(window_args, window_index, data_block, input_channel_labels):
+    """
+    Returns the Window passed to a computation when the executor has an annotation_index.
+    """
+    (dataset, _, start_time_usec, slide_usec, window_size_usec,
+     annotation_index) = window_args
+    return Window(dataset, input_channel_labels, data_block, window_index,
+                  start_time_usec + window_index * slide_usec, window_size_usec,
+                  annotation_index)
+
+
+def _window_args(dataset, channel_labels, start_time_usec, slide_usec, window_size_usec,
+                 annotation_index, computation, batch):
+    """
+    Returns the arguments of _make_window for an executor, or None if it has no
+    annotation_index.
+    """
+    if annotation_index is None:
+        return None
+    if batch or isinstance(computation, WindowReducer):
+        raise ValueError('annotation_index cannot be used with batch or a WindowReducer')
+    return (dataset, list(channel_labels), start_time_usec, slide_usec, window_size_usec,
+            annotation_index)
+
+
+def _per_channel_block(block_args, first_window, windows):
+    """
+    Returns the per channel results of a block of windows as a windows x channels array.
+    """
+    per_channel_computation, batch, channel_count, window_args = block_args
+    if window_args:
+        channel_labels = window_args[1]
+        return np.array([[per_channel_computation(_make_window(
+            window_args, first_window + offset, matrix[:, column:column + 1],
+            [channel_labels[column]]))
+                          for column in range(matrix.shape[1])]
+                         for offset, matrix in enumerate(windows)])
+    if batch:
+        x = _compute_batch(per_channel_computation, windows)
+        if x.shape != (len(windows), channel_count):
+            raise ValueError('Batched per_channel_computation returned shape '
+                             + str(x.shape) + ', expected '
+                             + str((len(windows), channel_count)))
+        return x
+    return np.array([[per_channel_computation(channel) for channel in matrix.T]
+                     for matrix in windows])
+
+
+def _across_channels_block(block_args, first_window, windows):
+    """
+    Returns the list of results of a block of windows.
+    """
+    per_block_computation, batch, window_args = block_args
+    if window_args:
+        return [per_block_computation(_make_window(window_args, first_window + offset, matrix,
+                                                   window_args[1]))
+                for offset, matrix in enumerate(windows)]
+    if batch:
+        x = list(_compute_batch(per_block_computation, windows))
+        if len(x) != len(windows):
+            raise ValueError('Batched per_block_computation returned '
+                             + str(len(x)) + ' results, expected '
+                             + str(len(windows)))
+        return x
+    return [per_block_computation(matrix) for matrix in windows]
+
 
 class ProcessSlidingWindowPerChannel:
     """
@@ -72,49 +445,106 @@ class ProcessSlidingWindowPerChannel:
     @staticmethod
     def execute(dataset, channel_list,
                 start_time_usec, window_size_usec, slide_usec, duration_usec,
-                per_channel_computation):
+                per_channel_computation, block_usec=None, batch=False, max_workers=None,
+                skip_gaps=False, annotation_index=None):
         """
         Access a sliding window over a subset of channels, do a single computation
         over each channel separately, and repeat for the duration
 
+        Windows are read in blocks of about block_usec microseconds.
+
+        If batch is True, per_channel_computation is called once per block with a
+        windows x samples x channels array and must return a windows x channels array,
+        for example lambda windows: np.mean(windows, axis=1).
+
+        If max_workers is set, windows are computed in a pool of that many processes.
+        per_channel_computation must then be picklable, so it should be a module level
+        function rather than a lambda. The result is the same as in serial mode.
+        Datasets copied to the workers have no session, so per_channel_computation
+        cannot read data or annotations from the IEEG platform there.
+
+        per_channel_computation can also be an ieeg.window_reducers.WindowReducer such as
+        Mean() or LineLength(), which computes all windows of a block from running sums
+        in time proportional to the number of samples. batch and max_workers are then
+        not used.
+
+        If skip_gaps is True, windows which are known gaps of all channels (see
+        Dataset.get_gaps) are neither read nor computed, and their results are np.nan.
+
+        If annotation_index, an ieeg.annotation_index.AnnotationIndex, is given,
+        per_channel_computation is called with a Window of one channel instead of its
+        samples. The Window's data_block holds the samples as an n x 1 array and its
+        annotations property the annotations which overlap the window on that channel.
+        annotation_index cannot be used with batch or a WindowReducer.
+
         Returns a 2D matrix
         """
         return ProcessSlidingWindowPerChannel.execute_with_provenance(dataset, channel_list, start_time_usec, window_size_usec, slide_usec,
-                                            duration_usec, per_channel_computation, None, None, None)
+                                            duration_usec, per_channel_computation, None, None, None,
+                                            block_usec=block_usec, batch=batch,
+                                            max_workers=max_workers, skip_gaps=skip_gaps,
+                                            annotation_index=annotation_index)
 
     @staticmethod
     def execute_with_provenance(dataset, channel_list,
                                 start_time_usec, window_size_usec, slide_usec, duration_usec,
-                                per_channel_computation, mprov_connection, op_name, in_name):
+                                per_channel_computation, mprov_connection, op_name, in_name,
+                                block_usec=None, batch=False, max_workers=None,
+                                skip_gaps=False, annotation_index=None):
         channel_indices = dataset.get_channel_indices(channel_list)
+        window_args = _window_args(dataset, channel_list, start_time_usec, slide_usec,
+                                   window_size_usec, annotation_index,
+                                   per_channel_computation, batch)
+        window_count = max(int(math.ceil(duration_usec / slide_usec)), 1)
+        # Every block is reduced to a results array before the next one is read,
+        # so the block buffer can be reused.
+        blocks = SlidingWindowBlocks(dataset, channel_indices, start_time_usec,
+                                     window_size_usec, slide_usec, window_count, block_usec,
+                                     reuse_buffer=True, skip_gaps=skip_gaps)
 
-        # 0th window
-        start_index = start_time_usec
-
-        matrix = dataset.get_data(start_index, window_size_usec, channel_indices)
-        ret = np.reshape(np.array([per_channel_computation(channel) for channel in matrix.T]),
-                         (len(channel_indices), 1))
-
-        if mprov_connection:
-            ProcessSlidingWindowPerChannel.write_window_annot(mprov_connection, in_name, 0, window_size_usec,
-                                    op_name, ret.shape[1] - 1, '')
-
-        for window in range(1, int(math.ceil(duration_usec / slide_usec))):
-            start_index = start_time_usec + window * slide_usec
+        block_args = (per_channel_computation, batch, len(channel_indices), window_args)
+        if isinstance(per_channel_computation, WindowReducer):
+            block_results = ((first_window, per_channel_computation.reduce(
+                buffer, window_rows, window_end_rows))
+                             for first_window, buffer, window_rows, window_end_rows
+                             in blocks.iter_buffers())
+        elif max_workers:
+            block_results = ((first_window, np.asarray(results))
+                             for first_window, _, _, _, results
+                             in run_blocks_in_process_pool(blocks, _per_channel_block,
+                                                           block_args, max_workers))
+        else:
+            block_results = ((first_window, _per_channel_block(block_args, first_window, windows))
+                             for first_window, windows in blocks)
 
-            matrix = dataset.get_data(start_index, window_size_usec, channel_indices)
-            x = np.reshape(np.array([per_channel_computation(channel) for channel in matrix.T]),
-                           (len(channel_indices), 1))
-
-            ret = np.hstack((ret, x))
+        ret = np.full((len(channel_indices), window_count), np.nan) if skip_gaps else None
+        for first_window, x in block_results:
+            if ret is None:
+                ret = np.empty((len(channel_indices), window_count), dtype=x.dtype)
+            elif not np.can_cast(x.dtype, ret.dtype):
+                # Promote the results so far as concatenating them would.
+                ret = ret.astype(np.result_type(ret.dtype, x.dtype))
+            ret[:, first_window:first_window + len(x)] = x.T
 
             if mprov_connection:
-                ProcessSlidingWindowPerChannel.write_window_annot(mprov_connection, in_name, window, window_size_usec,
-                                        op_name, ret.shape[1] - 1, '')
+                for window in range(first_window, first_window + len(x)):
+                    ProcessSlidingWindowPerChannel.write_window_annot(mprov_connection, in_name, window, window_size_usec,
+                                            op_name, window, '')
 
         return ret
 
 
+def _compute_batch(batch_computation, windows):
+    """
+    Returns the result of batch_computation over a block of windows as an array.
+    Blocks of unequal length windows are passed one window at a time.
+    """
+    if isinstance(windows, list):
+        return np.concatenate([np.asarray(batch_computation(matrix[np.newaxis]))
+                               for matrix in windows])
+    return np.asarray(batch_computation(windows))
+
+
 class ProcessSlidingWindowAcrossChannels:
     """
     Methods to process a sliding window across channels.
@@ -123,32 +553,72 @@ class ProcessSlidingWindowAcrossChannels:
 
     @staticmethod
     def execute(dataset, channel_subset_list, start_time_usec, window_size_usec, slide_usec, duration_usec,
-                per_block_computation):
+                per_block_computation, block_usec=None, batch=False, max_workers=None,
+                skip_gaps=False, annotation_index=None):
         """
         Access a sliding window over a subset of channels, do a single computation
         over the 2D matrix, and repeat for the duration
 
+        Windows are read in blocks of about block_usec microseconds.
+
+        If batch is True, per_block_computation is called once per block with a
+        windows x samples x channels array and must return one result per window,
+        for example lambda windows: np.mean(windows, axis=(1, 2)).
+
+        If max_workers is set, windows are computed in a pool of that many processes.
+        per_block_computation must then be picklable, so it should be a module level
+        function rather than a lambda. The result is the same as in serial mode.
+        Datasets copied to the workers have no session, so per_block_computation
+        cannot read data or annotations from the IEEG platform there.
+
+        If skip_gaps is True, windows which are known gaps of all channels (see
+        Dataset.get_gaps) are neither read nor computed, and their results are None.
+
+        If annotation_index, an ieeg.annotation_index.AnnotationIndex, is given,
+        per_block_computation is called with a Window instead of the 2D matrix. The
+        Window's data_block holds the matrix and its annotations property the
+        annotations which overlap the window. annotation_index cannot be used with batch.
+
         Returns an array
         """
         return ProcessSlidingWindowAcrossChannels.execute_with_provenance(dataset, channel_subset_list, start_time_usec, window_size_usec, slide_usec,
                                             duration_usec,
-                                            per_block_computation, None, None, None)
+                                            per_block_computation, None, None, None,
+                                            block_usec=block_usec, batch=batch,
+                                            max_workers=max_workers, skip_gaps=skip_gaps,
+                                            annotation_index=annotation_index)
 
     @staticmethod
     def execute_with_provenance(dataset, channel_subset_list, start_time_usec, window_size_usec, slide_usec,
-                                duration_usec, per_block_computation, mprov_connection, op_name, in_name):
+                                duration_usec, per_block_computation, mprov_connection, op_name, in_name,
+                                block_usec=None, batch=False, max_workers=None,
+                                skip_gaps=False, annotation_index=None):
         channel_indices = dataset.get_channel_indices(channel_subset_list)
-        ret = []
+        window_args = _window_args(dataset, channel_subset_list, start_time_usec, slide_usec,
+                                   window_size_usec, annotation_index,
+                                   per_block_computation, batch)
+        window_count = int(math.ceil(duration_usec / slide_usec))
+        blocks = SlidingWindowBlocks(dataset, channel_indices, start_time_usec,
+                                     window_size_usec, slide_usec, window_count, block_usec,
+                                     skip_gaps=skip_gaps)
+        ret = [None] * window_count
 
-        for window in range(0, int(math.ceil(duration_usec / slide_usec))):
-            start_index = start_time_usec + window * slide_usec
+        block_args = (per_block_computation, batch, window_args)
+        if max_workers:
+            block_results = ((first_window, results)
+                             for first_window, _, _, _, results
+                             in run_blocks_in_process_pool(blocks, _across_channels_block,
+                                                           block_args, max_workers))
+        else:
+            block_results = ((first_window, _across_channels_block(block_args, first_window, windows))
+                             for first_window, windows in blocks)
 
-            matrix = dataset.get_data(start_index, window_size_usec, channel_indices)
-            x = per_block_computation(matrix)
+        for first_window, x in block_results:
+            ret[first_window:first_window + len(x)] = x
 
-            ret = ret + [x]
             if mprov_connection:
-                ProcessSlidingWindowPerChannel.write_window_annot(mprov_connection, in_name, window, window_size_usec,
-                                        op_name, len(ret) - 1, '')
+                for window in range(first_window, first_window + len(x)):
+                    ProcessSlidingWindowPerChannel.write_window_annot(mprov_connection, in_name, window, window_size_usec,
+                                            op_name, window, '')
 
         return np.array(ret)
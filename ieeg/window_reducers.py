@@ -0,0 +1,223 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import numpy as np
+
+
+def _prefix_sum(values):
+    """
+    Returns the cumulative sum of values along axis 0 with a leading row of zeros,
+    so that the sum of rows [s, e) is result[e] - result[s].
+    """
+    prefix = np.zeros((values.shape[0] + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=prefix[1:])
+    return prefix
+
+
+def _window_sum(prefix, window_rows, window_end_rows):
+    return prefix[window_end_rows] - prefix[window_rows]
+
+
+def _nan_windows(buffer, window_rows, window_end_rows):
+    """
+    Returns a windows x channels boolean array which is True where a window contains NaN.
+    """
+    nan_counts = _prefix_sum(np.isnan(buffer))
+    return _window_sum(nan_counts, window_rows, window_end_rows) > 0
+
+
+class WindowReducer:
+    """
+    A per channel window computation which can also be computed for every window
+    of a block at once in time proportional to the block length rather than
+    the number of windows times the window length.
+
+    A WindowReducer can be passed as the per_channel_computation of
+    ieeg.processing.ProcessSlidingWindowPerChannel.execute, which then uses reduce.
+    Calling a WindowReducer on the samples of a single channel window computes
+    the same value from scratch.
+    """
+
+    def __call__(self, channel):
+        raise NotImplementedError
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        """
+        Returns a windows x channels array with the value of each window
+        buffer[window_rows[i]:window_end_rows[i]].
+
+        :param buffer: A samples x channels array
+        :param window_rows: The first row of each window in buffer
+        :param window_end_rows: One past the last row of each window in buffer
+        """
+        raise NotImplementedError
+
+
+class Mean(WindowReducer):
+    """
+    The mean of each window. NaN if the window contains NaN.
+    """
+
+    def __call__(self, channel):
+        return np.mean(channel)
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        sums = _window_sum(_prefix_sum(np.nan_to_num(buffer)), window_rows, window_end_rows)
+        means = sums / (window_end_rows - window_rows)[:, np.newaxis]
+        means[_nan_windows(buffer, window_rows, window_end_rows)] = np.nan
+        return means
+
+
+class Variance(WindowReducer):
+    """
+    The population variance of each window. NaN if the window contains NaN.
+    """
+
+    def __call__(self, channel):
+        return np.var(channel)
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        # Shifting by the block mean keeps the running sums small,
+        # which avoids most of the cancellation in sum(x^2) - sum(x)^2 / n.
+        counts = np.count_nonzero(~np.isnan(buffer), axis=0)
+        shift = np.nansum(buffer, axis=0) / np.maximum(counts, 1)
+        shifted = np.nan_to_num(buffer - shift)
+        lengths = (window_end_rows - window_rows)[:, np.newaxis]
+        sums = _window_sum(_prefix_sum(shifted), window_rows, window_end_rows)
+        squares = _window_sum(_prefix_sum(shifted * shifted), window_rows, window_end_rows)
+        variances = np.maximum(squares - sums * sums / lengths, 0) / lengths
+        # The differences of the running sums are not exactly zero for one sample.
+        variances[lengths[:, 0] == 1] = 0
+        variances[_nan_windows(buffer, window_rows, window_end_rows)] = np.nan
+        return variances
+
+
+class StandardDeviation(Variance):
+    """
+    The population standard deviation of each window. NaN if the window contains NaN.
+    """
+
+    def __call__(self, channel):
+        return np.std(channel)
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        return np.sqrt(super(StandardDeviation, self).reduce(
+            buffer, window_rows, window_end_rows))
+
+
+class RootMeanSquare(WindowReducer):
+    """
+    The root mean square of each window. NaN if the window contains NaN.
+    """
+
+    def __call__(self, channel):
+        return np.sqrt(np.mean(channel * channel))
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        values = np.nan_to_num(buffer)
+        squares = _window_sum(_prefix_sum(values * values), window_rows, window_end_rows)
+        rms = np.sqrt(squares / (window_end_rows - window_rows)[:, np.newaxis])
+        rms[_nan_windows(buffer, window_rows, window_end_rows)] = np.nan
+        return rms
+
+
+class LineLength(WindowReducer):
+    """
+    The sum of the absolute differences between consecutive samples of each window.
+    NaN if the window contains NaN.
+    """
+
+    def __call__(self, channel):
+        return np.sum(np.abs(np.diff(channel)))
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        differences = np.abs(np.diff(buffer, axis=0))
+        # Window [s, e) has the differences [s, e - 1).
+        last_rows = np.maximum(window_end_rows - 1, window_rows)
+        lengths = _window_sum(_prefix_sum(np.nan_to_num(differences)), window_rows, last_rows)
+        lengths[_window_sum(_prefix_sum(np.isnan(differences)), window_rows, last_rows) > 0] = np.nan
+        return lengths
+
+
+class ZeroCrossings(WindowReducer):
+    """
+    The number of consecutive sample pairs of opposite sign in each window.
+    """
+
+    def __call__(self, channel):
+        return np.count_nonzero(channel[:-1] * channel[1:] < 0)
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        crossings = buffer[:-1] * buffer[1:] < 0
+        last_rows = np.maximum(window_end_rows - 1, window_rows)
+        return _window_sum(_prefix_sum(crossings), window_rows, last_rows).astype(np.int64)
+
+
+class _Extremum(WindowReducer):
+    """
+    Base class of the minimum and maximum reducers. NaN for empty windows.
+
+    Uses the van Herk/Gil-Werman algorithm: for each window length L the buffer is cut
+    into blocks of L rows, and the running extremum from the start and from the end of
+    every block is computed. A window of L rows spans at most two blocks, so it is
+    answered by combining one suffix and one prefix, in O(n) time for each length.
+    """
+    _combine = None
+    _extremum = None
+    _identity = None
+
+    def __call__(self, channel):
+        if len(channel) == 0:
+            return np.nan
+        return type(self)._extremum(channel)
+
+    def reduce(self, buffer, window_rows, window_end_rows):
+        combine = type(self)._combine
+        lengths = window_end_rows - window_rows
+        result = np.full((len(window_rows), buffer.shape[1]), np.nan)
+        for length in np.unique(lengths[lengths > 0]):
+            selected = lengths == length
+            rows = window_rows[selected]
+            first_row = rows.min()
+            segment = buffer[first_row:window_end_rows[selected].max()]
+            # Pad the segment with the identity to a whole number of blocks.
+            block_count = -(-len(segment) // length)
+            blocks = np.full((block_count * length, buffer.shape[1]), type(self)._identity)
+            blocks[:len(segment)] = segment
+            blocks = blocks.reshape(block_count, length, buffer.shape[1])
+            prefix = combine.accumulate(blocks, axis=1).reshape(-1, buffer.shape[1])
+            suffix = combine.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(
+                -1, buffer.shape[1])
+            offsets = rows - first_row
+            result[selected] = combine(suffix[offsets], prefix[offsets + length - 1])
+        return result
+
+
+class Minimum(_Extremum):
+    """
+    The minimum of each window. NaN if the window contains NaN.
+    """
+    _combine = np.minimum
+    _extremum = np.min
+    _identity = np.inf
+
+
+class Maximum(_Extremum):
+    """
+    The maximum of each window. NaN if the window contains NaN.
+    """
+    _combine = np.maximum
+    _extremum = np.max
+    _identity = -np.inf
@@ -24,7 +24,8 @@ setup(name='ieeg',
       version='1.6',
       description='API for the IEEG.org platform',
       install_requires=['deprecation','requests','numpy','pandas', 'pennprov==2.2.4'],
-      packages=setuptools.find_packages(),
+      extras_require={'async': ['aiohttp']},
+      packages=setuptools.find_packages(exclude=['tests', 'tests.*']),
       long_description=long_description,
       long_description_content_type="text/markdown",
       url="https://github.com/ieeg-portal/ieegpy",
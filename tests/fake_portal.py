@@ -0,0 +1,248 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+import xml.etree.ElementTree as ET
+import numpy as np
+from ieeg.auth import Session
+from ieeg.block_cache import sample_index
+
+GAP_VALUE = np.iinfo(np.int32).min
+
+START_TIME = 1000000000
+DURATION_USEC = 3600 * 1000000
+
+# Six channels at 500 Hz and two at 250 Hz.
+CHANNELS = [{'label': 'LEFT_%02d' % (i + 1), 'rev_id': 'rev%d' % i, 'data_check': 'dc%d' % i,
+             'sample_rate': 500.0 if i < 6 else 250.0, 'conversion': 0.5 + i}
+            for i in range(8)]
+CHANNELS_BY_REV_ID = {channel['rev_id']: channel for channel in CHANNELS}
+
+# Gaps of all channels in usec from the dataset start.
+GAPS = [(20000000, 25000000)]
+
+
+def details_xml():
+    """
+    Returns a getDataSnapshotTimeSeriesDetails response body for CHANNELS.
+    """
+    root = ET.Element('timeseriesdetails')
+    details = ET.SubElement(root, 'details')
+    for channel in CHANNELS:
+        detail = ET.SubElement(details, 'detail')
+        for tag, value in [('channelLabel', channel['label']), ('revisionId', channel['rev_id']),
+                           ('startTime', START_TIME), ('endTime', START_TIME + DURATION_USEC),
+                           ('name', 'n' + channel['label']), ('duration', DURATION_USEC),
+                           ('minSample', -10000), ('maxSample', 10000),
+                           ('numberOfSamples',
+                            int(DURATION_USEC * channel['sample_rate'] / 1e6)),
+                           ('sampleRate', channel['sample_rate']),
+                           ('voltageConversionFactor', channel['conversion']),
+                           ('dataCheck', channel['data_check']), ('acquisition', 'acq')]:
+            ET.SubElement(detail, tag).text = str(value)
+    return ET.tostring(root)
+
+
+def montages_json():
+    """
+    Returns a montages response body with a bipolar montage.
+    """
+    return {'montages': {'montage': [
+        {'@serverId': 'm1', '@name': 'Bipolar', 'montagePairs': {'montagePair': [
+            {'@channel': 'LEFT_01', '@refChannel': 'LEFT_02'},
+            {'@channel': 'LEFT_03', '@refChannel': 'LEFT_04'}]}}]}}
+
+
+def samples(channel, start, duration):
+    """
+    Returns the raw int32 samples of channel in [start, start + duration).
+    """
+    # Like the IEEG platform, no samples are returned past the end of the recording.
+    first = sample_index(min(start, DURATION_USEC), channel['sample_rate'])
+    end = sample_index(min(start + duration, DURATION_USEC), channel['sample_rate'])
+    indices = np.arange(first, end, dtype=np.int64)
+    values = ((indices * 7 + int(channel['rev_id'][3:]) * 1009) % 20001 - 10000).astype(np.int32)
+    times = indices * 1e6 / channel['sample_rate']
+    for gap_start, gap_end in GAPS:
+        values[(times >= gap_start) & (times < gap_end)] = GAP_VALUE
+    return values
+
+
+def expected(labels, start, duration):
+    """
+    Returns the scaled data get_data should return for the given channel labels.
+    """
+    columns = []
+    for label in labels:
+        channel = [channel for channel in CHANNELS if channel['label'] == label][0]
+        raw = samples(channel, start, duration)
+        column = raw * channel['conversion']
+        column[raw == GAP_VALUE] = np.nan
+        columns.append(column)
+    return np.column_stack(columns)
+
+
+def data_response(body, start, duration):
+    """
+    Returns the (body, headers) of a getUnscaledTimeSeriesSetBinaryRaw response to
+    the given XML request body.
+    """
+    root = ET.fromstring(body)
+    rev_ids = [element.find('id').text for element in root.iter('timeSeriesIdAndCheck')]
+    columns = [samples(CHANNELS_BY_REV_ID[rev_id], start, duration) for rev_id in rev_ids]
+    headers = {'samples-per-row': ','.join(str(len(column)) for column in columns),
+               'voltage-conversion-factors-mv': ','.join(
+                   str(CHANNELS_BY_REV_ID[rev_id]['conversion']) for rev_id in rev_ids)}
+    return b''.join(column.astype('>i4').tobytes() for column in columns), headers
+
+
+class FakePortal:
+    """
+    A threaded HTTP stand-in for the IEEG services used by Session and Dataset.
+
+    Attributes:
+        annotations: The annotation records of each layer name, in start time order.
+        added: The number of annotations in each addAnnotationsToDataSnapshot request.
+        data_requests: The (start, duration, channel revisionIds) of each data request.
+        fail_data: The number of data requests to answer with an error, for testing retries.
+    """
+
+    def __init__(self):
+        self.annotations = {}
+        self.added = []
+        self.data_requests = []
+        self.fail_data = 0
+        self._lock = threading.Lock()
+
+    def handle_get(self, path, query):
+        """
+        Returns the (status, body, content type, headers) of a GET request.
+        """
+        if path.startswith('/services/timeseries/getIdByDataSnapshotName/'):
+            name = path.rsplit('/', 1)[1]
+            if name == 'missing':
+                return 404, json.dumps({'IeegWsException': {
+                    'errorCode': 'NoSuchDataSnapshot', 'message': name}}), 'application/json', {}
+            return 200, 'snap-' + name, 'text/plain', {}
+        if path.startswith('/services/timeseries/getDataSnapshotTimeSeriesDetails/'):
+            return 200, details_xml(), 'application/xml', {}
+        if path.startswith('/services/datasets/') and path.endswith('/montages'):
+            return 200, json.dumps(montages_json()), 'application/json', {}
+        if path.startswith('/services/timeseries/getCountsByLayer/'):
+            entries = [{'key': layer, 'value': len(records)}
+                       for layer, records in self.annotations.items()]
+            return 200, json.dumps({'countsByLayer': {'countsByLayer': {'entry': entries}
+                                                      if entries else ''}}), \
+                'application/json', {}
+        if path.startswith('/services/timeseries/getTsAnnotations/'):
+            records = self.annotations.get(path.rsplit('/', 1)[1], [])
+            if 'startOffsetUsec' in query:
+                start_offset = int(query['startOffsetUsec'][0])
+                records = [record for record in records
+                           if record['startTimeUutc'] >= start_offset]
+            first = int(query.get('firstResult', ['0'])[0])
+            if 'maxResults' in query:
+                records = records[first:first + int(query['maxResults'][0])]
+            else:
+                records = records[first:]
+            body = {'timeseriesannotations': {'annotations': {
+                'annotation': records[0] if len(records) == 1 else records} if records else None}}
+            return 200, json.dumps(body), 'application/json', {}
+        return 404, 'not found', 'text/plain', {}
+
+    def handle_post(self, path, query, body):
+        """
+        Returns the (status, body, content type, headers) of a POST request.
+        """
+        if path.startswith('/services/timeseries/getUnscaledTimeSeriesSetBinaryRaw/'):
+            root = ET.fromstring(body)
+            rev_ids = [element.find('id').text for element in root.iter('timeSeriesIdAndCheck')]
+            with self._lock:
+                self.data_requests.append(
+                    (query['start'][0], query['duration'][0], rev_ids))
+                if self.fail_data:
+                    self.fail_data -= 1
+                    return 500, 'unavailable', 'text/plain', {}
+            data, headers = data_response(body, float(query['start'][0]),
+                                          float(query['duration'][0]))
+            return 200, data, 'application/octet-stream', headers
+        if path.startswith('/services/timeseries/addAnnotationsToDataSnapshot/'):
+            records = json.loads(body)['timeseriesannotations']['annotations']['annotation']
+            records = [records] if isinstance(records, dict) else records
+            with self._lock:
+                self.added.append(len(records))
+                for record in records:
+                    layer = self.annotations.setdefault(record['layer'], [])
+                    layer.append(dict(record, revId='added-' + str(sum(self.added)) + '-'
+                                      + str(len(layer))))
+                    layer.sort(key=lambda stored: stored['startTimeUutc'])
+            return 200, 'snap', 'text/plain', {}
+        return 404, 'not found', 'text/plain', {}
+
+
+def _handler(portal):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body, content_type, headers):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            self._reply(*portal.handle_get(url.path, parse_qs(url.query)))
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._reply(*portal.handle_post(url.path, parse_qs(url.query), body))
+    return Handler
+
+
+@contextlib.contextmanager
+def serve(portal=None, **session_kwargs):
+    """
+    Serves portal, a new FakePortal by default, on localhost and yields a
+    (portal, Session) pair connected to it.
+    """
+    portal = portal or FakePortal()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(portal))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    saved = Session.host, Session.port, Session.method
+    Session.host = '127.0.0.1'
+    Session.port = ':' + str(server.server_address[1])
+    Session.method = 'http://'
+    try:
+        with Session('user', 'password', **session_kwargs) as session:
+            yield portal, session
+    finally:
+        Session.host, Session.port, Session.method = saved
+        server.shutdown()
+        server.server_close()
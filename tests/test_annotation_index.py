@@ -0,0 +1,66 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import numpy as np
+from ieeg.annotation_index import AnnotationIndex
+from ieeg.dataset import AnnotationTable
+
+
+def random_table(rng, count):
+    """
+    Returns an AnnotationTable of count annotations on one or two of four channels,
+    some of them of zero length.
+    """
+    starts = rng.integers(0, 10000, count)
+    ends = starts + rng.integers(0, 500, count) * (rng.random(count) < 0.8)
+    channel_counts = rng.integers(1, 3, count)
+    channel_indices = np.concatenate([[]] + [rng.choice(4, size, replace=False)
+                                      for size in channel_counts])
+    offsets = np.concatenate(([0], np.cumsum(channel_counts)))
+    return AnnotationTable(None, starts, ends, ['spike'] * count, ['Spikes'] * count,
+                           ['me'] * count, [''] * count, offsets, channel_indices)
+
+
+def channels_of(table, row):
+    return set(table.channel_indices[table.channel_offsets[row]:table.channel_offsets[row + 1]])
+
+
+def test_queries_match_brute_force():
+    rng = np.random.default_rng(11)
+    index = AnnotationIndex(random_table(rng, 300))
+    table = index.table
+    ends = np.maximum(table.end_usec, table.start_usec + 1)
+    assert (np.diff(table.start_usec) >= 0).all()
+    for _ in range(200):
+        start = int(rng.integers(-100, 10500))
+        end = start + int(rng.integers(0, 700))
+        channels = None if rng.random() < 0.5 else [int(rng.integers(4))]
+        overlaps = (table.start_usec < max(end, start + 1)) & (ends > start)
+        expected = [row for row in np.flatnonzero(overlaps)
+                    if channels is None or channels_of(table, row) & set(channels)]
+        assert sorted(index.overlapping(start, end, channels).tolist()) == expected
+        assert index.count_overlapping([start], [end])[0] == overlaps.sum()
+
+        distances = np.where((table.start_usec <= start) & (ends > start), 0,
+                             np.where(table.start_usec > start, table.start_usec - start,
+                                      start - ends + 1))
+        nearest = index.nearest(start, k=5)
+        assert sorted(distances[nearest].tolist()) == sorted(distances)[:5]
+
+
+def test_empty_index():
+    index = AnnotationIndex(random_table(np.random.default_rng(0), 0))
+    assert len(index) == 0
+    assert len(index.overlapping(0, 100)) == 0 and len(index.nearest(0, k=3)) == 0
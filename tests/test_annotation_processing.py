@@ -0,0 +1,73 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import pickle
+import numpy as np
+import pytest
+from ieeg.annotation_processing import SlidingWindowAnnotator
+from ieeg.dataset import Annotation
+from tests import fake_portal
+
+LABELS = ['LEFT_01', 'LEFT_03']
+
+
+def annotate_high_means(window, annotation_layer):
+    """
+    Annotates windows whose first channel has a mean above 500 uV.
+    """
+    if np.nanmean(window.data_block[:, 0]) <= 500:
+        return None
+    return Annotation(window.dataset, 'detector', 'high mean', '', annotation_layer,
+                      window.window_start_usec,
+                      window.window_start_usec + window.window_size_usec,
+                      annotated_labels=window.input_channel_labels)
+
+
+def annotate_by_reading(window, annotation_layer):
+    window.dataset.get_data(window.window_start_usec, window.window_size_usec, [0])
+
+
+def fields(annotation):
+    return (annotation.annotator, annotation.type, annotation.start_time_offset_usec, annotation.end_time_offset_usec,
+            [detail.portal_id for detail in annotation.annotated])
+
+
+def test_process_pool_annotations_match_serial_mode():
+    with fake_portal.serve() as (portal, session):
+        dataset = session.open_dataset('d1')
+        results = []
+        for max_workers in [None, 2]:
+            annotator = SlidingWindowAnnotator(500000, 200000, annotate_high_means,
+                                               max_workers=max_workers, block_usec=1000000)
+            results.append(annotator.annotate_dataset(dataset, 'Layer' + str(max_workers),
+                                                      10000000, 5000000, LABELS))
+        serial, pooled = results
+        assert serial
+        assert [fields(a) for a in pooled] == [fields(a) for a in serial]
+        assert all(annotation.parent is dataset for annotation in pooled)
+        assert portal.added == [len(serial), len(pooled)]
+
+
+def test_workers_cannot_read_from_the_dataset():
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        copy = pickle.loads(pickle.dumps(dataset))
+        assert copy.get_channel_labels() == dataset.get_channel_labels()
+        with pytest.raises(AttributeError, match='copied to another process'):
+            copy.get_data(0, 1000000, [0])
+
+        annotator = SlidingWindowAnnotator(500000, 500000, annotate_by_reading, max_workers=2)
+        with pytest.raises(AttributeError, match='copied to another process'):
+            annotator.annotate_dataset(dataset, 'Layer', 0, 2000000, LABELS)
@@ -0,0 +1,70 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+from ieeg.annotation_store import AnnotationStore
+from ieeg.metadata_cache import MetadataCache
+from tests import fake_portal
+
+
+def records(layer, count, first=0):
+    """
+    Returns count annotation records of layer on the first channel, one per second.
+    """
+    return [{'revId': layer + '-' + str(i), 'annotator': 'me', 'type': 'spike',
+             'description': '', 'layer': layer, 'startTimeUutc': i * 1000000,
+             'endTimeUutc': i * 1000000 + 500,
+             'timeseriesRevIds': {'timeseriesRevId': fake_portal.CHANNELS[0]['rev_id']}}
+            for i in range(first, first + count)]
+
+
+def test_sync_reads_new_annotations_incrementally(tmp_path):
+    portal = fake_portal.FakePortal()
+    portal.annotations['Spikes'] = records('Spikes', 25)
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        with AnnotationStore(dataset, str(tmp_path)) as store:
+            assert store.sync(page_size=10) == {'Spikes': 25}
+            assert store.sync(page_size=10) == {}
+            portal.annotations['Spikes'] += records('Spikes', 5, 25)
+            # The last copied annotation is read again, and stored once.
+            assert store.sync(page_size=10) == {'Spikes': 6}
+            assert store.get_annotation_layers() == {'Spikes': 30}
+            assert [a.portal_id for a in store.get_annotations('Spikes', 26000000, 27000000)] \
+                == ['Spikes-26']
+
+
+def test_sync_bypasses_cached_layer_counts(tmp_path):
+    portal = fake_portal.FakePortal()
+    portal.annotations['Spikes'] = records('Spikes', 3)
+    cache = MetadataCache(str(tmp_path / 'metadata'), layers_ttl_sec=3600)
+    with fake_portal.serve(portal, metadata_cache=cache) as (_, session):
+        dataset = session.open_dataset('d1')
+        with AnnotationStore(dataset, str(tmp_path / 'store')) as store:
+            assert dataset.get_annotation_layers() == {'Spikes': 3}
+            store.sync()
+            portal.annotations['Spikes'] += records('Spikes', 2, 3)
+            assert store.sync() == {'Spikes': 3}
+            assert store.get_annotation_layers() == {'Spikes': 5}
+
+
+def test_sync_takes_a_single_layer_name(tmp_path):
+    portal = fake_portal.FakePortal()
+    portal.annotations['Spikes'] = records('Spikes', 3)
+    portal.annotations['S'] = records('S', 2)
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        with AnnotationStore(dataset, str(tmp_path)) as store:
+            assert store.sync('Spikes') == {'Spikes': 3}
+            assert store.get_annotation_layers() == {'Spikes': 3}
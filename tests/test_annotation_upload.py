@@ -0,0 +1,80 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import pytest
+from ieeg.annotation_upload import AnnotationJournal, AnnotationUploader
+from ieeg.dataset import Annotation, AnnotationTable
+from ieeg.ieeg_api import IeegConnectionError
+from tests import fake_portal
+
+
+class FailingPortal(fake_portal.FakePortal):
+    """
+    A FakePortal which rejects the fail_add-th addAnnotationsToDataSnapshot request.
+    """
+
+    def __init__(self, fail_add):
+        super().__init__()
+        self.fail_add = fail_add
+        self.add_requests = 0
+
+    def handle_post(self, path, query, body):
+        if path.startswith('/services/timeseries/addAnnotationsToDataSnapshot/'):
+            self.add_requests += 1
+            if self.add_requests == self.fail_add:
+                return 500, 'unavailable', 'text/plain', {}
+        return super().handle_post(path, query, body)
+
+
+def spikes(dataset, starts):
+    return [Annotation(dataset, 'me', 'spike', '', 'Spikes', start, start + 10,
+                       annotated_labels=['LEFT_01']) for start in starts]
+
+
+def test_journal_resumes_duplicate_annotations(tmp_path):
+    portal = FailingPortal(fail_add=2)
+    journal_path = str(tmp_path / 'spikes.journal')
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        # Two identical annotations, of which only the first is accepted.
+        with pytest.raises(IeegConnectionError):
+            dataset.add_annotations(spikes(dataset, [100, 100, 200]), batch_size=1,
+                                    max_workers=1, journal=AnnotationJournal(journal_path))
+        assert portal.added == [1]
+
+        dataset.add_annotations(spikes(dataset, [100, 100, 200]), batch_size=1,
+                                max_workers=1, journal=AnnotationJournal(journal_path))
+        assert [record['startTimeUutc'] for record in portal.annotations['Spikes']] \
+            == [100, 100, 200]
+
+        journal = AnnotationJournal(journal_path)
+        assert len(journal) == 3
+        dataset.add_annotations(spikes(dataset, [100, 100, 200, 100]), batch_size=2,
+                                journal=journal)
+        assert [record['startTimeUutc'] for record in portal.annotations['Spikes']] \
+            == [100, 100, 100, 200]
+
+
+def test_uploads_follow_add_order():
+    portal = fake_portal.FakePortal()
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        with AnnotationUploader(dataset, batch_size=4, max_workers=1) as uploader:
+            uploader.add(spikes(dataset, [100, 200, 300]))
+            uploader.add(AnnotationTable.from_annotations(
+                dataset, spikes(dataset, [400, 500, 600, 700, 800])))
+            uploader.add(spikes(dataset, [900]))
+        assert portal.added == [3, 4, 1, 1]
+        assert uploader.uploaded_count == 9
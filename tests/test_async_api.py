@@ -0,0 +1,283 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import asyncio
+import json
+from urllib.parse import parse_qs
+import numpy as np
+import pytest
+from ieeg.annotation_upload import AnnotationJournal
+from ieeg.auth import Session
+from ieeg.dataset import Annotation
+from ieeg.ieeg_api import IeegConnectionError, IeegServiceError
+from ieeg.metadata_cache import MetadataCache
+from tests import fake_portal
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+from ieeg.async_api import AsyncSession  # noqa: E402
+
+
+class FakePortal:
+    """
+    An aiohttp stand-in for the IEEG services which counts concurrent data requests.
+    Annotation requests are answered by a tests.fake_portal.FakePortal.
+    """
+
+    def __init__(self, data_delay_sec=0):
+        self.data_delay_sec = data_delay_sec
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.data_requests = 0
+        self.annotation_portal = fake_portal.FakePortal()
+        self.app = web.Application()
+        self.app.router.add_get('/services/timeseries/getCountsByLayer/{snapshot}',
+                                self.annotations)
+        self.app.router.add_get('/services/timeseries/getTsAnnotations/{snapshot}/{layer}',
+                                self.annotations)
+        self.app.router.add_post('/services/timeseries/addAnnotationsToDataSnapshot/{snapshot}',
+                                 self.annotations)
+        self.app.router.add_post(
+            '/services/timeseries/datasets/{snapshot}/tsAnnotations/{layer}', self.move_layer)
+        self.app.router.add_post(
+            '/services/timeseries/removeTsAnnotationsByLayer/{snapshot}/{layer}',
+            self.delete_layer)
+        self.app.router.add_get('/services/timeseries/getIdByDataSnapshotName/{name}',
+                                self.get_id)
+        self.app.router.add_get(
+            '/services/timeseries/getDataSnapshotTimeSeriesDetails/{snapshot}', self.details)
+        self.app.router.add_get('/services/datasets/{snapshot}/montages', self.montages)
+        self.app.router.add_post(
+            '/services/timeseries/getUnscaledTimeSeriesSetBinaryRaw/{snapshot}', self.data)
+
+    async def get_id(self, request):
+        assert request.headers['signature']
+        name = request.match_info['name']
+        if name == 'missing':
+            body = {'IeegWsException': {'errorCode': 'NoSuchDataSnapshot', 'message': 'missing'}}
+            return web.Response(status=404, body=json.dumps(body).encode('utf-8'),
+                                content_type='application/json')
+        if name == 'broken':
+            return web.Response(status=500, text='proxy error')
+        return web.Response(text='snap-' + name)
+
+    async def details(self, request):
+        return web.Response(body=fake_portal.details_xml(), content_type='application/xml')
+
+    async def montages(self, request):
+        return web.json_response(fake_portal.montages_json())
+
+    async def annotations(self, request):
+        query = parse_qs(request.query_string)
+        if request.method == 'GET':
+            status, body, content_type, _ = self.annotation_portal.handle_get(
+                request.path, query)
+        else:
+            status, body, content_type, _ = self.annotation_portal.handle_post(
+                request.path, query, await request.read())
+        return web.Response(status=status, text=body, content_type=content_type)
+
+    async def move_layer(self, request):
+        layers = self.annotation_portal.annotations
+        moved = layers.pop(request.match_info['layer'], [])
+        layers.setdefault(request.query['toLayerName'], []).extend(
+            dict(record, layer=request.query['toLayerName']) for record in moved)
+        return web.json_response({'tsAnnotationsMoved': {'moved': str(len(moved))}})
+
+    async def delete_layer(self, request):
+        deleted = self.annotation_portal.annotations.pop(request.match_info['layer'], [])
+        return web.json_response({'tsAnnotationsDeleted': {'noDeleted': str(len(deleted))}})
+
+    async def data(self, request):
+        self.data_requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.data_delay_sec)
+            body, headers = fake_portal.data_response(
+                await request.read(), float(request.query['start']),
+                float(request.query['duration']))
+            return web.Response(body=body, headers=headers,
+                                content_type='application/octet-stream')
+        finally:
+            self.in_flight -= 1
+
+
+def run_with_portal(portal, test, monkeypatch, max_concurrency=8, timeout_sec=None):
+    """
+    Runs the coroutine function test(session) against portal served on localhost.
+    """
+    async def run():
+        server = TestServer(portal.app)
+        await server.start_server()
+        monkeypatch.setattr(Session, 'host', '127.0.0.1')
+        monkeypatch.setattr(Session, 'port', ':' + str(server.port))
+        monkeypatch.setattr(Session, 'method', 'http://')
+        try:
+            async with AsyncSession('user', 'password', max_concurrency=max_concurrency,
+                                    timeout_sec=timeout_sec) as session:
+                return await test(session)
+        finally:
+            await server.close()
+    return asyncio.run(run())
+
+
+def test_get_data(monkeypatch):
+    async def test(session):
+        dataset = await session.open_dataset('d1')
+        data = await dataset.get_data(1000000, 2000000, [0, 2], montage=None)
+        samples = await dataset.get_samples(500, 1000, [0, 2], montage=None)
+        bipolar = await dataset.get_data(1000000, 2000000, [0, 1], montage='Bipolar')
+        mixed = await dataset.get_data(1000000, 2000000, [0, 6], montage=None)
+        by_rate = await dataset.get_data_by_rate(1000000, 2000000, [0, 6])
+        return data, samples, bipolar, mixed, by_rate
+
+    data, samples, bipolar, mixed, by_rate = run_with_portal(FakePortal(), test, monkeypatch)
+    expected = fake_portal.expected(['LEFT_01', 'LEFT_03'], 1000000, 2000000)
+    np.testing.assert_array_equal(data, expected)
+    np.testing.assert_array_equal(samples, expected)
+    raw = fake_portal.expected(['LEFT_01', 'LEFT_02', 'LEFT_03', 'LEFT_04'], 1000000, 2000000)
+    np.testing.assert_allclose(bipolar, np.column_stack((raw[:, 0] - raw[:, 1],
+                                                         raw[:, 2] - raw[:, 3])))
+    assert mixed.shape == (1000, 2)
+    np.testing.assert_array_equal(mixed[:, 0], expected[:, 0])
+    slow = fake_portal.expected(['LEFT_07'], 1000000, 2000000)[:, 0]
+    np.testing.assert_array_equal(mixed[::2, 1], slow)
+    assert sorted(by_rate) == [250.0, 500.0]
+    np.testing.assert_array_equal(by_rate[250.0][1][:, 0], slow)
+
+
+def test_error_mapping(monkeypatch):
+    async def open_missing(session):
+        await session.open_dataset('missing')
+
+    async def open_broken(session):
+        await session.open_dataset('broken')
+
+    with pytest.raises(IeegServiceError) as error:
+        run_with_portal(FakePortal(), open_missing, monkeypatch)
+    assert error.value.ieeg_error_code == 'NoSuchDataSnapshot'
+    with pytest.raises(IeegConnectionError):
+        run_with_portal(FakePortal(), open_broken, monkeypatch)
+
+
+def test_concurrency_limit(monkeypatch):
+    portal = FakePortal(data_delay_sec=0.05)
+
+    async def test(session):
+        dataset = await session.open_dataset('d1')
+        return await asyncio.gather(*[
+            dataset.get_data(chunk * 1000000, 1000000, [0], montage=None)
+            for chunk in range(8)])
+
+    results = run_with_portal(portal, test, monkeypatch, max_concurrency=2)
+    assert len(results) == 8
+    assert portal.data_requests == 8
+    assert portal.max_in_flight == 2
+
+
+def test_timeout_raises_connection_error(monkeypatch):
+    async def test(session):
+        dataset = await session.open_dataset('d1')
+        await dataset.get_data(0, 1000000, [0], montage=None)
+
+    with pytest.raises(IeegConnectionError):
+        run_with_portal(FakePortal(data_delay_sec=2), test, monkeypatch, timeout_sec=0.5)
+
+
+def test_window_cache(monkeypatch):
+    portal = FakePortal()
+
+    async def test(session):
+        dataset = await session.open_dataset('d1')
+        cache = dataset.enable_window_cache(block_usec=1000000)
+        first = await dataset.get_data(500000, 2000000, [0, 2], montage=None)
+        requests = portal.data_requests
+        second = await dataset.get_data(1000000, 1000000, [0, 2], montage=None)
+        return first, second, requests, cache
+
+    first, second, requests, cache = run_with_portal(portal, test, monkeypatch)
+    np.testing.assert_array_equal(
+        first, fake_portal.expected(['LEFT_01', 'LEFT_03'], 500000, 2000000))
+    np.testing.assert_array_equal(
+        second, fake_portal.expected(['LEFT_01', 'LEFT_03'], 1000000, 1000000))
+    assert requests == 3
+    assert portal.data_requests == 3
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_iter_chunks_and_chunked_dataframe(monkeypatch):
+    portal = FakePortal(data_delay_sec=0.05)
+
+    async def test(session):
+        dataset = await session.open_dataset('d1')
+        chunks = [(chunk_start, data) async for chunk_start, data in dataset.iter_chunks(
+            0, 2500000, [0, 1], 1000000, overlap_usec=500000, montage=None)]
+        frame = await dataset.get_dataframe(0, 2500000, [0, 1], index='usec',
+                                            montage=None, chunk_usec=700000)
+        portal.data_requests = 0
+        generator = dataset.iter_chunks(0, 10000000, [0], 1000000, prefetch=2,
+                                        montage=None)
+        await generator.__anext__()
+        await generator.aclose()
+        await asyncio.sleep(0.1)
+        return chunks, frame
+
+    chunks, frame = run_with_portal(portal, test, monkeypatch)
+    assert [chunk_start for chunk_start, _ in chunks] == [0, 500000, 1000000, 1500000]
+    for chunk_start, data in chunks:
+        np.testing.assert_array_equal(data, fake_portal.expected(
+            ['LEFT_01', 'LEFT_02'], chunk_start, min(1000000, 2500000 - chunk_start)))
+    np.testing.assert_array_equal(frame.to_numpy(), fake_portal.expected(
+        ['LEFT_01', 'LEFT_02'], 0, 2500000))
+    assert frame.index[1] == 2000
+    assert portal.data_requests <= 3
+
+
+def test_batched_annotations(monkeypatch, tmp_path):
+    portal = FakePortal()
+    journal_path = str(tmp_path / 'spikes.journal')
+
+    async def test(session):
+        dataset = await session.open_dataset('d1')
+        session.metadata_cache = MetadataCache(str(tmp_path / 'metadata'))
+
+        def spikes(starts):
+            return [Annotation(dataset, 'me', 'spike', '', 'Spikes', start, start + 10,
+                               annotated_labels=['LEFT_01']) for start in starts]
+
+        await dataset.add_annotations(spikes(range(0, 2500, 100)), batch_size=10,
+                                      max_workers=2, journal=AnnotationJournal(journal_path))
+        added = list(portal.annotation_portal.added)
+        await dataset.add_annotations(spikes(range(0, 2600, 100)), batch_size=10,
+                                      journal=AnnotationJournal(journal_path))
+        layers = await dataset.get_annotation_layers()
+        starts = [annotation.start_time_offset_usec
+                  async for annotation in dataset.iter_annotations('Spikes', page_size=7,
+                                                                   max_workers=2)]
+        moved = await dataset.move_annotation_layer('Spikes', 'Moved')
+        moved_layers = await dataset.get_annotation_layers()
+        deleted = await dataset.delete_annotation_layer('Moved')
+        return added, layers, starts, moved, moved_layers, deleted, dataset
+
+    added, layers, starts, moved, moved_layers, deleted, dataset = run_with_portal(
+        portal, test, monkeypatch)
+    assert sorted(added) == [5, 10, 10]
+    assert portal.annotation_portal.added[3:] == [1]
+    assert layers == {'Spikes': 26}
+    assert starts == list(range(0, 2600, 100))
+    assert (moved, moved_layers, deleted) == (26, {'Moved': 26}, 26)
+    assert dataset.session.metadata_cache.get_annotation_layers(dataset.snap_id) is None
@@ -0,0 +1,50 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import requests
+from ieeg.dataset import Dataset
+from ieeg.ieeg_api import IeegConnectionError, IeegServiceError
+from tests import fake_portal
+
+
+class BrokenPortal(fake_portal.FakePortal):
+    """
+    A FakePortal whose 'garbled' dataset has unparseable details.
+    """
+
+    def handle_get(self, path, query):
+        if path.endswith('/snap-garbled'):
+            return 200, '<timeseriesdetails><details>', 'application/xml', {}
+        return super().handle_get(path, query)
+
+
+def test_open_datasets_returns_errors_per_dataset(monkeypatch):
+    with fake_portal.serve(BrokenPortal()) as (_, session):
+        get_id = session.api.get_dataset_id_by_name
+
+        def get_id_or_drop(name):
+            if name == 'dropped':
+                raise requests.ConnectionError('connection reset')
+            return get_id(name)
+        monkeypatch.setattr(session.api, 'get_dataset_id_by_name', get_id_or_drop)
+
+        results = session.open_datasets(['d1', 'missing', 'garbled', 'dropped', 'd1'])
+        assert list(results) == ['d1', 'missing', 'garbled', 'dropped']
+        assert isinstance(results['d1'], Dataset)
+        assert isinstance(results['missing'], IeegServiceError)
+        assert results['missing'].ieeg_error_code == 'NoSuchDataSnapshot'
+        for name in ['garbled', 'dropped']:
+            assert type(results[name]) is IeegConnectionError
+            assert results[name].__cause__ is not None
@@ -0,0 +1,144 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import os
+import numpy as np
+import pytest
+from ieeg.block_cache import DiskBlockCache, WindowCache
+from ieeg.ieeg_api import IeegConnectionError
+from tests import fake_portal
+
+LABELS = ['LEFT_01', 'LEFT_02']
+
+
+class ShortPortal(fake_portal.FakePortal):
+    """
+    A FakePortal whose data responses lack their last sample.
+    """
+
+    def handle_post(self, path, query, body):
+        status, data, content_type, headers = super().handle_post(path, query, body)
+        if path.startswith('/services/timeseries/getUnscaledTimeSeriesSetBinaryRaw/'):
+            lengths = [int(length) for length in headers['samples-per-row'].split(',')]
+            columns = np.frombuffer(data, dtype='>i4').reshape(len(lengths), -1)
+            data = columns[:, :-1].tobytes()
+            headers['samples-per-row'] = ','.join(str(length - 1) for length in lengths)
+        return status, data, content_type, headers
+
+
+def test_cached_reads_match_and_end_at_the_recording_end(tmp_path):
+    cache = DiskBlockCache(str(tmp_path), block_usec=1000000)
+    with fake_portal.serve(disk_cache=cache) as (portal, session):
+        dataset = session.open_dataset('d1')
+        channels = dataset.get_channel_indices(LABELS)
+        start = fake_portal.DURATION_USEC - 2500000
+        expected = fake_portal.expected(LABELS, start, 4000000)
+        np.testing.assert_array_equal(dataset.get_data(start, 4000000, channels), expected)
+        request_count = len(portal.data_requests)
+        np.testing.assert_array_equal(dataset.get_data(start, 4000000, channels), expected)
+        assert len(portal.data_requests) == request_count
+
+
+def test_short_blocks_are_not_cached(tmp_path):
+    cache = DiskBlockCache(str(tmp_path), block_usec=1000000)
+    with fake_portal.serve(ShortPortal(), disk_cache=cache) as (_, session):
+        dataset = session.open_dataset('d1')
+        with pytest.raises(IeegConnectionError):
+            dataset.get_data(0, 3000000, dataset.get_channel_indices(LABELS))
+    assert len(cache._blocks) == 0
+
+
+def test_clear_removes_channel_directories(tmp_path):
+    cache = DiskBlockCache(str(tmp_path), block_usec=1000000)
+    with fake_portal.serve(disk_cache=cache) as (_, session):
+        dataset = session.open_dataset('d1')
+        dataset.get_data(0, 3000000, dataset.get_channel_indices(LABELS))
+        assert len(os.listdir(str(tmp_path))) == 2
+        cache.clear()
+        assert os.listdir(str(tmp_path)) == []
+        np.testing.assert_array_equal(
+            dataset.get_data(0, 3000000, dataset.get_channel_indices(LABELS)),
+            fake_portal.expected(LABELS, 0, 3000000))
+
+
+def test_window_cache_hits_and_misses():
+    with fake_portal.serve() as (portal, session):
+        dataset = session.open_dataset('d1')
+        cache = dataset.enable_window_cache(block_usec=1000000)
+        channels = dataset.get_channel_indices(LABELS)
+        for start in range(0, 3000000, 500000):
+            np.testing.assert_array_equal(
+                dataset.get_data(start, 1000000, channels, montage=None),
+                fake_portal.expected(LABELS, start, 1000000))
+        assert (cache.hits, cache.misses) == (5, 4)
+        assert len(portal.data_requests) == 4
+        assert len(cache) == 4
+        assert cache.total_bytes == 4 * 500 * 2 * 8
+
+
+def test_window_cache_evicts_least_recently_used_blocks():
+    with fake_portal.serve() as (portal, session):
+        dataset = session.open_dataset('d1')
+        cache = dataset.enable_window_cache(max_bytes=2 * 500 * 2 * 8, block_usec=1000000)
+        channels = dataset.get_channel_indices(LABELS)
+        for start in [0, 1000000, 0, 2000000, 1000000, 0]:
+            np.testing.assert_array_equal(
+                dataset.get_data(start, 1000000, channels, montage=None),
+                fake_portal.expected(LABELS, start, 1000000))
+        # Block 1 was evicted by block 2, and block 0 by block 1.
+        assert (cache.hits, cache.misses) == (1, 5)
+        assert len(cache) == 2
+        assert cache.total_bytes <= cache.max_bytes
+
+
+def test_window_cache_keys_blocks_by_montage_and_channels():
+    with fake_portal.serve() as (portal, session):
+        dataset = session.open_dataset('d1')
+        cache = dataset.enable_window_cache(block_usec=1000000)
+        raw = fake_portal.expected(['LEFT_01', 'LEFT_02', 'LEFT_03', 'LEFT_04'], 0, 1000000)
+        reads = [([0, 1], None, raw[:, [0, 1]]),
+                 ([0], None, raw[:, [0]]),
+                 ([1, 0], None, raw[:, [1, 0]]),
+                 ([0, 1], 'Bipolar', np.column_stack((raw[:, 0] - raw[:, 1],
+                                                       raw[:, 2] - raw[:, 3])))]
+        for channels, montage, expected in reads + reads:
+            np.testing.assert_allclose(
+                dataset.get_data(0, 1000000, channels, montage=montage), expected)
+        assert (cache.hits, cache.misses) == (4, 4)
+
+
+def test_window_cache_checks_block_lengths():
+    with fake_portal.serve(ShortPortal()) as (_, session):
+        dataset = session.open_dataset('d1')
+        cache = dataset.enable_window_cache(block_usec=1000000)
+        with pytest.raises(IeegConnectionError):
+            dataset.get_data(0, 3000000, dataset.get_channel_indices(LABELS), montage=None)
+        assert len(cache) == 0
+
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        cache = dataset.enable_window_cache(block_usec=1000000)
+        channels = dataset.get_channel_indices(LABELS)
+        # The last block ends after the recording, so it may be short.
+        start = fake_portal.DURATION_USEC - 1500000
+        np.testing.assert_array_equal(
+            dataset.get_data(start, 1500000, channels, montage=None),
+            fake_portal.expected(LABELS, start, 1500000))
+        assert len(cache) == 2
+
+
+def test_window_cache_rejects_a_zero_block_length():
+    with pytest.raises(ValueError):
+        WindowCache(block_usec=0)
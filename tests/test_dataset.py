@@ -0,0 +1,459 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from ieeg.dataset import AnnotationTable, ChannelTable, Dataset, Montage, TimeSeriesDetails
+from ieeg.ieeg_api import IeegConnectionError
+from tests import fake_portal
+
+
+def test_time_series_details_constructor():
+    details = TimeSeriesDetails('rev0', 'n0', 'LEFT_01', '3600000000.0', '-10', '10',
+                                '1800000', '1000', '3600001000', '500.0', '0.5')
+    assert (details.portal_id, details.name, details.channel_label) == ('rev0', 'n0', 'LEFT_01')
+    assert details.number_of_samples == 1800000 and details.end_time == 3600001000
+    assert details.sample_rate == 500.0 and details.voltage_conversion_factor == 0.5
+    assert 'LEFT_01' in str(details)
+
+
+def test_ts_array_is_deprecated_and_round_trips():
+    table = ChannelTable.parse(fake_portal.details_xml())
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        with pytest.warns(DeprecationWarning):
+            elements = dataset.ts_array
+    assert [element.find('channelLabel').text for element in elements] == table.labels
+    rebuilt = ChannelTable._from_detail_fields(
+        [{child.tag: child.text for child in element} for element in elements])
+    assert rebuilt.portal_ids == table.portal_ids and rebuilt.data_checks == table.data_checks
+    assert (rebuilt.values == table.values).all()
+
+
+@pytest.mark.parametrize('first_sample', [0, 3, 1001, 12289])
+def test_get_samples_at_a_rate_which_does_not_divide_a_second(monkeypatch, first_sample):
+    # A sample every 1953.125 usec, so most samples fall between whole microseconds.
+    for channel in fake_portal.CHANNELS[:2]:
+        monkeypatch.setitem(channel, 'sample_rate', 512.0)
+    with fake_portal.serve() as (portal, session):
+        dataset = session.open_dataset('d1')
+        data = dataset.get_samples(first_sample, 777, [0, 1], montage=None)
+        start, duration, _ = portal.data_requests[-1]
+        assert start == str(int(start)) and duration == str(int(duration))
+        assert data.shape == (777, 2)
+        np.testing.assert_array_equal(data, fake_portal.expected(
+            ['LEFT_01', 'LEFT_02'], first_sample * 1e6 / 512, 777 * 1e6 / 512))
+
+
+def dense_montage(raw_by_label, pairs):
+    """
+    Returns each (channel label, reference labels) pair computed column by column:
+    the channel minus the mean of its reference channels.
+    """
+    return np.column_stack([
+        raw_by_label[label] - np.mean([raw_by_label[reference] for reference in references],
+                                      axis=0)
+        if references else raw_by_label[label]
+        for label, references in pairs])
+
+
+def test_montages_match_a_dense_reference():
+    rng = np.random.default_rng(5)
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        labels = dataset.get_channel_labels()[:6]
+        raw = rng.normal(0, 100, (50, 6))
+        raw[10:13, 2] = np.nan
+        raw_by_label = dict(zip(labels, raw.T))
+        neighbors = {'LEFT_02': ['LEFT_01', 'LEFT_03'], 'LEFT_05': ['LEFT_04', 'LEFT_06'],
+                     'LEFT_06': ['LEFT_05']}
+        montages = [
+            (Montage.common_average(dataset, labels[1:]),
+             [(label, labels[1:]) for label in labels[1:]]),
+            (Montage.laplacian(dataset, neighbors), list(neighbors.items())),
+            (dataset.get_montage('Bipolar'),
+             [('LEFT_01', ['LEFT_02']), ('LEFT_03', ['LEFT_04'])])]
+        for montage, pairs in montages:
+            for montage_channels in (list(range(len(pairs))), [len(pairs) - 1, 0]):
+                raw_channels = montage.get_raw_channels(montage_channels)
+                expected = dense_montage(raw_by_label, [pairs[i] for i in montage_channels])
+                result = montage.apply(raw[:, raw_channels], montage_channels)
+                np.testing.assert_allclose(result, expected)
+                # Only rows whose channels or references are gaps are NaN.
+                np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+                np.testing.assert_allclose(
+                    montage.apply(raw, montage_channels, raw_channels=list(range(6))),
+                    expected)
+                out = np.empty(expected.shape, dtype=np.float32)
+                assert montage.apply(raw[:, raw_channels], montage_channels, out=out) is out
+                np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-3)
+                raw_columns, matrix = montage.get_montage_info(montage_channels)
+                np.testing.assert_allclose(np.nan_to_num(raw[:, raw_columns]) @ matrix,
+                                           dense_montage(
+                                               {label: np.nan_to_num(column)
+                                                for label, column in raw_by_label.items()},
+                                               [pairs[i] for i in montage_channels]),
+                                           atol=1e-9)
+        with pytest.raises(ValueError):
+            Montage.laplacian(dataset, {'LEFT_01': ['NOT_A_CHANNEL']})
+
+
+def test_montaged_reads_propagate_gaps():
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        labels = ['LEFT_01', 'LEFT_02', 'LEFT_03', 'LEFT_04']
+        start, duration = fake_portal.GAPS[0][0] - 1000000, 2000000
+        raw_by_label = dict(zip(labels, fake_portal.expected(labels, start, duration).T))
+        average = Montage.common_average(dataset, labels)
+        result = dataset.get_data(start, duration, [0, 3], montage=average)
+        expected = dense_montage(raw_by_label, [('LEFT_01', labels), ('LEFT_04', labels)])
+        np.testing.assert_allclose(result, expected)
+        assert np.isnan(result[500:]).all() and not np.isnan(result[:500]).any()
+        bipolar = dataset.get_data(start, duration, [0, 1], montage='Bipolar')
+        np.testing.assert_allclose(bipolar, dense_montage(
+            raw_by_label, [('LEFT_01', ['LEFT_02']), ('LEFT_03', ['LEFT_04'])]))
+
+
+class SlowPortal(fake_portal.FakePortal):
+    """
+    A FakePortal which answers each data request after delay_sec seconds.
+    """
+
+    def __init__(self, delay_sec):
+        super().__init__()
+        self.delay_sec = delay_sec
+
+    def handle_post(self, path, query, body):
+        if path.startswith('/services/timeseries/getUnscaledTimeSeriesSetBinaryRaw/'):
+            time.sleep(self.delay_sec)
+        return super().handle_post(path, query, body)
+
+
+def test_iter_chunks_boundaries():
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        chunks = list(dataset.iter_chunks(1000000, 2600000, [0, 6], 1000000,
+                                          overlap_usec=200000, montage=None))
+        assert [chunk_start for chunk_start, _ in chunks] == [1000000, 1800000, 2600000]
+        for chunk_start, data in chunks:
+            duration = min(1000000, 3600000 - chunk_start)
+            np.testing.assert_array_equal(
+                data, dataset.get_data(chunk_start, duration, [0, 6], montage=None))
+        assert [data.shape[0] for _, data in chunks] == [500, 500, 500]
+        assert [chunk_start for chunk_start, _ in dataset.iter_chunks(
+            0, 3000000, [0], 1000000, montage=None)] == [0, 1000000, 2000000]
+        assert list(dataset.iter_chunks(0, 0, [0], 1000000, montage=None)) == []
+        with pytest.raises(ValueError):
+            list(dataset.iter_chunks(0, 3000000, [0], 1000000, overlap_usec=1000000))
+
+
+def test_closing_iter_chunks_cancels_prefetches():
+    portal = SlowPortal(delay_sec=0.2)
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        chunks = dataset.iter_chunks(0, 20000000, [0], 1000000, prefetch=4, montage=None)
+        chunk_start, data = next(chunks)
+        assert chunk_start == 0 and data.shape == (500, 1)
+        chunks.close()
+        # The read in flight when the generator closed may finish, the others never start.
+        time.sleep(0.6)
+        assert len(portal.data_requests) <= 2
+        assert not [thread for thread in threading.enumerate()
+                    if thread.name.startswith('ieeg-prefetch') and thread.is_alive()]
+
+
+def test_get_data_multi_matches_separate_reads():
+    with fake_portal.serve() as (portal, session):
+        dataset = session.open_dataset('d1')
+        average = Montage.common_average(dataset, ['LEFT_02', 'LEFT_03', 'LEFT_05'])
+        channels_by_montage = {None: [4, 0, 6, 0], 'Bipolar': [1, 0], average: [2]}
+        views = dataset.get_data_multi(1000000, 2000000, channels_by_montage)
+        # One read of the union of the raw channels, split into one result per key.
+        assert len(portal.data_requests) == 2
+        assert sorted(len(rev_ids) for _, _, rev_ids in portal.data_requests) == [1, 5]
+        assert set(views) == set(channels_by_montage)
+        for key, channels in channels_by_montage.items():
+            np.testing.assert_allclose(
+                views[key], dataset.get_data(1000000, 2000000, channels, montage=key))
+        assert views[None].shape == (1000, 4)
+
+        single = dataset.get_data_multi(1000000, 2000000, {None: [1]}, dtype=np.float32)
+        assert single[None].dtype == np.float32
+        np.testing.assert_array_equal(single[None][:, 0], np.float32(
+            fake_portal.expected(['LEFT_02'], 1000000, 2000000)[:, 0]))
+
+
+def test_get_data_multi_errors():
+    portal = fake_portal.FakePortal()
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        with pytest.raises(ValueError):
+            dataset.get_data_multi(0, 1000000, {None: [0]}, dtype=np.int32)
+        with pytest.raises(KeyError):
+            dataset.get_data_multi(0, 1000000, {None: [0], 'No such montage': [0]})
+        assert portal.data_requests == []
+        portal.fail_data = 1
+        with pytest.raises(IeegConnectionError):
+            dataset.get_data_multi(0, 1000000, {None: [0], 'Bipolar': [0]})
+
+
+def test_get_dataframe_time_index():
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        # 1000300 usec falls between samples, so the first row is the sample at 1002000.
+        frame = dataset.get_dataframe(1000300, 1000000, [0, 1], index='usec', montage=None)
+        np.testing.assert_array_equal(frame.index, 1002000 + 2000 * np.arange(500))
+        assert frame.index.name == 'usec'
+        assert list(frame.columns) == ['LEFT_01', 'LEFT_02']
+        np.testing.assert_array_equal(frame.to_numpy(), fake_portal.expected(
+            ['LEFT_01', 'LEFT_02'], 1000300, 1000000))
+
+        times = dataset.get_dataframe(1000300, 1000000, [0], index='datetime',
+                                      montage=None).index
+        np.testing.assert_array_equal(times, pd.to_datetime(
+            fake_portal.START_TIME + 1002000 + 2000 * np.arange(500), unit='us', utc=True))
+        assert str(times.tz) == 'UTC'
+
+        bipolar = dataset.get_dataframe(0, 1000000, [1], montage='Bipolar')
+        assert list(bipolar.columns) == ['LEFT_03-LEFT_04']
+        with pytest.raises(ValueError):
+            dataset.get_dataframe(0, 1000000, [0, 6], index='usec', montage=None)
+        with pytest.raises(ValueError):
+            dataset.get_dataframe(0, 1000000, [0], index='seconds', montage=None)
+
+
+def test_chunked_get_dataframe_fills_one_array(monkeypatch):
+    arrays = []
+    chunk_array = Dataset._chunk_array
+
+    def record_chunk_array(*args):
+        arrays.append(chunk_array(*args))
+        return arrays[-1]
+
+    monkeypatch.setattr(Dataset, '_chunk_array', staticmethod(record_chunk_array))
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        # The read crosses the gap at 20 s and the chunks do not divide it.
+        start = fake_portal.GAPS[0][0] - 2000300
+        whole = dataset.get_dataframe(start, 7000000, [0, 2], index='usec', montage=None)
+        chunked = dataset.get_dataframe(start, 7000000, [0, 2], index='usec', montage=None,
+                                        chunk_usec=1300000)
+        pd.testing.assert_frame_equal(chunked, whole)
+        assert np.isnan(chunked.to_numpy()).any()
+        assert len(arrays) == 1
+        assert np.shares_memory(chunked.to_numpy(), arrays[0])
+
+        float32 = dataset.get_dataframe(start, 7000000, [0, 2], dtype=np.float32,
+                                        montage=None, chunk_usec=1300000)
+        assert float32.dtypes.tolist() == [np.float32, np.float32]
+        assert np.shares_memory(float32.to_numpy(), arrays[1])
+        with pytest.raises(ValueError):
+            dataset.get_dataframe(0, 1000000, [0, 6], montage=None, chunk_usec=300000)
+
+
+def resampled(label, sample_rate, start, duration, sample_times):
+    """
+    Returns the channel read from [start, start + duration) linearly interpolated at
+    sample_times, holding the first and last samples beyond its ends.
+    """
+    values = fake_portal.expected([label], start, duration)[:, 0]
+    first_sample = int(np.ceil(start * sample_rate / 1e6 - 1e-6))
+    times = (first_sample + np.arange(len(values))) * (1e6 / sample_rate)
+    return np.interp(sample_times, times, values)
+
+
+@pytest.mark.parametrize('start', [1000000, 1001000, fake_portal.GAPS[0][1] - 1003000])
+def test_mixed_rates_match_an_explicit_resample(monkeypatch, start):
+    monkeypatch.setitem(fake_portal.CHANNELS[7], 'sample_rate', 200.0)
+    with fake_portal.serve() as (portal, session):
+        dataset = session.open_dataset('d1')
+        duration = 2000000
+        data = dataset.get_data(start, duration, [6, 0, 7], montage=None)
+        assert len(portal.data_requests) == 3
+        sample_times = (np.ceil(start / 2000 - 1e-9) + np.arange(1000)) * 2000
+        assert data.shape == (1000, 3)
+        np.testing.assert_array_equal(
+            data[:, 1], fake_portal.expected(['LEFT_01'], start, duration)[:, 0])
+        for column, (label, sample_rate) in ((0, ('LEFT_07', 250.0)),
+                                             (2, ('LEFT_08', 200.0))):
+            np.testing.assert_allclose(
+                data[:, column], resampled(label, sample_rate, start, duration, sample_times))
+
+        out = np.empty((1000, 3), dtype=np.float32)
+        assert dataset.get_data(start, duration, [6, 0, 7], out=out, montage=None) is out
+        np.testing.assert_allclose(out, data, rtol=1e-6)
+        by_rate = dataset.get_data_by_rate(start, duration, [6, 0, 7])
+        assert sorted(by_rate) == [200.0, 250.0, 500.0]
+        assert by_rate[200.0][0] == [7]
+
+
+def annotation_record(rev_id, start, end, layer='Events'):
+    return {'annotator': 'me', 'type': 'event', 'description': rev_id, 'layer': layer,
+            'startTimeUutc': start, 'endTimeUutc': end, 'revId': rev_id,
+            'timeseriesRevIds': {'timeseriesRevId': ['rev0']}}
+
+
+class CountingPortal(fake_portal.FakePortal):
+    """
+    A FakePortal which records the firstResult of each getTsAnnotations request.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pages = []
+
+    def handle_get(self, path, query):
+        if path.startswith('/services/timeseries/getTsAnnotations/'):
+            with self._lock:
+                self.pages.append(int(query.get('firstResult', ['0'])[0]))
+        return super().handle_get(path, query)
+
+
+def test_iter_annotations_pages_in_start_time_order():
+    portal = CountingPortal()
+    # Ties in start time, some of which straddle page boundaries.
+    starts = [start // 3 * 1000 for start in range(23)]
+    portal.annotations['Events'] = [annotation_record('a%02d' % i, start, start + 500)
+                                    for i, start in enumerate(starts)]
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        for page_size in (1, 5, 6, 23, 100):
+            portal.pages = []
+            annotations = list(dataset.iter_annotations('Events', page_size=page_size,
+                                                        max_workers=3))
+            assert [a.description for a in annotations] == ['a%02d' % i for i in range(23)]
+            assert [a.start_time_offset_usec for a in annotations] == starts
+            expected_pages = list(range(0, 23, page_size))
+            if 23 % page_size == 0:
+                # A full last page is followed by a check for annotations added since.
+                expected_pages.append(23)
+            assert sorted(portal.pages) == expected_pages
+        assert list(dataset.iter_annotations('Missing')) == []
+        with pytest.raises(ValueError):
+            list(dataset.iter_annotations('Events', page_size=0))
+
+
+def test_iter_annotations_reads_annotations_added_after_counting():
+    portal = CountingPortal()
+    portal.annotations['Events'] = [annotation_record('a%02d' % i, i * 1000, i * 1000 + 1)
+                                    for i in range(10)]
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        annotations = dataset.iter_annotations('Events', page_size=5, max_workers=1)
+        first = next(annotations)
+        portal.annotations['Events'].extend(
+            annotation_record('b%02d' % i, 20000 + i, 20001 + i) for i in range(7))
+        rest = list(annotations)
+        assert [a.description for a in [first] + rest] == \
+            ['a%02d' % i for i in range(10)] + ['b%02d' % i for i in range(7)]
+
+
+def test_closing_iter_annotations_stops_reading_pages():
+    portal = CountingPortal()
+    portal.annotations['Events'] = [annotation_record('a%03d' % i, i * 1000, i * 1000 + 1)
+                                    for i in range(100)]
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        annotations = dataset.iter_annotations('Events', page_size=10, max_workers=2)
+        taken = [next(annotations) for _ in range(12)]
+        annotations.close()
+        time.sleep(0.2)
+        assert [a.description for a in taken] == ['a%03d' % i for i in range(12)]
+        # Only the max_workers pages after the second were submitted, not all ten.
+        assert len(portal.pages) <= 4
+
+
+def annotation_table_records():
+    records = [annotation_record('r%d' % i, 1000 * i, 1000 * i + 10 * i, layer)
+               for i, layer in enumerate(['Spikes', 'Seizures', 'Spikes', 'Spikes', 'Other'])]
+    channel_rev_ids = [['rev0'], ['rev2', 'rev5'], ['rev1'], ['rev7', 'rev0', 'rev3'], 'rev4']
+    for record, rev_ids in zip(records, channel_rev_ids):
+        record['timeseriesRevIds']['timeseriesRevId'] = rev_ids
+    records[1]['type'] = 'seizure'
+    return records
+
+
+def test_annotation_table_json_round_trip():
+    portal = fake_portal.FakePortal()
+    records = annotation_table_records()
+    portal.annotations['Layer'] = records
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        table = dataset.get_annotations('Layer', as_table=True)
+        assert len(table) == 5
+        np.testing.assert_array_equal(table.channel_offsets, [0, 1, 3, 4, 7, 8])
+        np.testing.assert_array_equal(table.channel_indices, [0, 2, 5, 1, 7, 0, 3, 4])
+        assert table.channel_indices.dtype == np.int32
+        assert [table.channels(row).tolist() for row in range(5)] == \
+            [[0], [2, 5], [1], [7, 0, 3], [4]]
+        assert list(table.types.categories) == ['event', 'seizure']
+
+        json_annotations, annotated = table.to_json()
+        for record, json_annotation in zip(records, json_annotations):
+            rev_ids = record['timeseriesRevIds']['timeseriesRevId']
+            assert json_annotation == dict(record, timeseriesRevIds={
+                'timeseriesRevId': [rev_ids] if isinstance(rev_ids, str) else rev_ids})
+        assert annotated == ['rev0', 'rev1', 'rev2', 'rev3', 'rev4', 'rev5', 'rev7']
+
+        listed = dataset.get_annotations('Layer')
+        assert [(a.start_time_offset_usec, a.layer, [d.portal_id for d in a.annotated])
+                for a in table.to_annotations()] == \
+            [(a.start_time_offset_usec, a.layer, [d.portal_id for d in a.annotated])
+             for a in listed]
+        from_list = AnnotationTable.from_annotations(dataset, listed)
+        np.testing.assert_array_equal(from_list.channel_offsets, table.channel_offsets)
+        np.testing.assert_array_equal(from_list.channel_indices, table.channel_indices)
+
+        # A table without portal ids is added and read back unchanged.
+        new = table[[0, 1, 3, 4]]
+        new.portal_ids[:] = None
+        new.layers = pd.Categorical(['Copy'] * len(new))
+        dataset.add_annotations(new)
+        copied = dataset.get_annotations('Copy', as_table=True)
+        assert portal.added == [4]
+        np.testing.assert_array_equal(copied.start_usec, new.start_usec)
+        np.testing.assert_array_equal(copied.channel_offsets, new.channel_offsets)
+        np.testing.assert_array_equal(copied.channel_indices, new.channel_indices)
+        assert list(copied.descriptions) == list(new.descriptions)
+
+
+def test_annotation_table_indexing():
+    portal = fake_portal.FakePortal()
+    portal.annotations['Layer'] = annotation_table_records()
+    with fake_portal.serve(portal) as (_, session):
+        dataset = session.open_dataset('d1')
+        table = dataset.get_annotations('Layer', as_table=True)
+        channel_lists = [table.channels(row).tolist() for row in range(len(table))]
+        selections = [slice(1, None, 2), slice(None, None, -1), -1, 2, [3, 0, 3],
+                      np.array([], dtype=int), table.layers == 'Spikes',
+                      (table.end_usec - table.start_usec) > 15]
+        for key in selections:
+            rows = np.atleast_1d(np.arange(len(table))[key])
+            selected = table[key]
+            assert len(selected) == len(rows)
+            np.testing.assert_array_equal(selected.start_usec, table.start_usec[rows])
+            assert list(selected.layers) == list(np.asarray(table.layers)[rows])
+            assert list(selected.portal_ids) == list(table.portal_ids[rows])
+            assert [selected.channels(row).tolist() for row in range(len(rows))] == \
+                [channel_lists[row] for row in rows]
+            assert selected.channel_offsets[0] == 0
+            assert selected.channel_offsets[-1] == len(selected.channel_indices)
+        with pytest.raises(IndexError):
+            table[5]
+        with pytest.raises(ValueError):
+            AnnotationTable(dataset, [0], [1, 2], ['t'], ['l'], ['a'], ['d'], [0, 0], [])
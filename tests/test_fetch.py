@@ -0,0 +1,144 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import numpy as np
+import pytest
+from ieeg.block_cache import sample_index
+from ieeg import fetch
+from ieeg.fetch import FetchPlanner, decode_response, staging_buffer
+from ieeg.ieeg_api import IeegConnectionError
+from tests import fake_portal
+
+
+def test_plan_snaps_tile_edges_to_sample_grid():
+    planner = FetchPlanner(None, tile_usec=500000, tile_channels=2)
+    sample_rate, grid_offset = 3.0, 100
+    rows = planner.plan(250, 10 * 1000000, [0, 1, 2], [(3000000, 4000000)],
+                        (sample_rate, grid_offset))
+    assert [tile.channels for tile in rows[0]] == [[0, 1], [2]]
+    edges = [row[0].start for row in rows] + [rows[-1][0].start + rows[-1][0].duration]
+    assert edges[0] == 250 and edges[-1] == 250 + 10 * 1000000
+    assert all(isinstance(edge, int) for edge in edges)
+    assert edges == sorted(set(edges))
+    # Each inner edge is the last whole usec at or before its sample.
+    for edge in edges[1:-1]:
+        index = sample_index(edge - grid_offset, sample_rate)
+        assert edge == int(np.floor(grid_offset + index * 1e6 / sample_rate))
+    assert [row[0].gap for row in rows].count(True) == 1
+
+
+def test_plan_casts_float_tile_edges():
+    planner = FetchPlanner(None, tile_usec=60 * 1e6)
+    rows = planner.plan(0, 150 * 1000000, [0])
+    assert [(row[0].start, row[0].duration) for row in rows] == [
+        (0, 60000000), (60000000, 60000000), (120000000, 30000000)]
+    assert all(isinstance(row[0].start, int) for row in rows)
+
+
+@pytest.mark.parametrize('labels', [['LEFT_01', 'LEFT_03'], ['LEFT_07', 'LEFT_08']])
+def test_tiled_fetch_matches_expected_samples(labels):
+    # Tile edges fall between samples.
+    with fake_portal.serve(fetch_tile_usec=1234567.5, fetch_tile_channels=1) as (
+            portal, session):
+        dataset = session.open_dataset('d1')
+        channels = dataset.get_channel_indices(labels)
+        start, duration = 18000333, 9000777
+        data = dataset.get_data(start, duration, channels)
+        np.testing.assert_array_equal(data, fake_portal.expected(labels, start, duration))
+        assert len(portal.data_requests) > 2 * len(labels)
+
+
+def test_stitch_rejects_short_tiles():
+    class Portal(fake_portal.FakePortal):
+        def handle_post(self, path, query, body):
+            status, body, content_type, headers = super().handle_post(path, query, body)
+            if (path.startswith('/services/timeseries/getUnscaledTimeSeriesSetBinaryRaw/')
+                    and float(query['start'][0]) == 1000000):
+                # Drop the last sample of the second tile.
+                body = body[:-4]
+                headers['samples-per-row'] = str(int(headers['samples-per-row']) - 1)
+            return status, body, content_type, headers
+
+    with fake_portal.serve(Portal(), fetch_tile_usec=1000000) as (_, session):
+        dataset = session.open_dataset('d1')
+        with pytest.raises(IeegConnectionError):
+            dataset.get_data(0, 3000000, dataset.get_channel_indices(['LEFT_01']))
+
+
+def test_staging_buffer_keeps_only_small_buffers():
+    small = staging_buffer(1000)
+    assert staging_buffer(500).base is small.base
+    large = staging_buffer(fetch._MAX_STAGING_VALUES + 1)
+    assert large.size == fetch._MAX_STAGING_VALUES + 1
+    assert staging_buffer(1000).base is small.base
+
+
+class FakeResponse:
+    """
+    A streamed getUnscaledTimeSeriesSetBinaryRaw response.
+    """
+
+    def __init__(self, columns, conversion_factors, chunk_bytes=7):
+        self.headers = {'samples-per-row': ','.join(str(len(column)) for column in columns),
+                        'voltage-conversion-factors-mv': ','.join(
+                            str(factor) for factor in conversion_factors)}
+        self.content = b''.join(np.asarray(column, dtype='>i4').tobytes()
+                                for column in columns)
+        self.chunk_bytes = chunk_bytes
+
+    def iter_content(self, chunk_size):
+        for first in range(0, len(self.content), self.chunk_bytes):
+            yield self.content[first:first + self.chunk_bytes]
+
+
+def test_decode_response_reads_chunks_in_native_order():
+    columns = [[1, -2, 2**31 - 1], [-2**31, 0, 70000]]
+    storage = np.empty(10, dtype=np.int32)
+    int_matrix, conv_f = decode_response(FakeResponse(columns, [0.5, 2.0]), 2,
+                                         lambda size: storage[:size])
+    np.testing.assert_array_equal(int_matrix, np.array(columns).T)
+    assert int_matrix.dtype == np.int32 and int_matrix.base is not None
+    np.testing.assert_array_equal(conv_f, [0.5, 2.0])
+    np.testing.assert_array_equal(storage[:6], [1, -2, 2**31 - 1, -2**31, 0, 70000])
+
+
+def test_decode_response_rejects_length_mismatch():
+    response = FakeResponse([[1, 2, 3], [4, 5, 6]], [1.0, 1.0])
+    response.content = response.content[:-1]
+    with pytest.raises(IeegConnectionError):
+        decode_response(response, 2)
+    response.content += b'\0\0\0\0\0'
+    with pytest.raises(IeegConnectionError):
+        decode_response(response, 2)
+
+
+def test_get_data_converts_to_each_dtype():
+    labels = ['LEFT_02', 'LEFT_05']
+    start, duration = 19000000, 2000000
+    expected = fake_portal.expected(labels, start, duration)
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        channels = dataset.get_channel_indices(labels)
+        raw, conv_f = dataset.get_data(start, duration, channels, dtype='raw')
+        assert raw.dtype == np.int32
+        np.testing.assert_array_equal(conv_f, [1.5, 4.5])
+        assert (raw[np.isnan(expected)] == fake_portal.GAP_VALUE).all()
+        np.testing.assert_array_equal(dataset.get_data(start, duration, channels), expected)
+        single = dataset.get_data(start, duration, channels, dtype=np.float32)
+        assert single.dtype == np.float32
+        np.testing.assert_array_equal(single, expected.astype(np.float32))
+        out = np.empty(expected.shape, dtype=np.float32)
+        assert dataset.get_data(start, duration, channels, out=out) is out
+        np.testing.assert_array_equal(out, expected.astype(np.float32))
@@ -0,0 +1,80 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import numpy as np
+from ieeg.gap_index import GapIndex, Intervals
+
+
+def covered(intervals, length):
+    """
+    Returns a boolean array which is True at each usec in [0, length) the intervals cover.
+    """
+    mask = np.zeros(length, dtype=bool)
+    for start, end in intervals.pairs():
+        mask[start:end] = True
+    return mask
+
+
+def test_intervals_match_a_boolean_model():
+    rng = np.random.default_rng(3)
+    intervals = Intervals()
+    model = np.zeros(250, dtype=bool)
+    for _ in range(500):
+        start = int(rng.integers(0, 200))
+        end = start + int(rng.integers(0, 30))
+        if rng.random() < 0.6:
+            intervals.add(start, end)
+            model[start:end] = True
+        else:
+            intervals.remove(start, end)
+            model[start:end] = False
+        np.testing.assert_array_equal(covered(intervals, 250), model)
+        # Intervals are disjoint and do not touch.
+        assert all(end < next_start for end, next_start
+                   in zip(intervals.ends[:-1], intervals.starts[1:]))
+
+        query_start = int(rng.integers(0, 200))
+        query_end = query_start + int(rng.integers(1, 20))
+        in_range = model[query_start:query_end]
+        assert intervals.length(query_start, query_end) == in_range.sum()
+        assert intervals.covers(query_start, query_end) == (
+            in_range.all())
+        assert intervals.covers_each([query_start], [query_end])[0] == intervals.covers(
+            query_start, query_end)
+
+
+def test_intervals_intersection():
+    first = Intervals([(0, 10), (20, 30), (40, 50)])
+    second = Intervals([(5, 25), (28, 45)])
+    assert first.intersection(second).pairs() == [(5, 10), (20, 25), (28, 30), (40, 45)]
+    assert first.clipped(8, 42).pairs() == [(8, 10), (20, 30), (40, 42)]
+
+
+def test_gap_index_records_common_gaps_and_round_trips():
+    index = GapIndex()
+    index.record(0, 0, 100, [(10, 30), (60, 70)])
+    index.record(1, 0, 100, [(20, 40), (60, 80)])
+    assert index.common_gaps([0, 1], 0, 100) == [(20, 30), (60, 70)]
+    assert index.is_gap([0, 1], 62, 68) and not index.is_gap([0, 1], 10, 30)
+    assert index.gap_windows([0, 1], [20, 25, 60], [30, 35, 70]).tolist() == [True, False, True]
+    assert index.coverage(0, 0, 200) == 70 / 200
+    # Reading again replaces the gaps in the read span.
+    index.record(0, 50, 100, [])
+    assert index.get_gaps(0) == [(10, 30)]
+
+    loaded = GapIndex()
+    loaded.load_json(index.to_json(), int)
+    assert loaded.to_json() == index.to_json()
+    assert not GapIndex().common_gaps([0], 0, 100)
@@ -0,0 +1,47 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import pickle
+import xml.etree.ElementTree as ET
+from ieeg.ieeg_api import DataRequestBodies
+
+
+def requested_ids(body):
+    return [element.find('id').text for element in ET.fromstring(body).iter('timeSeriesIdAndCheck')]
+
+
+def test_bodies_list_each_channel_once_in_dataset_order():
+    bodies = DataRequestBodies(['r0', 'r1', 'r2'], ['c0', 'c1', 'c2'], max_entries=2)
+    body = bodies.get([2, 0, 2])
+    assert requested_ids(body) == ['r0', 'r2']
+    checks = [element.find('dataCheck').text
+              for element in ET.fromstring(body).iter('timeSeriesIdAndCheck')]
+    assert checks == ['c0', 'c2']
+    assert bodies.get((0, 2)) is body
+    assert requested_ids(bodies.get([])) == []
+
+
+def test_bodies_evict_least_recently_used_and_pickle():
+    bodies = DataRequestBodies(['r0', 'r1', 'r2'], ['c0', 'c1', 'c2'], max_entries=2)
+    first = bodies.get([0])
+    bodies.get([1])
+    bodies.get([0])
+    bodies.get([2])
+    assert bodies.get([0]) is first
+    assert list(bodies._bodies) == [frozenset([2]), frozenset([0])]
+
+    copy = pickle.loads(pickle.dumps(bodies))
+    assert copy.get([0, 1]) == bodies.get([0, 1])
+    assert len(copy._bodies) == 1
@@ -0,0 +1,103 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import json
+import pytest
+from ieeg.ieeg_api import IeegServiceError
+from ieeg.metadata_cache import MetadataCache
+from tests import fake_portal
+
+
+class CountingPortal(fake_portal.FakePortal):
+    """
+    A FakePortal which counts GET requests by service and can rename its montage.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.gets = []
+        self.montage_name = 'Bipolar'
+
+    def handle_get(self, path, query):
+        self.gets.append(path.split('/')[3] if path.startswith('/services/timeseries/')
+                         else path.rsplit('/', 1)[1])
+        if path.endswith('/montages'):
+            body = fake_portal.montages_json()
+            body['montages']['montage'][0]['@name'] = self.montage_name
+            return 200, json.dumps(body), 'application/json', {}
+        return super().handle_get(path, query)
+
+
+def test_expired_entries_are_validated_with_one_request(tmp_path):
+    portal = CountingPortal()
+    cache = MetadataCache(str(tmp_path), ttl_sec=3600)
+    with fake_portal.serve(portal, metadata_cache=cache) as (_, session):
+        session.open_dataset('d1')
+        portal.montage_name = 'Renamed'
+        portal.gets.clear()
+        assert session.open_dataset('d1').montages.keys() == {'Bipolar'}
+        assert portal.gets == []
+
+        cache.ttl_sec = 0
+        assert session.open_dataset('d1').montages.keys() == {'Bipolar'}
+        assert portal.gets == ['getDataSnapshotTimeSeriesDetails']
+
+
+def test_changed_data_checks_refetch_everything(tmp_path, monkeypatch):
+    portal = CountingPortal()
+    cache = MetadataCache(str(tmp_path), ttl_sec=0)
+    with fake_portal.serve(portal, metadata_cache=cache) as (_, session):
+        session.open_dataset('d1')
+        portal.montage_name = 'Renamed'
+        channels = [dict(channel) for channel in fake_portal.CHANNELS]
+        channels[3]['data_check'] = 'changed'
+        monkeypatch.setattr(fake_portal, 'CHANNELS', channels)
+        portal.gets.clear()
+        dataset = session.open_dataset('d1')
+        assert dataset.montages.keys() == {'Renamed'}
+        assert dataset.data_checks[3] == 'changed'
+        assert portal.gets == ['getDataSnapshotTimeSeriesDetails', 'getIdByDataSnapshotName',
+                               'getDataSnapshotTimeSeriesDetails', 'montages']
+
+
+def test_rejected_data_requests_drop_the_entry(tmp_path):
+    class RejectingPortal(CountingPortal):
+        def handle_post(self, path, query, body):
+            return 400, json.dumps({'IeegWsException': {
+                'errorCode': 'BadDataCheck', 'message': 'dataCheck changed'}}), \
+                'application/json', {}
+
+    portal = RejectingPortal()
+    cache = MetadataCache(str(tmp_path), ttl_sec=3600)
+    with fake_portal.serve(portal, metadata_cache=cache) as (_, session):
+        dataset = session.open_dataset('d1')
+        assert cache.get_dataset('d1') is not None
+        with pytest.raises(IeegServiceError):
+            dataset.get_data(0, 1000000, [0])
+        assert cache.get_dataset('d1') is None
+
+
+def test_layer_counts_have_their_own_ttl(tmp_path):
+    portal = CountingPortal()
+    portal.annotations['seizures'] = []
+    cache = MetadataCache(str(tmp_path), layers_ttl_sec=3600)
+    with fake_portal.serve(portal, metadata_cache=cache) as (_, session):
+        dataset = session.open_dataset('d1')
+        assert dataset.get_annotation_layers() == {'seizures': 0}
+        portal.annotations['seizures'] = [{}]
+        assert dataset.get_annotation_layers() == {'seizures': 0}
+
+        cache.layers_ttl_sec = 0
+        assert dataset.get_annotation_layers() == {'seizures': 1}
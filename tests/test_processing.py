@@ -0,0 +1,179 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import numpy as np
+import pytest
+from ieeg.annotation_index import AnnotationIndex
+from ieeg.dataset import Annotation, AnnotationTable
+from ieeg.processing import ProcessSlidingWindowAcrossChannels, ProcessSlidingWindowPerChannel
+from tests import fake_portal
+
+LABELS = ['LEFT_01', 'LEFT_03']
+
+
+def window_by_window(dataset, start, window_size, slide, duration, computation):
+    """
+    Returns computation over each channel of each window read with its own get_data call.
+    """
+    window_count = int(np.ceil(duration / slide))
+    channels = dataset.get_channel_indices(LABELS)
+    return np.array([[computation(column) for column in dataset.get_data(
+        start + window * slide, window_size, channels).T]
+                     for window in range(window_count)]).T
+
+
+def test_per_channel_matches_window_by_window_reads_at_recording_end():
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        # The last windows run past the end of the recording and are shorter.
+        start = fake_portal.DURATION_USEC - 3000000
+        expected = window_by_window(dataset, start, 1000000, 300000, 3000000, np.mean)
+        result = ProcessSlidingWindowPerChannel.execute(
+            dataset, LABELS, start, 1000000, 300000, 3000000, np.mean, block_usec=1000000)
+        np.testing.assert_allclose(result, expected)
+        assert not np.isnan(result).any()
+
+
+def test_per_channel_promotes_result_dtype_across_blocks():
+    def count_or_nan(column):
+        return np.nan if np.isnan(column).any() else len(column)
+
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        # The first blocks give int results and the blocks in the gap at 20 s give NaN.
+        expected = window_by_window(dataset, 15000000, 1000000, 1000000, 10000000,
+                                    count_or_nan)
+        result = ProcessSlidingWindowPerChannel.execute(
+            dataset, LABELS, 15000000, 1000000, 1000000, 10000000, count_or_nan,
+            block_usec=2000000)
+        assert result.dtype == np.float64
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_across_channels_matches_window_by_window_reads():
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        channels = dataset.get_channel_indices(LABELS)
+        start = fake_portal.DURATION_USEC - 2500000
+        expected = [np.max(dataset.get_data(start + window * 400000, 700000, channels))
+                    for window in range(7)]
+        result = ProcessSlidingWindowAcrossChannels.execute(
+            dataset, LABELS, start, 700000, 400000, 2500000, np.max, block_usec=1000000)
+        np.testing.assert_array_equal(result, expected)
+
+
+def peak_to_peak(column):
+    return np.max(column) - np.min(column)
+
+
+def channel_means(matrix):
+    return np.mean(matrix, axis=0)
+
+
+@pytest.mark.parametrize('start', [15000000, fake_portal.DURATION_USEC - 3000000])
+def test_process_pool_matches_serial_mode(start):
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        args = (dataset, LABELS, start, 700000, 300000, 3000000)
+        serial = ProcessSlidingWindowPerChannel.execute(*args, peak_to_peak,
+                                                        block_usec=1000000)
+        pooled = ProcessSlidingWindowPerChannel.execute(*args, peak_to_peak,
+                                                        block_usec=1000000, max_workers=2)
+        np.testing.assert_array_equal(pooled, serial)
+
+        serial = ProcessSlidingWindowAcrossChannels.execute(*args, channel_means,
+                                                            block_usec=1000000)
+        pooled = ProcessSlidingWindowAcrossChannels.execute(*args, channel_means,
+                                                            block_usec=1000000, max_workers=2)
+        assert len(pooled) == len(serial)
+        for pooled_result, serial_result in zip(pooled, serial):
+            np.testing.assert_array_equal(pooled_result, serial_result)
+
+
+def annotation_count(window):
+    return len(window.annotations)
+
+
+def annotated_peak(window):
+    return len(window.annotations) * 1000 + np.max(window.data_block)
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_windows_see_overlapping_annotations(max_workers):
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        spans = [(100000, 200000, 'LEFT_01'), (650000, 1500000, 'LEFT_03'),
+                 (1400000, 1400001, 'LEFT_01'), (2000000, 2600000, 'LEFT_02')]
+        index = AnnotationIndex(AnnotationTable.from_annotations(dataset, [
+            Annotation(dataset, 'me', 'event', '', 'Events', start, end,
+                       annotated_labels=[label]) for start, end, label in spans]))
+        window_starts = [window * 300000 for window in range(10)]
+
+        def expected_count(window_start, labels):
+            return sum(1 for start, end, label in spans if label in labels
+                       and start < window_start + 700000 and end > window_start)
+
+        counts = ProcessSlidingWindowPerChannel.execute(
+            dataset, LABELS, 0, 700000, 300000, 3000000, annotation_count,
+            block_usec=1000000, max_workers=max_workers, annotation_index=index)
+        np.testing.assert_array_equal(
+            counts, [[expected_count(window_start, [label]) for window_start in window_starts]
+                     for label in LABELS])
+
+        peaks = ProcessSlidingWindowAcrossChannels.execute(
+            dataset, LABELS, 0, 700000, 300000, 3000000, annotated_peak,
+            block_usec=1000000, max_workers=max_workers, annotation_index=index)
+        channels = dataset.get_channel_indices(LABELS)
+        np.testing.assert_array_equal(
+            peaks, [expected_count(window_start, LABELS) * 1000
+                    + np.max(dataset.get_data(window_start, 700000, channels))
+                    for window_start in window_starts])
+
+        with pytest.raises(ValueError):
+            ProcessSlidingWindowPerChannel.execute(
+                dataset, LABELS, 0, 700000, 300000, 3000000, annotation_count, batch=True,
+                annotation_index=index)
+
+
+def window_means(windows):
+    return np.mean(windows, axis=1)
+
+
+def window_maxima(windows):
+    return np.max(windows, axis=(1, 2))
+
+
+@pytest.mark.parametrize('start, duration', [(15000000, 2900000),
+                                             (fake_portal.DURATION_USEC - 2900000, 2900000)])
+def test_batch_mode_matches_per_window_mode(start, duration):
+    with fake_portal.serve() as (_, session):
+        dataset = session.open_dataset('d1')
+        # The last window ends after the requested duration, and at the recording end
+        # the last windows are shorter than the others.
+        args = (dataset, LABELS, start, 700000, 300000, duration)
+        per_window = ProcessSlidingWindowPerChannel.execute(*args, np.mean,
+                                                            block_usec=1000000)
+        batched = ProcessSlidingWindowPerChannel.execute(*args, window_means,
+                                                         block_usec=1000000, batch=True)
+        assert per_window.shape == (2, 10)
+        np.testing.assert_allclose(batched, per_window)
+        np.testing.assert_allclose(
+            per_window, window_by_window(dataset, start, 700000, 300000, duration, np.mean))
+
+        per_window = ProcessSlidingWindowAcrossChannels.execute(*args, np.max,
+                                                                block_usec=1000000)
+        batched = ProcessSlidingWindowAcrossChannels.execute(*args, window_maxima,
+                                                             block_usec=1000000, batch=True)
+        np.testing.assert_array_equal(batched, per_window)
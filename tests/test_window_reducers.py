@@ -0,0 +1,100 @@
+'''
+ Copyright 2019 Trustees of the University of Pennsylvania
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+import warnings
+import numpy as np
+import pytest
+from ieeg import window_reducers
+
+REDUCERS = [
+    (window_reducers.Mean(), np.mean),
+    (window_reducers.Variance(), np.var),
+    (window_reducers.StandardDeviation(), np.std),
+    (window_reducers.RootMeanSquare(), lambda x: np.sqrt(np.mean(np.square(x)))),
+    (window_reducers.LineLength(), lambda x: np.sum(np.abs(np.diff(x)))),
+    (window_reducers.ZeroCrossings(), lambda x: np.count_nonzero(np.diff(np.sign(x)) == 2)
+     + np.count_nonzero(np.diff(np.sign(x)) == -2)),
+    (window_reducers.Minimum(), np.min),
+    (window_reducers.Maximum(), np.max),
+]
+
+
+def reduce_each(function, buffer, window_rows, window_end_rows):
+    """
+    Returns function applied to each channel of each window, skipping empty windows.
+    """
+    result = np.full((len(window_rows), buffer.shape[1]), np.nan)
+    for window, (row, end_row) in enumerate(zip(window_rows, window_end_rows)):
+        if end_row > row:
+            result[window] = [function(column) for column in buffer[row:end_row].T]
+    return result
+
+
+@pytest.mark.parametrize('reducer, function', REDUCERS,
+                         ids=[type(reducer).__name__ for reducer, _ in REDUCERS])
+def test_reduce_matches_numpy_on_unequal_windows(reducer, function):
+    rng = np.random.default_rng(7)
+    buffer = rng.normal(1.0, 100.0, (300, 3))
+    buffer[150:153, 1] = np.nan
+    window_rows = rng.integers(0, 290, 200)
+    window_end_rows = np.minimum(window_rows + rng.integers(1, 70, 200), 300)
+    window_rows[:3] = [0, 299, 140]
+    window_end_rows[:3] = [300, 300, 160]
+    result = reducer.reduce(buffer, window_rows, window_end_rows)
+    np.testing.assert_allclose(
+        result, reduce_each(function, buffer, window_rows, window_end_rows), rtol=1e-9,
+        atol=1e-6)
+    np.testing.assert_allclose(
+        result[:, 0], [reducer(buffer[row:end_row, 0])
+                       for row, end_row in zip(window_rows, window_end_rows)],
+        rtol=1e-9, atol=1e-6)
+
+
+@pytest.mark.parametrize('reducer', [window_reducers.Minimum(), window_reducers.Maximum()],
+                         ids=['Minimum', 'Maximum'])
+def test_extremum_of_empty_windows_is_nan(reducer):
+    buffer = np.arange(20, dtype=float).reshape(10, 2)
+    window_rows = np.array([0, 4, 10, 3])
+    window_end_rows = np.array([3, 4, 10, 10])
+    result = reducer.reduce(buffer, window_rows, window_end_rows)
+    assert np.isnan(result[1:3]).all()
+    np.testing.assert_array_equal(
+        result[[0, 3]], reduce_each(type(reducer)._extremum, buffer, window_rows[[0, 3]],
+                                    window_end_rows[[0, 3]]))
+    assert np.isnan(reducer.reduce(buffer, window_rows[1:3], window_end_rows[1:3])).all()
+    assert np.isnan(reducer(buffer[4:4, 0]))
+
+
+def test_empty_windows_match_calling_the_reducer():
+    buffer = np.ones((5, 1))
+    empty = np.array([2])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for reducer, _ in REDUCERS:
+            expected = reducer(buffer[2:2, 0])
+            np.testing.assert_array_equal(reducer.reduce(buffer, empty, empty), [[expected]])
+
+
+@pytest.mark.parametrize('reducer', [window_reducers.Minimum(), window_reducers.Maximum()],
+                         ids=['Minimum', 'Maximum'])
+def test_extremum_of_sliding_windows(reducer):
+    rng = np.random.default_rng(3)
+    buffer = rng.integers(-50, 50, (103, 2)).astype(float)
+    buffer[40, 0] = np.nan
+    window_rows = np.arange(1, 94, 3)
+    window_end_rows = window_rows + 10
+    np.testing.assert_array_equal(
+        reducer.reduce(buffer, window_rows, window_end_rows),
+        reduce_each(type(reducer)._extremum, buffer, window_rows, window_end_rows))